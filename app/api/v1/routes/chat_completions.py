@@ -7,15 +7,29 @@ import asyncio
 from typing import List, Dict, Optional
 from pydantic import BaseModel
 import uuid
+import os
+import re
 from datetime import datetime
-from services.code_agent.code_executor import execute_code
-from services.module_resolver import find_relevant_modules
-from services.llm_client import stream_text_from_llm, get_text_from_llm
+from services.code_agent.code_executor import execute_code, stream_execute_code
+from services.code_agent.executor_pool import ExecutorSaturatedError
+from services.code_agent.output_summary import summarize_output
+from services.code_agent.pipeline import ExecutionPrewarm, static_output, PIPELINE_SHORT_CIRCUIT
+from services.code_agent.code_logger import log_route_decision
+from services.turn_router import classify_turn
+from services.module_resolver import find_relevant_modules, conversation_query
+from services.llm_client import stream_text_from_llm, get_text_from_llm, TokenUsage
+from services.metrics import stage_seconds, stage_timer, retries
 from services.code_agent.code_generator import generate_code
 
 router = APIRouter()
 logger = logging.getLogger(__name__)
 
+# Relay the output of the generated code to streaming clients while it runs
+STREAM_EXECUTION_OUTPUT = os.getenv("STREAM_EXECUTION_OUTPUT", "true").lower() in ("1", "true", "yes")
+
+# Conversation ids become a path segment of the executor's session routes
+CONVERSATION_ID_PATTERN = re.compile(r"[A-Za-z0-9][A-Za-z0-9_.:-]{0,127}")
+
 # Models
 class Message(BaseModel):
     role: str
@@ -32,6 +46,9 @@ class ChatCompletionRequest(BaseModel):
     presence_penalty: Optional[float] = 0
     frequency_penalty: Optional[float] = 0
     user: Optional[str] = None
+    conversation_id: Optional[str] = None
+    # Set to false to bypass the generated code cache for this request
+    use_cache: Optional[bool] = True
 
 class Choice(BaseModel):
     index: int
@@ -61,6 +78,54 @@ class ChatCompletionChunk(BaseModel):
     created: int
     model: str
     choices: List[StreamChoice]
+    usage: Optional[Dict[str, int]] = None
+
+def _sse_chunk(request_id: str, created: int, model: str, delta: DeltaMessage, finish_reason: Optional[str] = None) -> str:
+    """Serialize a single chat completion chunk as a server-sent event."""
+    chunk = ChatCompletionChunk(
+        id=request_id,
+        created=created,
+        model=model,
+        choices=[
+            StreamChoice(
+                index=0,
+                delta=delta,
+                finish_reason=finish_reason
+            )
+        ]
+    )
+    return f"data: {json.dumps(chunk.model_dump())}\n\n"
+
+def _sse_usage_chunk(request_id: str, created: int, model: str, usage: TokenUsage) -> str:
+    """Serialize the final chunk with the token usage of the whole request, it has no choices."""
+    chunk = ChatCompletionChunk(id=request_id, created=created, model=model, choices=[], usage=usage.as_openai())
+    return f"data: {json.dumps(chunk.model_dump())}\n\n"
+
+def _conversation_id(request: ChatCompletionRequest) -> Optional[str]:
+    """
+    Id of the conversation, used to keep its execution session alive between turns.
+    Only clients that send one get a session, without it every turn runs statelessly:
+    an id guessed from the messages could hand one user's interpreter to another.
+
+    Raises:
+        HTTPException: If the conversation id is not a valid session id.
+    """
+    if not request.conversation_id:
+        return None
+    if not CONVERSATION_ID_PATTERN.fullmatch(request.conversation_id):
+        raise HTTPException(
+            status_code=400,
+            detail="conversation_id must be 1 to 128 letters, digits, '_', '.', ':' or '-', starting with a letter or digit"
+        )
+    return request.conversation_id
+
+def _fast_path_messages(request: ChatCompletionRequest) -> List[Message]:
+    """Final answer prompt for conversational turns that need no tools."""
+    current_time = datetime.now().strftime("%Y-%m-%d")
+    system_message = "You are a helpful AI Agent, you can provide real-time information and execute tools."
+    system_message += f"The current date and time is {current_time}. "
+    system_message += "The user's last message needs no tools, answer it directly and briefly within the context of the chat."
+    return [Message(role="system", content=system_message)] + list(request.messages)
 
 # The main chat completions endpoint
 @router.post("/chat/completions")
@@ -68,8 +133,9 @@ async def create_chat_completion(request: ChatCompletionRequest):
     """
     Create a chat completion with code execution capabilities.
     """
-    #start_time = time.time()
     request_id = f"chatcmpl-{uuid.uuid4()}"
+    # Reject an invalid conversation id before a stream is opened
+    _conversation_id(request)
 
     if request.stream:
         return StreamingResponse(
@@ -77,59 +143,87 @@ async def create_chat_completion(request: ChatCompletionRequest):
             media_type="text/event-stream"
         )
     # For non-streaming requests
+    start_time = time.perf_counter()
+    usage = TokenUsage()
     try:
-        # Find relevant modules for the task
         user_query = request.messages[-1].content
-        relevant_modules = await find_relevant_modules(user_query)
+        # Plain conversational turns skip code generation and execution
+        decision = classify_turn(request.messages)
+        await log_route_decision(user_query, decision)
+        if decision.route == "chat":
+            new_messages = _fast_path_messages(request)
+        else:
+            # Find relevant modules for the task
+            with stage_timer("module_resolution"):
+                relevant_modules = await find_relevant_modules(conversation_query(request.messages))
+            session_id = _conversation_id(request)
 
-        # Generate code with retry mechanism
-        max_retries = 2
-        attempt = 0
-        code = None
-        error_message = None
-
-        while attempt <= max_retries:
+            # Warm up the executor and the final answer's connection while the code is generated
+            prewarm = ExecutionPrewarm.start(session_id)
             try:
-                code = await generate_code(
-                    messages=request.messages,
-                    relevant_modules=relevant_modules,
-                    temperature=request.temperature
-                )
-                break
-            except Exception as e:
-                error_message = str(e)
-                logger.warning(f"Code generation attempt {attempt + 1} failed: {error_message}")
-                attempt += 1
-                if attempt > max_retries:
-                    raise Exception("Code generation failed after multiple attempts.")
+                # Generate code with retry mechanism
+                max_retries = 2
+                attempt = 0
+                code = None
+                error_message = None
+
+                while attempt <= max_retries:
+                    try:
+                        with stage_timer("code_gen"):
+                            code = await generate_code(
+                                messages=request.messages,
+                                relevant_modules=relevant_modules,
+                                temperature=request.temperature,
+                                use_cache=request.use_cache,
+                                usage=usage
+                            )
+                        break
+                    except Exception as e:
+                        error_message = str(e)
+                        logger.warning(f"Code generation attempt {attempt + 1} failed: {error_message}")
+                        attempt += 1
+                        if attempt > max_retries:
+                            raise Exception("Code generation failed after multiple attempts.")
+                        else:
+                            retries.inc("code_gen")
+                            await asyncio.sleep(1)  # Wait for a second before retrying
+
+                logger.info(code)
+                execution_result = static_output(code) if PIPELINE_SHORT_CIRCUIT else None
+                if execution_result is None:
+                    # Execute the generated code
+                    execution_result = await execute_code(
+                        code, session_id=session_id, reserved=await prewarm.take(), request_id=request_id,
+                        reserved_wait=prewarm.reserve_wait
+                    )
                 else:
-                    await asyncio.sleep(1)  # Wait for a second before retrying
-
-        logger.info(code)
-        # Execute the generated code
-        execution_result = await execute_code(code)
-        # Modify the system message to include instructions about the execution result
-        system_message = "You are a helpful AI Agent Orchestrator."
-        system_message += f"The user asked: '{user_query}'. Answer this question within the context of the chat."
-        system_message += f"The Python AI Agent wrote and executed Python code that produced this result: '{execution_result}'. "
-        system_message += "Use the execution result to answers the users question within the context."
-        if error_message:
-            system_message += f" The previous attempt to generate code failed with the following error: '{error_message}'. Please correct the code and try again."
-
-        # Create new messages with the modified system message
-        new_messages = [
-            Message(role="system", content=system_message)
-        ]
-        # Add all user messages
-        for msg in request.messages:
-            if msg.role == "user":
-                new_messages.append(msg)
+                    logger.info("Generated code needs no execution, skipping the executor")
+            finally:
+                await prewarm.release()
+            # Modify the system message to include instructions about the execution result
+            system_message = "You are a helpful AI Agent Orchestrator."
+            system_message += f"The user asked: '{user_query}'. Answer this question within the context of the chat."
+            system_message += f"The Python AI Agent wrote and executed Python code that produced this result: '{summarize_output(execution_result)}'. "
+            system_message += "Use the execution result to answers the users question within the context."
+            if error_message:
+                system_message += f" The previous attempt to generate code failed with the following error: '{error_message}'. Please correct the code and try again."
+
+            # Create new messages with the modified system message
+            new_messages = [
+                Message(role="system", content=system_message)
+            ]
+            # Add all user messages
+            for msg in request.messages:
+                if msg.role == "user":
+                    new_messages.append(msg)
         # Get final response from the LLM API
-        response_content = await get_text_from_llm(
-            messages=new_messages,
-            model="mistral-large-latest",
-            temperature=request.temperature
-        )
+        with stage_timer("final_llm"):
+            response_content = await get_text_from_llm(
+                messages=new_messages,
+                model="mistral-large-latest",
+                temperature=request.temperature,
+                usage=usage
+            )
         # Format the response
         return ChatCompletionResponse(
             id=request_id,
@@ -142,113 +236,148 @@ async def create_chat_completion(request: ChatCompletionRequest):
                     finish_reason="stop"
                 )
             ],
-            usage={
-                "prompt_tokens": 0,  # Need to implement token usage
-                "completion_tokens": 0,
-                "total_tokens": 0
-            }
+            usage=usage.as_openai()
+        )
+    except ExecutorSaturatedError as e:
+        logger.warning(f"Executors saturated: {str(e)}")
+        raise HTTPException(
+            status_code=429,
+            detail={"message": str(e), "queue_depth": e.queue_depth},
+            headers={"Retry-After": "5"}
         )
     except Exception as e:
         logger.error(f"Error in chat completion: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        stage_seconds.observe(time.perf_counter() - start_time, "total")
+        logger.info(f"Token usage for request {request_id}: {usage.as_openai()}, stages: {usage.stages}")
 
 async def stream_chat_completion(request: ChatCompletionRequest, request_id: str, is_code_request: bool):
     """
     Stream the chat completion response.
     """
-    start_time = time.time()  # Log the start time
+    start_time = time.perf_counter()  # Log the start time
     created = int(time.time())
+    usage = TokenUsage()
     try:
-        # Find relevant modules
-        user_query = request.messages[-1].content
-        relevant_modules = await find_relevant_modules(user_query)
+        # Open the assistant message right away so the client sees the first byte early
+        yield _sse_chunk(request_id, created, request.model, DeltaMessage(role="assistant", content=""))
 
-        # Generate code with retry mechanism
-        max_retries = 2
-        attempt = 0
-        code = None
-        error_message = None
+        user_query = request.messages[-1].content
+        # Plain conversational turns skip code generation and execution
+        decision = classify_turn(request.messages)
+        await log_route_decision(user_query, decision)
+        if decision.route == "chat":
+            new_messages = _fast_path_messages(request)
+        else:
+            # Find relevant modules
+            with stage_timer("module_resolution"):
+                relevant_modules = await find_relevant_modules(conversation_query(request.messages))
+            session_id = _conversation_id(request)
 
-        while attempt <= max_retries:
+            # Warm up the executor and the final answer's connection while the code is generated
+            prewarm = ExecutionPrewarm.start(session_id)
             try:
-                code = await generate_code(
-                    messages=request.messages,
-                    relevant_modules=relevant_modules,
-                    temperature=0.3
-                )
-                break
-            except Exception as e:
-                error_message = str(e)
-                logger.warning(f"Code generation attempt {attempt + 1} failed: {error_message}")
-                attempt += 1
-                if attempt > max_retries:
-                    raise Exception("Code generation failed after multiple attempts.")
-                else:
-                    await asyncio.sleep(1)  # Wait for a second before retrying
+                # Generate code with retry mechanism
+                max_retries = 2
+                attempt = 0
+                code = None
+                error_message = None
 
-        # Log the generated code for debugging
-        logger.info(f"Generated code: {code[:100]}...")
+                while attempt <= max_retries:
+                    try:
+                        with stage_timer("code_gen"):
+                            code = await generate_code(
+                                messages=request.messages,
+                                relevant_modules=relevant_modules,
+                                temperature=0.3,
+                                use_cache=request.use_cache,
+                                usage=usage
+                            )
+                        break
+                    except Exception as e:
+                        error_message = str(e)
+                        logger.warning(f"Code generation attempt {attempt + 1} failed: {error_message}")
+                        attempt += 1
+                        if attempt > max_retries:
+                            raise Exception("Code generation failed after multiple attempts.")
+                        else:
+                            retries.inc("code_gen")
+                            await asyncio.sleep(1)  # Wait for a second before retrying
 
-        # Execute code silently
-        execution_result = await execute_code(code)
+                # Log the generated code for debugging
+                logger.info(f"Generated code: {code[:100]}...")
 
-        current_time = datetime.now().strftime("%Y-%m-%d")
+                execution_result = static_output(code) if PIPELINE_SHORT_CIRCUIT else None
+                if execution_result is not None:
+                    logger.info("Generated code needs no execution, skipping the executor")
+                else:
+                    # Execute code, relaying its output as progress chunks while it runs
+                    execution_result = ""
+                    output_open = False
+                    async for event in stream_execute_code(
+                        code, session_id=session_id, reserved=await prewarm.take(), request_id=request_id,
+                        reserved_wait=prewarm.reserve_wait
+                    ):
+                        if event["type"] == "result":
+                            execution_result = event["output"]
+                        elif STREAM_EXECUTION_OUTPUT:
+                            content = event["data"]
+                            if not output_open:
+                                content = "```text\n" + content
+                                output_open = True
+                            yield _sse_chunk(request_id, created, request.model, DeltaMessage(content=content))
+                    if output_open:
+                        yield _sse_chunk(request_id, created, request.model, DeltaMessage(content="\n```\n\n"))
+            finally:
+                await prewarm.release()
 
-        # This is probably a bad way to do this, it needs to be more straight forward for the LLM what it retrieves.
-        system_message = "You are a helpful AI Agent, you can provide real-time information and execute tools."
-        system_message += f"The current date and time is {current_time}. "
-        system_message += f"You have retrieved the following information:'{execution_result}'. "
-        system_message += "Use the retrieved information to answer the user's question."
-        system_message += "Always use nice markdown formatting for a clear and concrete answer."
-        if error_message:
-            system_message += f" The previous attempt to generate code failed with the following error: '{error_message}'. Please correct the code and try again."
+            current_time = datetime.now().strftime("%Y-%m-%d")
 
-        new_messages = [
-            Message(role="system", content=system_message)
-        ]
+            # This is probably a bad way to do this, it needs to be more straight forward for the LLM what it retrieves.
+            system_message = "You are a helpful AI Agent, you can provide real-time information and execute tools."
+            system_message += f"The current date and time is {current_time}. "
+            system_message += f"You have retrieved the following information:'{summarize_output(execution_result)}'. "
+            system_message += "Use the retrieved information to answer the user's question."
+            system_message += "Always use nice markdown formatting for a clear and concrete answer."
+            if error_message:
+                system_message += f" The previous attempt to generate code failed with the following error: '{error_message}'. Please correct the code and try again."
+
+            new_messages = [
+                Message(role="system", content=system_message)
+            ]
 
-        # Add all user messages
-        for msg in request.messages:
-                new_messages.append(msg)
+            # Add all user messages
+            for msg in request.messages:
+                    new_messages.append(msg)
 
         # Stream the final explanation from the LLM API
         logging.info(f"Streaming final explanation from LLM API {new_messages}")
+        final_start = time.perf_counter()
+        first_chunk = True
         async for chunk_text in stream_text_from_llm(
             messages=new_messages,
             model="mistral-large-latest",
-            temperature=0.4
+            temperature=0.4,
+            usage=usage
         ):
-            chunk = ChatCompletionChunk(
-                id=request_id,
-                created=created,
-                model=request.model,
-                choices=[
-                    StreamChoice(
-                        index=0,
-                        delta=DeltaMessage(content=chunk_text),
-                        finish_reason=None
-                    )
-                ]
-            )
-            yield f"data: {json.dumps(chunk.model_dump())}\n\n"
+            if first_chunk:
+                stage_seconds.observe(time.perf_counter() - final_start, "final_llm_ttft")
+                first_chunk = False
+            yield _sse_chunk(request_id, created, request.model, DeltaMessage(content=chunk_text))
+        stage_seconds.observe(time.perf_counter() - final_start, "final_llm")
+
+        yield _sse_chunk(request_id, created, request.model, DeltaMessage(), finish_reason="stop")
+        yield _sse_usage_chunk(request_id, created, request.model, usage)
+        yield "data: [DONE]\n\n"
     except Exception as e:
         logger.error(f"Error in streaming: {str(e)}")
         error_message = f"Error: {str(e)}"
-        chunk = ChatCompletionChunk(
-            id=request_id,
-            created=created,
-            model=request.model,
-            choices=[
-                StreamChoice(
-                    index=0,
-                    delta=DeltaMessage(content=error_message),
-                    finish_reason='error'
-                )
-            ]
-        )
-        yield f"data: {json.dumps(chunk.model_dump())}\n\n"
+        yield _sse_chunk(request_id, created, request.model, DeltaMessage(content=error_message), finish_reason='error')
         yield "data: [DONE]\n\n"
     finally:
-        end_time = time.time()  # Log the end time
+        end_time = time.perf_counter()  # Log the end time
         total_time = end_time - start_time
-        logger.info(f"Total execution time for request {request_id}: {total_time:.2f} seconds")
\ No newline at end of file
+        stage_seconds.observe(total_time, "total")
+        logger.info(f"Total execution time for request {request_id}: {total_time:.2f} seconds")
+        logger.info(f"Token usage for request {request_id}: {usage.as_openai()}, stages: {usage.stages}")
\ No newline at end of file
@@ -1,11 +1,55 @@
 from database.database import Database
-from fastapi import APIRouter
+from fastapi import APIRouter, Query
+from datetime import datetime
+import sqlite3
+from typing import Optional
+import asyncio
 
 router = APIRouter()
 
+def _local_iso(value: Optional[datetime]) -> Optional[str]:
+    """Timestamps are stored as naive local time ISO strings, compare in the same form."""
+    if value is None:
+        return None
+    if value.tzinfo is not None:
+        value = value.astimezone().replace(tzinfo=None)
+    return value.isoformat()
+
+def _query_logs(**filters):
+    try:
+        db = Database.reader()
+    except sqlite3.OperationalError:
+        # Nothing was logged yet, the log writer creates the database
+        return [], None
+    try:
+        return db.get_logs(**filters)
+    finally:
+        db.close()
+
 @router.get("/execution-results")
-async def get_execution_results():
-    db = Database()
-    logs = db.get_logs()
-    db.close()
-    return {"logs": logs}
\ No newline at end of file
+async def get_execution_results(
+    limit: int = Query(50, ge=1, le=500, description="Maximum number of logs in the page"),
+    cursor: Optional[int] = Query(None, description="next_cursor of the previous page"),
+    since: Optional[datetime] = Query(None, description="Only logs at or after this time"),
+    until: Optional[datetime] = Query(None, description="Only logs before this time"),
+    status: Optional[int] = Query(None, description="Only logs with this executor response status code"),
+    has_stderr: Optional[bool] = Query(None, description="Only logs with, or without, stderr output"),
+    log_id: Optional[str] = Query(None, description="Only the log with this log id"),
+    summary: bool = Query(False, description="Leave out the code, result and stderr text"),
+):
+    """
+    Return the execution logs newest first, one page at a time.
+    Pass the returned next_cursor as cursor to get the next page, it is null on the last page.
+    """
+    logs, next_cursor = await asyncio.to_thread(
+        _query_logs,
+        limit=limit,
+        cursor=cursor,
+        since=_local_iso(since),
+        until=_local_iso(until),
+        status=status,
+        has_stderr=has_stderr,
+        log_id=log_id,
+        summary=summary,
+    )
+    return {"logs": logs, "next_cursor": next_cursor}
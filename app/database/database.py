@@ -1,14 +1,78 @@
+import os
 import sqlite3
+import hashlib
+import zlib
 from datetime import datetime
 import uuid
+from urllib.parse import quote
+
+# Execution log database file, put it on a volume to keep the logs across deployments
+EXECUTION_LOG_DB_PATH = os.getenv("EXECUTION_LOG_DB_PATH", "execution_log.db")
+
+# zlib level of the stored code and result text
+BLOB_COMPRESSION_LEVEL = 6
+
+# Code and result are stored once per distinct text, in the blobs table, and referenced by hash
+INSERT_EXECUTION = '''
+    INSERT INTO execution_log (log_id, timestamp, code, result, response_status_code, stderr, code_hash, result_hash)
+    VALUES (?, ?, '', '', ?, ?, ?, ?)
+'''
+
+INSERT_BLOB = 'INSERT OR IGNORE INTO blobs (hash, data, size) VALUES (?, ?, ?)'
+
+INSERT_ROUTE_DECISION = '''
+    INSERT INTO route_log (timestamp, query, route, score, reason, latency_ms)
+    VALUES (?, ?, ?, ?, ?, ?)
+'''
+
+# Must match the partial index on execution_log for SQLite to use it
+HAS_STDERR = "stderr IS NOT NULL AND stderr != ''"
+
+LOG_COLUMNS = (
+    "id", "log_id", "timestamp", "code", "result", "response_status_code", "stderr", "code_hash", "result_hash"
+)
+
+# The summary projection leaves out the code, result and stderr text
+SUMMARY_COLUMNS = ("id", "log_id", "timestamp", "response_status_code", f"{HAS_STDERR} AS has_stderr")
+
+def content_hash(text):
+    return hashlib.sha256(text.encode()).hexdigest()
+
+def compress(text):
+    return zlib.compress(text.encode(), BLOB_COMPRESSION_LEVEL)
+
+def decompress(data):
+    return zlib.decompress(data).decode()
 
 class Database:
     # Init the database
-    def __init__(self, db_name='execution_log.db'):
-        self.db_name = db_name
-        self.conn = sqlite3.connect(self.db_name)
+    def __init__(self, db_name=None):
+        self.db_name = db_name or EXECUTION_LOG_DB_PATH
+        # The log writer runs its queries in worker threads, one at a time
+        self.conn = sqlite3.connect(self.db_name, timeout=5, check_same_thread=False)
+        # Only takes effect on a new database, existing ones are switched by enable_incremental_vacuum
+        self.conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+        # WAL lets the API read while the writer commits, NORMAL syncs on checkpoints instead of every commit
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
         self.create_table()
 
+    @classmethod
+    def reader(cls, db_name=None):
+        """
+        Open the database read-only, for queries. Skips the pragmas and the schema setup,
+        so readers never take the write lock from the log writer, which creates the schema.
+
+        Raises:
+            sqlite3.OperationalError: If the database doesn't exist yet.
+        """
+        db = cls.__new__(cls)
+        db.db_name = db_name or EXECUTION_LOG_DB_PATH
+        db.conn = sqlite3.connect(
+            f"file:{quote(os.path.abspath(db.db_name))}?mode=ro", uri=True, timeout=5, check_same_thread=False
+        )
+        return db
+
     def create_table(self):
         with self.conn:
             self.conn.execute('''
@@ -22,16 +86,62 @@ class Database:
                     stderr TEXT
                 )
             ''')
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS route_log (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    timestamp TEXT NOT NULL,
+                    query TEXT NOT NULL,
+                    route TEXT NOT NULL,
+                    score REAL NOT NULL,
+                    reason TEXT NOT NULL,
+                    latency_ms REAL NOT NULL
+                )
+            ''')
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS blobs (
+                    hash TEXT PRIMARY KEY,
+                    data BLOB NOT NULL,
+                    size INTEGER NOT NULL
+                )
+            ''')
+            # Rows written before the blobs table have their text inline and no hashes
+            columns = {row[1] for row in self.conn.execute('PRAGMA table_info(execution_log)')}
+            for column in ("code_hash", "result_hash"):
+                if column not in columns:
+                    self.conn.execute(f'ALTER TABLE execution_log ADD COLUMN {column} TEXT')
+
+            # Indexes for the filters of /v1/execution-results, pages are walked by id
+            self.conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_execution_log_log_id ON execution_log (log_id)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS idx_execution_log_timestamp ON execution_log (timestamp)')
+            self.conn.execute(
+                'CREATE INDEX IF NOT EXISTS idx_execution_log_status ON execution_log (response_status_code, id)'
+            )
+            self.conn.execute(f'''
+                CREATE INDEX IF NOT EXISTS idx_execution_log_has_stderr ON execution_log (id)
+                WHERE {HAS_STDERR}
+            ''')
+            # Indexes for finding blobs that are no longer referenced
+            self.conn.execute('CREATE INDEX IF NOT EXISTS idx_execution_log_code_hash ON execution_log (code_hash)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS idx_execution_log_result_hash ON execution_log (result_hash)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS idx_route_log_timestamp ON route_log (timestamp)')
+
+    # Store a text once, compressed, and return its hash
+    def _store_blob(self, text):
+        digest = content_hash(text)
+        self.conn.execute(INSERT_BLOB, (digest, compress(text), len(text.encode())))
+        return digest
+
+    def _insert_execution(self, log_id, timestamp, code, result, response_status_code, stderr):
+        return self.conn.execute(INSERT_EXECUTION, (
+            log_id, timestamp, response_status_code, stderr, self._store_blob(code), self._store_blob(result)
+        ))
 
     # Log the execution of a code snippet
     def log_execution(self, code, result, response_status_code=None, stderr=None):
         timestamp = datetime.now().isoformat()
         log_id = str(uuid.uuid4())
         with self.conn:
-            cursor = self.conn.execute('''
-                INSERT INTO execution_log (log_id, timestamp, code, result, response_status_code, stderr)
-                VALUES (?, ?, ?, ?, ?, ?)
-            ''', (log_id, timestamp, code, result, response_status_code, stderr))
+            cursor = self._insert_execution(log_id, timestamp, code, result, response_status_code, stderr)
             id = cursor.lastrowid
         return {
             "id": id,
@@ -43,22 +153,144 @@ class Database:
             "stderr": stderr
         }
 
-    # Return all the logs from the db in a structured format
-    def get_logs(self):
-        cursor = self.conn.execute('SELECT * FROM execution_log')
-        logs = cursor.fetchall()
-        structured_logs = []
-        for log in logs:
-            structured_logs.append({
-                "id": log[0],
-                "log_id": log[1],
-                "timestamp": log[2],
-                "code": log[3],
-                "result": log[4],
-                "response_status_code": log[5],
-                "stderr": log[6]
+    # Log the fast-path routing decision of a chat turn
+    def log_route_decision(self, query, route, score, reason, latency_ms):
+        timestamp = datetime.now().isoformat()
+        with self.conn:
+            self.conn.execute(INSERT_ROUTE_DECISION, (timestamp, query, route, score, reason, latency_ms))
+
+    # Insert a batch of execution logs and routing decisions in a single transaction
+    def write_batch(self, executions, route_decisions):
+        with self.conn:
+            for execution in executions:
+                self._insert_execution(*execution)
+            if route_decisions:
+                self.conn.executemany(INSERT_ROUTE_DECISION, route_decisions)
+
+    # Return the text of the given blob hashes
+    def _load_blobs(self, hashes):
+        texts = {}
+        hashes = list(hashes)
+        # Stay below SQLite's limit on the number of query parameters
+        for start in range(0, len(hashes), 500):
+            chunk = hashes[start:start + 500]
+            rows = self.conn.execute(
+                f'SELECT hash, data FROM blobs WHERE hash IN ({", ".join("?" * len(chunk))})', chunk
+            )
+            texts.update((digest, decompress(data)) for digest, data in rows)
+        return texts
+
+    # Return a page of logs, newest first, and the cursor of the next page
+    def get_logs(self, limit=50, cursor=None, since=None, until=None, status=None,
+                 has_stderr=None, log_id=None, summary=False):
+        conditions, params = [], []
+        if cursor is not None:
+            conditions.append('id < ?')
+            params.append(cursor)
+        if since is not None:
+            conditions.append('timestamp >= ?')
+            params.append(since)
+        if until is not None:
+            conditions.append('timestamp < ?')
+            params.append(until)
+        if status is not None:
+            conditions.append('response_status_code = ?')
+            params.append(status)
+        if has_stderr is not None:
+            conditions.append(HAS_STDERR if has_stderr else f'NOT ({HAS_STDERR})')
+        if log_id is not None:
+            conditions.append('log_id = ?')
+            params.append(log_id)
+
+        columns = SUMMARY_COLUMNS if summary else LOG_COLUMNS
+        query = f'SELECT {", ".join(columns)} FROM execution_log'
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        # One extra row tells whether there is a next page
+        query += ' ORDER BY id DESC LIMIT ?'
+        rows = self.conn.execute(query, params + [limit + 1]).fetchall()
+
+        names = [column.split(' AS ')[-1] for column in columns]
+        logs = [dict(zip(names, row)) for row in rows[:limit]]
+        if summary:
+            for log in logs:
+                log["has_stderr"] = bool(log["has_stderr"])
+        else:
+            # Repeated code and results are decompressed once per page
+            texts = self._load_blobs({
+                log[column] for log in logs for column in ("code_hash", "result_hash") if log[column]
             })
-        return structured_logs
+            for log in logs:
+                code_hash, result_hash = log.pop("code_hash"), log.pop("result_hash")
+                if code_hash:
+                    log["code"] = texts.get(code_hash, "")
+                if result_hash:
+                    log["result"] = texts.get(result_hash, "")
+        next_cursor = logs[-1]["id"] if len(rows) > limit else None
+        return logs, next_cursor
+
+    # Move the inline text of up to limit older rows into the blobs table, returns the number of rows moved
+    def compact_legacy_rows(self, limit):
+        with self.conn:
+            rows = self.conn.execute(
+                'SELECT id, code, result FROM execution_log WHERE code_hash IS NULL ORDER BY id LIMIT ?', (limit,)
+            ).fetchall()
+            for id, code, result in rows:
+                self.conn.execute(
+                    "UPDATE execution_log SET code = '', result = '', code_hash = ?, result_hash = ? WHERE id = ?",
+                    (self._store_blob(code), self._store_blob(result), id)
+                )
+        return len(rows)
+
+    # Delete up to limit rows of a log table older than the cutoff, returns the number of rows deleted
+    def delete_older_than(self, table, cutoff, limit):
+        with self.conn:
+            return self.conn.execute(
+                f'DELETE FROM {table} WHERE id IN (SELECT id FROM {table} WHERE timestamp < ? ORDER BY id LIMIT ?)',
+                (cutoff, limit)
+            ).rowcount
+
+    # Delete the oldest limit rows of a log table, returns the number of rows deleted
+    def delete_oldest(self, table, limit):
+        with self.conn:
+            return self.conn.execute(
+                f'DELETE FROM {table} WHERE id IN (SELECT id FROM {table} ORDER BY id LIMIT ?)', (limit,)
+            ).rowcount
+
+    # Delete the blobs no execution log refers to anymore, returns the number of blobs deleted
+    def delete_orphan_blobs(self):
+        with self.conn:
+            return self.conn.execute('''
+                DELETE FROM blobs
+                WHERE NOT EXISTS (SELECT 1 FROM execution_log WHERE code_hash = blobs.hash)
+                  AND NOT EXISTS (SELECT 1 FROM execution_log WHERE result_hash = blobs.hash)
+            ''').rowcount
+
+    def count_rows(self, table):
+        return self.conn.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+
+    # Bytes of the database pages in use, free pages waiting for a vacuum don't count
+    def used_bytes(self):
+        page_count = self.conn.execute('PRAGMA page_count').fetchone()[0]
+        free_pages = self.conn.execute('PRAGMA freelist_count').fetchone()[0]
+        page_size = self.conn.execute('PRAGMA page_size').fetchone()[0]
+        return (page_count - free_pages) * page_size
+
+    # Switch a database created without auto_vacuum to incremental vacuuming, needs a full VACUUM once
+    def enable_incremental_vacuum(self):
+        if self.conn.execute('PRAGMA auto_vacuum').fetchone()[0] == 2:
+            return False
+        self.conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+        self.conn.execute('VACUUM')
+        return True
+
+    # Give free pages back to the file system and truncate the WAL, returns the number of pages freed
+    def incremental_vacuum(self, pages=0):
+        free_pages = self.conn.execute('PRAGMA freelist_count').fetchone()[0]
+        # The pragma frees one page per step, execute() would only step it once
+        self.conn.executescript(f'PRAGMA incremental_vacuum({pages});' if pages else 'PRAGMA incremental_vacuum;')
+        self.conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        return free_pages - self.conn.execute('PRAGMA freelist_count').fetchone()[0]
 
     def close(self):
-        self.conn.close()
\ No newline at end of file
+        self.conn.close()
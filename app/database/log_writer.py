@@ -0,0 +1,191 @@
+import os
+import time
+import uuid
+import asyncio
+import logging
+import sqlite3
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+from database.database import Database
+from database.retention import enforce_retention, LOG_RETENTION_INTERVAL
+
+logger = logging.getLogger(__name__)
+
+# Maximum number of rows written in one transaction
+LOG_BATCH_SIZE = int(os.getenv("LOG_BATCH_SIZE", "100"))
+
+# Milliseconds a row waits at most for its batch to fill up
+LOG_FLUSH_INTERVAL_MS = float(os.getenv("LOG_FLUSH_INTERVAL_MS", "200"))
+
+# Maximum number of rows waiting to be written, further rows are dropped
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+
+_STOP = object()
+
+class LogWriter:
+    """
+    Single background writer for the execution and routing logs.
+
+    Requests put their rows on a queue and return right away. The writer takes them off
+    in batches of up to LOG_BATCH_SIZE rows, or whatever arrived within LOG_FLUSH_INTERVAL_MS,
+    and inserts each batch in one transaction on a long-lived connection, off the event loop.
+    A second task applies the retention policy every LOG_RETENTION_INTERVAL seconds, taking
+    turns with the writer on the same connection.
+    """
+
+    def __init__(
+        self,
+        db_name: Optional[str] = None,
+        batch_size: int = LOG_BATCH_SIZE,
+        flush_interval_ms: float = LOG_FLUSH_INTERVAL_MS,
+        queue_size: int = LOG_QUEUE_SIZE,
+    ):
+        self.db_name = db_name
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval_ms / 1000
+        self.queue_size = queue_size
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._db: Optional[Database] = None
+        self._db_lock = asyncio.Lock()
+        self._retention_task: Optional[asyncio.Task] = None
+        self._stopping = asyncio.Event()
+        self.last_retention: Optional[Dict[str, Any]] = None
+        self.counters = {"queued": 0, "written": 0, "dropped": 0, "batches": 0, "failed": 0}
+
+    async def start(self) -> None:
+        """Open the database and start the writer task."""
+        if self._task is not None and not self._task.done():
+            return
+        self._db = await asyncio.to_thread(Database, self.db_name)
+        self._stopping.clear()
+        self._queue = asyncio.Queue(maxsize=self.queue_size)
+        self._task = asyncio.create_task(self._run())
+        self._retention_task = asyncio.create_task(self._retain())
+        logger.info(f"Log writer started on {self._db.db_name}")
+
+    async def close(self) -> None:
+        """Write everything still queued, then stop the writer and close the database."""
+        if self._task is None:
+            return
+        # Let a running retention pass stop after its current chunk, it shares the connection
+        self._stopping.set()
+        await self._retention_task
+        # The stop marker must get in even when the queue is full
+        await self._queue.put(_STOP)
+        await self._task
+        self._task = None
+        await asyncio.to_thread(self._db.close)
+        self._db = None
+        logger.info(f"Log writer closed after writing {self.counters['written']} rows")
+
+    def _put(self, kind: str, row: Tuple) -> None:
+        try:
+            self._queue.put_nowait((kind, row))
+            self.counters["queued"] += 1
+        except asyncio.QueueFull:
+            # Logging must never hold up a request
+            self.counters["dropped"] += 1
+            logger.warning(f"Log writer queue is full, dropped a {kind} row")
+
+    async def log_execution(
+        self, code: str, result: str, response_status_code: Optional[int] = None, stderr: Optional[str] = None
+    ) -> Dict[str, Any]:
+        """
+        Queue the log of a code execution.
+
+        Returns:
+            Dict[str, Any]: The log entry, without the row id which is assigned when it is written.
+        """
+        if self._task is None:
+            await self.start()
+        entry = {
+            "log_id": str(uuid.uuid4()),
+            "timestamp": datetime.now().isoformat(),
+            "code": code,
+            "result": result,
+            "response_status_code": response_status_code,
+            "stderr": stderr,
+        }
+        self._put("execution", tuple(entry.values()))
+        return entry
+
+    async def log_route_decision(
+        self, query: str, route: str, score: float, reason: str, latency_ms: float
+    ) -> None:
+        """Queue the log of a routing decision."""
+        if self._task is None:
+            await self.start()
+        self._put("route", (datetime.now().isoformat(), query, route, score, reason, latency_ms))
+
+    async def _next_batch(self) -> Tuple[List[Tuple], List[Tuple], bool]:
+        """Wait for a row, then collect more until the batch is full or the interval is over."""
+        item = await self._queue.get()
+        items, stop = [], item is _STOP
+        if not stop:
+            items.append(item)
+        deadline = time.monotonic() + self.flush_interval
+        while not stop and len(items) < self.batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                item = await asyncio.wait_for(self._queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            if item is _STOP:
+                stop = True
+            else:
+                items.append(item)
+        if stop:
+            # Shutting down: take the rest without waiting
+            while not self._queue.empty():
+                item = self._queue.get_nowait()
+                if item is not _STOP:
+                    items.append(item)
+        executions = [row for kind, row in items if kind == "execution"]
+        route_decisions = [row for kind, row in items if kind == "route"]
+        return executions, route_decisions, stop
+
+    async def _run(self) -> None:
+        while True:
+            executions, route_decisions, stop = await self._next_batch()
+            if executions or route_decisions:
+                try:
+                    async with self._db_lock:
+                        await asyncio.to_thread(self._db.write_batch, executions, route_decisions)
+                    self.counters["written"] += len(executions) + len(route_decisions)
+                    self.counters["batches"] += 1
+                except sqlite3.Error as e:
+                    self.counters["failed"] += len(executions) + len(route_decisions)
+                    logger.error(f"Failed to write {len(executions) + len(route_decisions)} log rows: {str(e)}")
+            if stop:
+                return
+
+    async def _retain(self) -> None:
+        while not self._stopping.is_set():
+            try:
+                self.last_retention = await enforce_retention(self._db, self._db_lock, self._stopping)
+            except Exception as e:
+                logger.error(f"Log retention run failed: {str(e)}")
+            try:
+                await asyncio.wait_for(self._stopping.wait(), LOG_RETENTION_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            **self.counters,
+            "pending": self._queue.qsize() if self._queue is not None else 0,
+            "batch_size": self.batch_size,
+            "flush_interval_ms": self.flush_interval * 1000,
+            "last_retention": self.last_retention,
+        }
+
+log_writer = LogWriter()
+
+async def init_log_writer() -> None:
+    await log_writer.start()
+
+async def close_log_writer() -> None:
+    await log_writer.close()
@@ -0,0 +1,119 @@
+import os
+import time
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from typing import Any, Dict, Optional
+from database.database import Database
+
+logger = logging.getLogger(__name__)
+
+# Execution and routing logs older than this many days are deleted, 0 keeps them regardless of age
+LOG_RETENTION_DAYS = float(os.getenv("LOG_RETENTION_DAYS", "30"))
+
+# Maximum number of execution logs kept, the oldest go first, 0 for no limit
+LOG_RETENTION_MAX_ROWS = int(os.getenv("LOG_RETENTION_MAX_ROWS", "100000"))
+
+# Maximum size in megabytes of the data in the log database, the oldest logs go first, 0 for no limit
+LOG_RETENTION_MAX_MB = float(os.getenv("LOG_RETENTION_MAX_MB", "512"))
+
+# Seconds between retention runs
+LOG_RETENTION_INTERVAL = float(os.getenv("LOG_RETENTION_INTERVAL", "3600"))
+
+# Rows deleted or compacted per transaction, the log writer gets the database in between
+LOG_RETENTION_CHUNK = int(os.getenv("LOG_RETENTION_CHUNK", "1000"))
+
+class RetentionStopped(Exception):
+    """The app is shutting down, the retention run stops between two database steps."""
+
+class _RetentionRun:
+    """One pass of the retention policy, each database step takes the lock on its own."""
+
+    def __init__(self, db: Database, lock: asyncio.Lock, stop: Optional[asyncio.Event]):
+        self.db = db
+        self.lock = lock
+        self.stop = stop
+
+    async def locked(self, step, *args):
+        if self.stop is not None and self.stop.is_set():
+            raise RetentionStopped()
+        async with self.lock:
+            return await asyncio.to_thread(step, *args)
+
+    async def in_chunks(self, step, *args) -> int:
+        """Run a chunked step until it has nothing left to do, the writer gets the database in between."""
+        total = 0
+        while True:
+            done = await self.locked(step, *args, LOG_RETENTION_CHUNK)
+            total += done
+            if done < LOG_RETENTION_CHUNK:
+                return total
+
+    async def delete_oldest_while(self, excess_rows) -> int:
+        """Delete the oldest execution logs and their blobs in chunks while excess_rows() is above 0."""
+        deleted = 0
+        while (excess := await excess_rows()) > 0:
+            done = await self.locked(self.db.delete_oldest, "execution_log", min(excess, LOG_RETENTION_CHUNK))
+            if not done:
+                break
+            deleted += done
+            await self.locked(self.db.delete_orphan_blobs)
+        return deleted
+
+    async def run(self) -> Dict[str, Any]:
+        db = self.db
+        start = time.perf_counter()
+        report = {"vacuum_enabled": await self.locked(db.enable_incremental_vacuum)}
+        report["compacted"] = await self.in_chunks(db.compact_legacy_rows)
+
+        deleted = 0
+        if LOG_RETENTION_DAYS > 0:
+            cutoff = (datetime.now() - timedelta(days=LOG_RETENTION_DAYS)).isoformat()
+            deleted += await self.in_chunks(db.delete_older_than, "execution_log", cutoff)
+            report["routes_deleted"] = await self.in_chunks(db.delete_older_than, "route_log", cutoff)
+        report["blobs_deleted"] = await self.locked(db.delete_orphan_blobs)
+
+        if LOG_RETENTION_MAX_ROWS > 0:
+            async def rows_over_limit():
+                return await self.locked(db.count_rows, "execution_log") - LOG_RETENTION_MAX_ROWS
+            deleted += await self.delete_oldest_while(rows_over_limit)
+
+        if LOG_RETENTION_MAX_MB > 0:
+            async def size_over_limit():
+                # The row count needed is unknown, go a chunk at a time
+                too_large = await self.locked(db.used_bytes) > LOG_RETENTION_MAX_MB * 1024 * 1024
+                return LOG_RETENTION_CHUNK if too_large else 0
+            deleted += await self.delete_oldest_while(size_over_limit)
+
+        report["deleted"] = deleted
+        report["pages_freed"] = await self.locked(db.incremental_vacuum)
+        report["used_bytes"] = await self.locked(db.used_bytes)
+        report["duration_ms"] = round((time.perf_counter() - start) * 1000, 2)
+        report["finished_at"] = datetime.now().isoformat()
+        return report
+
+async def enforce_retention(
+    db: Database, lock: asyncio.Lock, stop: Optional[asyncio.Event] = None
+) -> Dict[str, Any]:
+    """
+    Apply the retention policy to the log database.
+
+    Compacts rows that still have their text inline, deletes logs past the maximum age,
+    then the oldest logs until the row and size limits are met, drops the blobs no log
+    refers to anymore and gives the free pages back with an incremental vacuum.
+
+    Args:
+        db: The log database, shared with the log writer.
+        lock: Serializes the database access with the log writer.
+        stop: When set, the run ends before its next database step.
+
+    Returns:
+        Dict[str, Any]: What the run did.
+    """
+    try:
+        report = await _RetentionRun(db, lock, stop).run()
+    except RetentionStopped:
+        logger.info("Log retention run stopped for shutdown")
+        return {"stopped": True, "finished_at": datetime.now().isoformat()}
+    logger.info(f"Log retention run: {report}")
+    return report
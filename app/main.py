@@ -1,9 +1,19 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse
 
 from api.v1.routes.models import router as models_router
 from api.v1.routes.chat_completions import router as chat_completions_router
 from api.v1.routes.get_execution_results import router as get_execution_results_router
+from services.llm_client import init_http_client, close_http_client, get_pool_stats
+from services.code_agent.executor_pool import init_executor_pool, close_executor_pool, get_executor_pool
+from services.code_agent.code_cache import code_cache
+from services.code_agent import local_runtime
+from services.module_resolver import load_catalog, get_catalog
+from services.turn_router import get_router_stats
+from services.metrics import render_metrics
+from database.log_writer import init_log_writer, close_log_writer, log_writer
 
 import uvicorn
 import logging
@@ -16,7 +26,29 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-app = FastAPI(title="AI Code Execution Backend")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Module catalog is parsed once and hot reloaded when the file changes
+    load_catalog()
+    # Shared HTTP client for the LLM API, kept open for the lifetime of the app
+    await init_http_client()
+    # Persistent keep-alive connections to the executor containers
+    await init_executor_pool()
+    # Execution and routing logs are queued and written in batches by a single task
+    await init_log_writer()
+    # The local fallback's virtualenv is normally built with the image, build it now if the modules changed
+    venv_build = local_runtime.prepare_in_background()
+    try:
+        yield
+    finally:
+        if venv_build is not None:
+            venv_build.cancel()
+        await close_executor_pool()
+        await close_http_client()
+        # Last, so the rows logged by requests that were still finishing are written
+        await close_log_writer()
+
+app = FastAPI(title="AI Code Execution Backend", lifespan=lifespan)
 
 # Add middleware
 app.add_middleware(
@@ -31,6 +63,25 @@ app.include_router(models_router, prefix="/v1", tags=["Models"])
 app.include_router(chat_completions_router, prefix="/v1", tags=["Chat"])
 app.include_router(get_execution_results_router, prefix="/v1", tags=["Execution Results"])
 
+@app.get("/health")
+async def health_check():
+    """Health check endpoint with connection pool usage."""
+    executor_pool = await get_executor_pool()
+    return {
+        "status": "healthy",
+        "llm_pool": get_pool_stats(),
+        "executor_pool": executor_pool.stats(),
+        "code_cache": code_cache.stats(),
+        "module_catalog": get_catalog().version,
+        "router": get_router_stats(),
+        "log_writer": log_writer.stats()
+    }
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    """Per-stage latency histograms and counters in the Prometheus text format."""
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
 if __name__ == "__main__":
     port = int(os.getenv("PORT", 8008))
     uvicorn.run("main:app", host="0.0.0.0", port=port, reload=True)
\ No newline at end of file
@@ -0,0 +1,184 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import re
+import sqlite3
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Set to false to disable the generated code cache entirely
+CODE_CACHE_ENABLED = os.getenv("CODE_CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+
+# Number of generated scripts kept in memory
+CODE_CACHE_SIZE = int(os.getenv("CODE_CACHE_SIZE", "512"))
+
+# Seconds a generated script stays valid
+CODE_CACHE_TTL = float(os.getenv("CODE_CACHE_TTL", "3600"))
+
+# Optional SQLite file for a second, persistent cache tier, disabled when empty
+CODE_CACHE_DB_PATH = os.getenv("CODE_CACHE_DB_PATH", "")
+
+# Number of generated scripts kept in the SQLite tier
+CODE_CACHE_DB_SIZE = int(os.getenv("CODE_CACHE_DB_SIZE", "10000"))
+
+def _normalize_text(text: str) -> str:
+    return re.sub(r"\s+", " ", text).strip()
+
+def make_cache_key(
+    messages: List[Any], catalog_version: str, model: str, temperature: float
+) -> str:
+    """
+    Build the cache key of a code generation request.
+
+    Args:
+        messages: The conversation messages sent to the code generator.
+        catalog_version: Version of the module catalog used in the prompt.
+        model: The code generation model.
+        temperature: The sampling temperature.
+
+    Returns:
+        str: A sha256 hex digest.
+    """
+    payload = {
+        "messages": [[msg.role, _normalize_text(msg.content)] for msg in messages],
+        "catalog": catalog_version,
+        "model": model,
+        "temperature": round(temperature, 3),
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+class CodeCache:
+    """
+    Two-tier cache for generated code: an in-memory LRU and an optional SQLite file.
+    Entries expire after a TTL, both tiers are capped in size.
+    """
+
+    def __init__(
+        self,
+        size: int = CODE_CACHE_SIZE,
+        ttl: float = CODE_CACHE_TTL,
+        db_path: str = CODE_CACHE_DB_PATH,
+        db_size: int = CODE_CACHE_DB_SIZE,
+    ):
+        self.size = size
+        self.ttl = ttl
+        self.db_path = db_path
+        self.db_size = db_size
+        self._memory: "OrderedDict[str, tuple]" = OrderedDict()
+        self.counters = {"hits": 0, "memory_hits": 0, "disk_hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+        if self.db_path:
+            self._create_table()
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.db_path, timeout=5)
+
+    def _create_table(self) -> None:
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute('''
+                    CREATE TABLE IF NOT EXISTS code_cache (
+                        key TEXT PRIMARY KEY,
+                        code TEXT NOT NULL,
+                        created REAL NOT NULL,
+                        last_access REAL NOT NULL
+                    )
+                ''')
+                conn.execute('CREATE INDEX IF NOT EXISTS idx_code_cache_last_access ON code_cache (last_access)')
+        finally:
+            conn.close()
+
+    def _disk_get(self, key: str) -> Optional[tuple]:
+        conn = self._connect()
+        try:
+            with conn:
+                row = conn.execute(
+                    'SELECT code, created FROM code_cache WHERE key = ?', (key,)
+                ).fetchone()
+                if row is None:
+                    return None
+                if time.time() - row[1] > self.ttl:
+                    conn.execute('DELETE FROM code_cache WHERE key = ?', (key,))
+                    return None
+                conn.execute('UPDATE code_cache SET last_access = ? WHERE key = ?', (time.time(), key))
+                return row[1], row[0]
+        finally:
+            conn.close()
+
+    def _disk_set(self, key: str, code: str, created: float) -> None:
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute(
+                    'INSERT OR REPLACE INTO code_cache (key, code, created, last_access) VALUES (?, ?, ?, ?)',
+                    (key, code, created, created)
+                )
+                conn.execute('DELETE FROM code_cache WHERE created < ?', (time.time() - self.ttl,))
+                conn.execute('''
+                    DELETE FROM code_cache WHERE key IN (
+                        SELECT key FROM code_cache ORDER BY last_access DESC LIMIT -1 OFFSET ?
+                    )
+                ''', (self.db_size,))
+        finally:
+            conn.close()
+
+    def _memory_set(self, key: str, created: float, code: str) -> None:
+        self._memory[key] = (created, code)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.size:
+            self._memory.popitem(last=False)
+            self.counters["evictions"] += 1
+
+    async def get(self, key: str) -> Optional[str]:
+        """Return the cached code for the key, or None on a miss."""
+        entry = self._memory.get(key)
+        if entry is not None:
+            if time.time() - entry[0] <= self.ttl:
+                self._memory.move_to_end(key)
+                self.counters["hits"] += 1
+                self.counters["memory_hits"] += 1
+                return entry[1]
+            del self._memory[key]
+
+        if self.db_path:
+            try:
+                entry = await asyncio.to_thread(self._disk_get, key)
+            except sqlite3.Error as e:
+                logger.warning(f"Code cache lookup failed: {str(e)}")
+                entry = None
+            if entry is not None:
+                # Promote to the memory tier
+                self._memory_set(key, *entry)
+                self.counters["hits"] += 1
+                self.counters["disk_hits"] += 1
+                return entry[1]
+
+        self.counters["misses"] += 1
+        return None
+
+    async def set(self, key: str, code: str) -> None:
+        """Store generated code in both tiers."""
+        created = time.time()
+        self._memory_set(key, created, code)
+        self.counters["stores"] += 1
+        if self.db_path:
+            try:
+                await asyncio.to_thread(self._disk_set, key, code, created)
+            except sqlite3.Error as e:
+                logger.warning(f"Code cache store failed: {str(e)}")
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.counters["hits"] + self.counters["misses"]
+        return {
+            **self.counters,
+            "hit_rate": round(self.counters["hits"] / lookups, 3) if lookups else 0.0,
+            "memory_entries": len(self._memory),
+            "disk_enabled": bool(self.db_path),
+        }
+
+code_cache = CodeCache()
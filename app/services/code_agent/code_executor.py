@@ -1,68 +1,156 @@
 from services.code_agent.code_logger import log_code_execution
+from services.code_agent.executor_pool import get_executor_pool, Executor, ExecutorSaturatedError
+from services.code_agent import local_runtime
+from services.metrics import stage_seconds, stage_timer, retries, local_fallbacks
 import asyncio
 import tempfile
 import os
 import logging
 import uuid
 import shutil
-import random
 import httpx
+import json
+import time
+from typing import Optional, Dict, AsyncIterator
+from urllib.parse import quote
 
 logger = logging.getLogger(__name__)
 
-# Get the number of executors
-EXECUTOR_POOL_SIZE = int(os.getenv("EXECUTOR_POOL_SIZE", "3"))
+# Keep a live interpreter per conversation on the executors so state survives between turns
+EXECUTOR_SESSIONS_ENABLED = os.getenv("EXECUTOR_SESSIONS_ENABLED", "true").lower() in ("1", "true", "yes")
 
-# Get the list of installed modules from environment variable or use defaults
-INSTALLED_MODULES = os.getenv("INSTALLED_MODULES", "pandas,numpy,matplotlib,requests").split(",")
+class ExecutorBusyError(Exception):
+    """Raised when an executor answers 429: it is full, which is backpressure and not a failure."""
 
-async def execute_code(code: str, timeout: int = 120) -> str:
+    def __init__(self, message: str, queue_depth: int):
+        super().__init__(message)
+        self.queue_depth = queue_depth
+
+def _busy_error(executor: Executor, status_code: int, body: bytes) -> ExecutorBusyError:
+    try:
+        queue_depth = int(json.loads(body).get("queue_depth", 0))
+    except (ValueError, TypeError, AttributeError):
+        queue_depth = 0
+    return ExecutorBusyError(f"{executor.name} answered {status_code}: it is busy", queue_depth)
+
+async def _raise_if_all_busy(tried_executors: set, busy: ExecutorBusyError) -> None:
+    """
+    Raise ExecutorSaturatedError once every healthy executor was tried, so a full pool
+    pushes back to the caller instead of ending up in the local fallback.
+    """
+    pool = await get_executor_pool()
+    if all(executor.executor_id in tried_executors for executor in pool.executors if executor.healthy):
+        raise ExecutorSaturatedError(
+            f"All executors are busy: {str(busy)}", max(busy.queue_depth, pool.waiting)
+        )
+
+async def execute_code(
+    code: str,
+    timeout: int = 120,
+    session_id: Optional[str] = None,
+    reserved: Optional[Executor] = None,
+    request_id: Optional[str] = None,
+    reserved_wait: float = 0.0,
+) -> str:
     """
     Execute Python code with a timeout and retry mechanism.
 
     Args:
         code: The Python code to execute
         timeout: Maximum execution time in seconds
+        session_id: Conversation id, runs the code in the conversation's live session
+        reserved: Executor slot taken ahead of time, used by the first attempt and released afterwards
+        request_id: Chat completion id, sent to the executor so its logs can be traced back
+        reserved_wait: Seconds it took to reserve the slot, counted in the queue wait
 
     Returns:
         The execution output (stdout + stderr)
+
+    Raises:
+        ExecutorSaturatedError: If all executors are busy and the wait queue is full, or every
+            executor answered 429
     """
     execution_id = str(uuid.uuid4())
     max_retries = 2
     attempt = 0
+    # Executors that failed a previous attempt, retries go to a different one
+    tried_executors = set()
+    if not EXECUTOR_SESSIONS_ENABLED:
+        session_id = None
 
     while attempt <= max_retries:
         try:
             # Try to use the executor pool, on failover it will use the local environment
-            return await _execute_in_pool(code, execution_id, timeout)
+            attempt_reserved, reserved = reserved, None
+            return await _execute_in_pool(
+                code, execution_id, timeout, tried_executors, session_id, attempt_reserved, request_id,
+                reserved_wait if attempt_reserved else 0.0
+            )
+        except ExecutorSaturatedError:
+            # Push back to the caller instead of piling more work on the executors
+            raise
+        except ExecutorBusyError as e:
+            # Not a failed attempt, the next one goes to an executor that wasn't tried yet
+            logger.info(str(e))
+            await _raise_if_all_busy(tried_executors, e)
         except Exception as e:
             logger.warning(f"Attempt {attempt + 1} failed: {str(e)}")
             attempt += 1
             if attempt > max_retries:
                 logger.error("All attempts failed. Falling back to local execution.")
+                local_fallbacks.inc()
                 return await _execute_locally(code, execution_id, timeout)
             else:
+                retries.inc("execution")
                 await asyncio.sleep(1)  # Wait before retrying
 
-async def _execute_in_pool(code: str, execution_id: str, timeout: int) -> str:
-    """Execute code in one of the executor containers from the pool."""
+async def _execute_in_pool(
+    code: str,
+    execution_id: str,
+    timeout: int,
+    tried_executors: set,
+    session_id: Optional[str] = None,
+    reserved: Optional[Executor] = None,
+    request_id: Optional[str] = None,
+    reserved_wait: float = 0.0,
+) -> str:
+    """
+    Execute code in the least loaded healthy executor container from the pool.
+    Code of a session always goes to the executor that holds the session.
+    """
+    pool = await get_executor_pool()
     try:
-        # Select a random executor from the pool
-        executor_id = random.randint(1, EXECUTOR_POOL_SIZE)
-        executor_url = f"http://executor-{executor_id}:5000/execute"
+        # Reserve a slot on an executor, waits in the queue when all are busy
+        queued = time.perf_counter()
+        async with pool.acquire(exclude=tried_executors, session_id=session_id, reserved=reserved) as executor:
+            stage_seconds.observe(time.perf_counter() - queued + reserved_wait, "executor_queue_wait")
+            tried_executors.add(executor.executor_id)
+            logger.debug(f"Executing code in {executor.name} with ID {execution_id}")
 
-        logger.debug(f"Executing code in executor-{executor_id} with ID {execution_id}")
+            path = f"/sessions/{quote(session_id, safe='')}/execute" if session_id else "/execute"
+
+            # Send the code to the executor over its persistent connection
+            try:
+                with stage_timer("executor_run"):
+                    response = await executor.client.post(
+                        path,
+                        json={
+                            "code": code,
+                            "execution_id": execution_id,
+                            "timeout": timeout
+                        },
+                        headers=_trace_headers(request_id),
+                        timeout=timeout + 5
+                    )
+            except httpx.RequestError:
+                pool.record_failure(executor)
+                raise
+            pool.record_success(executor)
+
+            if response.status_code == 429:
+                # The executor is saturated, the next attempt picks a different one
+                raise _busy_error(executor, response.status_code, response.content)
 
-        # Send the code to the executor
-        async with httpx.AsyncClient(timeout=timeout + 5) as client:
-            response = await client.post(
-                executor_url,
-                json={
-                    "code": code,
-                    "execution_id": execution_id,
-                    "timeout": timeout
-                }
-            )
             result = response.json()
 
             logger.debug(f"Execution result: {result}")
@@ -73,9 +161,10 @@ async def _execute_in_pool(code: str, execution_id: str, timeout: int) -> str:
                 logger.error(f"Error from executor: {response.text}")
                 raise Exception(f"Error executing code: {response.text}")
 
-            if result["stderr"]:
-                return f"Output:\n{result['stdout']}\n\nWarnings/Errors:\n{result['stderr']}"
-            return result["stdout"]
+            return _format_result(result)
+
+    except (ExecutorSaturatedError, ExecutorBusyError):
+        raise
 
     except httpx.RequestError as e:
         logger.error(f"Error connecting to executor: {str(e)}")
@@ -85,10 +174,155 @@ async def _execute_in_pool(code: str, execution_id: str, timeout: int) -> str:
         logger.exception(f"Error executing code in pool: {str(e)}")
         raise Exception(f"Error executing code in pool: {str(e)}")
 
+def _trace_headers(request_id: Optional[str]) -> Dict[str, str]:
+    """Headers that tie the executor's logs to the chat completion request."""
+    return {"X-Request-ID": request_id} if request_id else {}
+
+def _format_result(result: Dict) -> str:
+    """Combine the stdout and stderr of an executor result into the execution output."""
+    if result["stderr"]:
+        output = f"Output:\n{result['stdout']}\n\nWarnings/Errors:\n{result['stderr']}"
+    else:
+        output = result["stdout"]
+
+    if result.get("truncated"):
+        sizes = ", ".join(
+            f"{name} {info['bytes']} bytes"
+            for name, info in result.get("output_info", {}).items() if info["truncated"]
+        )
+        output += f"\n\n(The output was truncated by the executor: {sizes}.)"
+    return output
+
+async def stream_execute_code(
+    code: str,
+    timeout: int = 120,
+    session_id: Optional[str] = None,
+    reserved: Optional[Executor] = None,
+    request_id: Optional[str] = None,
+    reserved_wait: float = 0.0,
+) -> AsyncIterator[Dict[str, str]]:
+    """
+    Execute Python code like execute_code, yielding its output while it runs.
+
+    Args:
+        code: The Python code to execute
+        timeout: Maximum execution time in seconds
+        session_id: Conversation id, runs the code in the conversation's live session
+        reserved: Executor slot taken ahead of time, used by the first attempt and released afterwards
+        request_id: Chat completion id, sent to the executor so its logs can be traced back
+        reserved_wait: Seconds it took to reserve the slot, counted in the queue wait
+
+    Yields:
+        {"type": "stdout" | "stderr", "data": text} events as the code prints, then a final
+        {"type": "result", "output": execution output} event.
+
+    Raises:
+        ExecutorSaturatedError: If all executors are busy and the wait queue is full, or every
+            executor answered 429
+    """
+    execution_id = str(uuid.uuid4())
+    max_retries = 2
+    attempt = 0
+    # Executors that failed a previous attempt, retries go to a different one
+    tried_executors = set()
+    if not EXECUTOR_SESSIONS_ENABLED:
+        session_id = None
+
+    while attempt <= max_retries:
+        streamed = False
+        attempt_reserved, reserved = reserved, None
+        try:
+            async for event in _stream_in_pool(
+                code, execution_id, timeout, tried_executors, session_id, attempt_reserved, request_id,
+                reserved_wait if attempt_reserved else 0.0
+            ):
+                streamed = True
+                yield event
+            return
+        except ExecutorSaturatedError:
+            raise
+        except ExecutorBusyError as e:
+            logger.info(str(e))
+            await _raise_if_all_busy(tried_executors, e)
+        except Exception as e:
+            if streamed:
+                # Output was already relayed, a retry would run the code twice
+                logger.error(f"Streamed execution {execution_id} failed: {str(e)}")
+                yield {"type": "result", "output": f"Error executing code: {str(e)}"}
+                return
+            logger.warning(f"Attempt {attempt + 1} failed: {str(e)}")
+            attempt += 1
+            if attempt > max_retries:
+                logger.error("All attempts failed. Falling back to local execution.")
+                local_fallbacks.inc()
+                yield {"type": "result", "output": await _execute_locally(code, execution_id, timeout)}
+                return
+            retries.inc("execution")
+            await asyncio.sleep(1)  # Wait before retrying
+
+async def _stream_in_pool(
+    code: str,
+    execution_id: str,
+    timeout: int,
+    tried_executors: set,
+    session_id: Optional[str] = None,
+    reserved: Optional[Executor] = None,
+    request_id: Optional[str] = None,
+    reserved_wait: float = 0.0,
+) -> AsyncIterator[Dict[str, str]]:
+    """Stream the execution of code from the least loaded healthy executor container."""
+    pool = await get_executor_pool()
+    queued = time.perf_counter()
+    async with pool.acquire(exclude=tried_executors, session_id=session_id, reserved=reserved) as executor:
+        stage_seconds.observe(time.perf_counter() - queued + reserved_wait, "executor_queue_wait")
+        tried_executors.add(executor.executor_id)
+        logger.debug(f"Streaming execution in {executor.name} with ID {execution_id}")
+
+        path = f"/sessions/{quote(session_id, safe='')}/execute/stream" if session_id else "/execute/stream"
+
+        start = time.perf_counter()
+        try:
+            async with executor.client.stream(
+                "POST",
+                path,
+                json={
+                    "code": code,
+                    "execution_id": execution_id,
+                    "timeout": timeout
+                },
+                headers=_trace_headers(request_id),
+                timeout=timeout + 5
+            ) as response:
+                pool.record_success(executor)
+                if response.status_code == 429:
+                    raise _busy_error(executor, response.status_code, await response.aread())
+                if response.status_code != 200:
+                    detail = await response.aread()
+                    raise Exception(f"{executor.name} answered {response.status_code}: {detail.decode(errors='replace')}")
+
+                async for line in response.aiter_lines():
+                    if not line.strip():
+                        continue
+                    event = json.loads(line)
+                    if event["type"] == "result":
+                        stage_seconds.observe(time.perf_counter() - start, "executor_run")
+                        # Log the code execution result to the slitedb for debugging purposes
+                        await log_code_execution(code, event["stdout"], response.status_code, event["stderr"])
+                        yield {"type": "result", "output": _format_result(event)}
+                        return
+                    yield {"type": event["type"], "data": event["data"]}
+        except httpx.RequestError as e:
+            pool.record_failure(executor)
+            logger.error(f"Error connecting to executor: {str(e)}")
+            raise Exception(f"Error connecting to code executor: {str(e)}")
+
+    raise Exception("Executor closed the stream without a result")
+
 async def _execute_locally(code: str, execution_id: str, timeout: int) -> str:
     """
     Execute code locally in a subprocess (less secure but works as fallback).
-    This is a fallback method when the executor pool is not available.
+    This is a fallback method when the executor pool is not available. The code runs in the
+    pre-built virtualenv of local_runtime, sandboxed and resource limited.
     """
     temp_dir = tempfile.mkdtemp(prefix=f"code_exec_{execution_id}_")
 
@@ -100,57 +334,20 @@ async def _execute_locally(code: str, execution_id: str, timeout: int) -> str:
 
         # Execute the code in a subprocess
         logger.info(f"Executing code locally for execution {execution_id}")
-
-        # Create a virtual environment for isolation
-        venv_dir = os.path.join(temp_dir, "venv")
-
-        # Create virtual environment
-        proc = await asyncio.create_subprocess_shell(
-            f"python -m venv {venv_dir}",
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE
-        )
-        await proc.communicate()
-
-        if proc.returncode != 0:
-            return "Failed to create virtual environment for code execution."
-
-        # Install required packages in the virtual environment
-        pip_cmd = f"{venv_dir}/bin/pip" if os.name != 'nt' else f"{venv_dir}\\Scripts\\pip"
-
-        # Install only safe modules
-        safe_modules = [m for m in INSTALLED_MODULES if m.strip() in
-                        ["pandas", "numpy", "matplotlib", "requests", "scikit-learn"]]
-
-        if safe_modules:
-            modules_str = " ".join(safe_modules)
-            proc = await asyncio.create_subprocess_shell(
-                f"{pip_cmd} install {modules_str}",
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
-            )
-            await proc.communicate()
-
-        # Execute the code
-        python_cmd = f"{venv_dir}/bin/python" if os.name != 'nt' else f"{venv_dir}\\Scripts\\python"
-
-        proc = await asyncio.create_subprocess_exec(
-            python_cmd, code_file,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE
-        )
+        proc = await local_runtime.run_sandboxed(code_file, temp_dir, timeout)
 
         try:
             stdout, stderr = await asyncio.wait_for(proc.communicate(), timeout=timeout)
-            output = stdout.decode()
-            error = stderr.decode()
+            output = stdout.decode(errors="replace")
+            error = stderr.decode(errors="replace")
 
             if error:
                 return f"Output:\n{output}\n\nErrors:\n{error}"
             return output
 
         except asyncio.TimeoutError:
-            proc.terminate()
+            local_runtime.kill(proc)
+            await proc.wait()
             return f"Execution timed out after {timeout} seconds."
 
     except Exception as e:
@@ -161,4 +358,4 @@ async def _execute_locally(code: str, execution_id: str, timeout: int) -> str:
         try:
             shutil.rmtree(temp_dir, ignore_errors=True)
         except Exception as e:
-            logger.error(f"Error during cleanup: {str(e)}")
\ No newline at end of file
+            logger.error(f"Error during cleanup: {str(e)}")
@@ -1,24 +1,30 @@
-from services.llm_client import get_text_from_llm
-from typing import List, Dict, Any
+from services.llm_client import get_text_from_llm, TokenUsage
+from services.code_agent.code_cache import code_cache, make_cache_key, CODE_CACHE_ENABLED
+from services.module_resolver import get_catalog, render_modules_info
+from typing import List, Dict, Any, Optional
 from pydantic import BaseModel
 import logging
 
 logger = logging.getLogger(__name__)
 
+CODE_GEN_MODEL = "mistral-small-latest"
+
 class Message(BaseModel):
     role: str
     content: str
 
-async def generate_code(messages: List[Message], relevant_modules: List[Dict[str, Any]], temperature: float = 0.23) -> str:
+async def generate_code(
+    messages: List[Message],
+    relevant_modules: List[Dict[str, Any]],
+    temperature: float = 0.23,
+    use_cache: bool = True,
+    usage: Optional[TokenUsage] = None
+) -> str:
     if not messages:
         return "# Error: No messages provided"
 
-    modules_info = "\n\n".join([
-        f"- {module['name']}: {module['description']}\n" +
-        "\n".join([f"  - {func['name']}: {func['description']}\n    Usage: {func['usage']}" 
-                  for func in module['functions']])
-        for module in relevant_modules
-    ])
+    # Pre-rendered by the module catalog
+    modules_info = render_modules_info(relevant_modules)
 
     system_message = f"""
     You are a Python code generator, your primary goal is to generate code that only uses the provided modules.
@@ -106,19 +112,37 @@ async def generate_code(messages: List[Message], relevant_modules: List[Dict[str
         messages[-5:] # 10 most recent messages
     )
 
+    # Identical recent conversations with the same modules reuse the generated code
+    cache_key = None
+    if use_cache and CODE_CACHE_ENABLED:
+        module_names = ",".join(module["name"] for module in relevant_modules)
+        catalog_version = f"{get_catalog().version}:{module_names}"
+        cache_key = make_cache_key(messages[-5:], catalog_version, CODE_GEN_MODEL, temperature)
+        cached = await code_cache.get(cache_key)
+        if cached is not None:
+            logger.info("Code gen cache hit")
+            return cached
+
     logger.info(f"Code gen messages: {code_messages}")
     print(f"Code gen messages: {code_messages}")
     try:
         response = await get_text_from_llm(
             messages=code_messages,
-            model="mistral-small-latest",
-            temperature=temperature
+            model=CODE_GEN_MODEL,
+            temperature=temperature,
+            usage=usage,
+            stage="code_gen"
         )
-        
+
         if "```python" in response:
-            return response.split("```python")[1].split("```")[0].strip()
-        return response.strip()
-        
+            code = response.split("```python")[1].split("```")[0].strip()
+        else:
+            code = response.strip()
+
+        if cache_key is not None:
+            await code_cache.set(cache_key, code)
+        return code
+
     except Exception as e:
         logger.error(f"Code gen failed: {e}")
         return f"# Error: {str(e)}"
\ No newline at end of file
@@ -1,10 +1,15 @@
-from database.database import Database
+from database.log_writer import log_writer
 
 async def log_code_execution(code, result, response_status_code, stderr):
     """
     Logs the execution of a code snippet along with its result.
+    The row is queued and written in a batch by the log writer.
     """
-    db = Database()
-    log_entry = db.log_execution(code, result, response_status_code, stderr)
-    db.close()
-    return {"message": "Code execution logged successfully", "log_entry": log_entry}
\ No newline at end of file
+    log_entry = await log_writer.log_execution(code, result, response_status_code, stderr)
+    return {"message": "Code execution logged successfully", "log_entry": log_entry}
+
+async def log_route_decision(query, decision):
+    """
+    Logs the fast-path routing decision of a chat turn, used to tune the threshold.
+    """
+    await log_writer.log_route_decision(query, decision.route, decision.score, decision.reason, decision.latency_ms)
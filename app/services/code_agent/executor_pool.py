@@ -0,0 +1,322 @@
+import asyncio
+import logging
+import os
+import random
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import Dict, Any, List, Optional, AsyncIterator, Collection
+import httpx
+
+logger = logging.getLogger(__name__)
+
+# Get the number of executors
+EXECUTOR_POOL_SIZE = int(os.getenv("EXECUTOR_POOL_SIZE", "3"))
+
+# Maximum number of concurrent executions sent to a single executor
+EXECUTOR_MAX_CONCURRENCY = int(os.getenv("EXECUTOR_MAX_CONCURRENCY", "2"))
+
+# Maximum number of executions waiting for a free executor slot before pushing back
+EXECUTOR_QUEUE_SIZE = int(os.getenv("EXECUTOR_QUEUE_SIZE", "20"))
+
+# Maximum time in seconds an execution waits for a free executor slot
+EXECUTOR_QUEUE_TIMEOUT = float(os.getenv("EXECUTOR_QUEUE_TIMEOUT", "30"))
+
+EXECUTOR_PORT = int(os.getenv("EXECUTOR_PORT", "5000"))
+EXECUTOR_CONNECT_TIMEOUT = float(os.getenv("EXECUTOR_CONNECT_TIMEOUT", "5"))
+
+# Interval and timeout in seconds for the background /health probes
+EXECUTOR_HEALTH_INTERVAL = float(os.getenv("EXECUTOR_HEALTH_INTERVAL", "10"))
+EXECUTOR_HEALTH_TIMEOUT = float(os.getenv("EXECUTOR_HEALTH_TIMEOUT", "3"))
+
+# Consecutive failures before an executor is taken out of rotation
+EXECUTOR_UNHEALTHY_THRESHOLD = int(os.getenv("EXECUTOR_UNHEALTHY_THRESHOLD", "2"))
+
+# Maximum number of conversation sessions pinned to an executor, least recently used are forgotten
+EXECUTOR_MAX_SESSIONS = int(os.getenv("EXECUTOR_MAX_SESSIONS", "1000"))
+
+class ExecutorSaturatedError(Exception):
+    """Raised when all executors are busy and the wait queue is full or timed out."""
+
+    def __init__(self, message: str, queue_depth: int):
+        super().__init__(message)
+        self.queue_depth = queue_depth
+
+class NoHealthyExecutorError(Exception):
+    """Raised when every executor in the pool is failing its health checks."""
+
+class Executor:
+    """
+    A single executor container with its own persistent keep-alive client.
+
+    Attributes:
+        executor_id (int): The executor number, used in the container hostname.
+        max_concurrency (int): Maximum number of concurrent executions.
+        in_flight (int): Number of executions currently running on this executor.
+        healthy (bool): Whether the executor is in rotation.
+        consecutive_failures (int): Failed health probes or requests since the last success.
+        client (httpx.AsyncClient): Keep-alive client bound to the executor's base URL.
+    """
+
+    def __init__(self, executor_id: int, max_concurrency: int):
+        self.executor_id = executor_id
+        self.name = f"executor-{executor_id}"
+        self.base_url = f"http://{self.name}:{EXECUTOR_PORT}"
+        self.max_concurrency = max_concurrency
+        self.in_flight = 0
+        self.healthy = True
+        self.consecutive_failures = 0
+        self.client = httpx.AsyncClient(
+            base_url=self.base_url,
+            limits=httpx.Limits(
+                max_connections=max_concurrency + 1,
+                max_keepalive_connections=max_concurrency + 1,
+            ),
+            timeout=httpx.Timeout(None, connect=EXECUTOR_CONNECT_TIMEOUT),
+        )
+
+    @property
+    def has_capacity(self) -> bool:
+        return self.in_flight < self.max_concurrency
+
+    async def close(self) -> None:
+        await self.client.aclose()
+
+class ExecutorPool:
+    """
+    Pool of executor containers with per-executor concurrency limits and a bounded wait queue.
+    """
+
+    def __init__(
+        self,
+        size: int = EXECUTOR_POOL_SIZE,
+        max_concurrency: int = EXECUTOR_MAX_CONCURRENCY,
+        queue_size: int = EXECUTOR_QUEUE_SIZE,
+        queue_timeout: float = EXECUTOR_QUEUE_TIMEOUT,
+    ):
+        self.executors: List[Executor] = [
+            Executor(executor_id, max_concurrency) for executor_id in range(1, size + 1)
+        ]
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.waiting = 0
+        self._condition = asyncio.Condition()
+        self._health_task: Optional[asyncio.Task] = None
+        # Sticky affinity of conversation sessions to the executor that holds their state
+        self._affinity: "OrderedDict[str, int]" = OrderedDict()
+
+    def _pinned_executor(self, session_id: Optional[str], exclude: Collection[int]) -> Optional[Executor]:
+        """The healthy executor holding the session, if it wasn't excluded by a failed attempt."""
+        executor_id = self._affinity.get(session_id) if session_id else None
+        if executor_id is None or executor_id in exclude:
+            return None
+        executor = self.executors[executor_id - 1]
+        return executor if executor.healthy else None
+
+    def _candidates(self, exclude: Collection[int], session_id: Optional[str] = None) -> List[Executor]:
+        """
+        Healthy executors, preferring the ones not tried before by this execution.
+        A session only goes to the executor holding its state while that one is usable.
+        """
+        pinned = self._pinned_executor(session_id, exclude)
+        if pinned is not None:
+            return [pinned]
+        healthy = [executor for executor in self.executors if executor.healthy]
+        preferred = [executor for executor in healthy if executor.executor_id not in exclude]
+        return preferred or healthy
+
+    def _select_executor(self, exclude: Collection[int] = (), session_id: Optional[str] = None) -> Optional[Executor]:
+        """
+        Pick the healthy executor with the least outstanding work, or None when all are busy.
+        Ties are broken randomly so idle executors share the load.
+        """
+        candidates = self._candidates(exclude, session_id)
+        available = [executor for executor in candidates if executor.has_capacity]
+        if not available:
+            return None
+        least = min(executor.in_flight for executor in available)
+        return random.choice([executor for executor in available if executor.in_flight == least])
+
+    async def reserve(
+        self, exclude: Collection[int] = (), session_id: Optional[str] = None, wait: bool = True
+    ) -> Optional[Executor]:
+        """
+        Take a slot on an executor, the caller must hand it back with release() or acquire().
+
+        Args:
+            exclude: Executor ids to avoid, e.g. the ones that failed a previous attempt.
+            session_id: Conversation session, sticks to the executor that holds its state.
+            wait: Wait in the queue when all executors are busy, otherwise return None right away.
+
+        Raises:
+            NoHealthyExecutorError: If no executor is passing its health checks.
+            ExecutorSaturatedError: If the wait queue is full or no slot frees up in time.
+        """
+        async with self._condition:
+            if not any(executor.healthy for executor in self.executors):
+                raise NoHealthyExecutorError("No healthy executors available")
+            executor = self._select_executor(exclude, session_id)
+            if executor is None:
+                if not wait:
+                    return None
+                if self.waiting >= self.queue_size:
+                    raise ExecutorSaturatedError(
+                        f"All executors are busy and the queue is full ({self.waiting} waiting)",
+                        self.waiting,
+                    )
+                self.waiting += 1
+                try:
+                    await asyncio.wait_for(
+                        self._condition.wait_for(lambda: self._select_executor(exclude, session_id) is not None),
+                        timeout=self.queue_timeout,
+                    )
+                except asyncio.TimeoutError:
+                    raise ExecutorSaturatedError(
+                        f"Timed out after {self.queue_timeout}s waiting for a free executor",
+                        self.waiting,
+                    )
+                finally:
+                    self.waiting -= 1
+                executor = self._select_executor(exclude, session_id)
+            executor.in_flight += 1
+            if session_id:
+                self._pin(session_id, executor)
+            return executor
+
+    async def release(self, executor: Executor) -> None:
+        """Hand back a slot taken with reserve() and wake up the waiters."""
+        async with self._condition:
+            executor.in_flight -= 1
+            self._condition.notify_all()
+
+    @asynccontextmanager
+    async def acquire(
+        self,
+        exclude: Collection[int] = (),
+        session_id: Optional[str] = None,
+        reserved: Optional[Executor] = None,
+    ) -> AsyncIterator[Executor]:
+        """
+        Reserve a slot on an executor for the duration of the context.
+
+        Args:
+            exclude: Executor ids to avoid, e.g. the ones that failed a previous attempt.
+            session_id: Conversation session, sticks to the executor that holds its state.
+            reserved: A slot taken ahead of time with reserve(), used instead of taking a new one.
+
+        Raises:
+            NoHealthyExecutorError: If no executor is passing its health checks.
+            ExecutorSaturatedError: If the wait queue is full or no slot frees up in time.
+        """
+        executor = reserved or await self.reserve(exclude, session_id)
+        try:
+            yield executor
+        finally:
+            await self.release(executor)
+
+    def _pin(self, session_id: str, executor: Executor) -> None:
+        """Remember which executor holds the session's state."""
+        self._affinity[session_id] = executor.executor_id
+        self._affinity.move_to_end(session_id)
+        while len(self._affinity) > EXECUTOR_MAX_SESSIONS:
+            self._affinity.popitem(last=False)
+
+    def forget_session(self, session_id: str) -> Optional[int]:
+        """Drop the affinity of a session, returns the executor id it was pinned to."""
+        return self._affinity.pop(session_id, None)
+
+    def record_success(self, executor: Executor) -> None:
+        """Reset the failure count of an executor after a successful request or probe."""
+        executor.consecutive_failures = 0
+        if not executor.healthy:
+            logger.info(f"{executor.name} recovered, putting it back in rotation")
+            executor.healthy = True
+
+    def record_failure(self, executor: Executor) -> None:
+        """Count a failed request or probe and take the executor out of rotation past the threshold."""
+        executor.consecutive_failures += 1
+        if executor.healthy and executor.consecutive_failures >= EXECUTOR_UNHEALTHY_THRESHOLD:
+            logger.warning(
+                f"{executor.name} failed {executor.consecutive_failures} times, taking it out of rotation"
+            )
+            executor.healthy = False
+
+    async def _probe(self, executor: Executor) -> None:
+        """Probe the /health endpoint of a single executor."""
+        try:
+            response = await executor.client.get("/health", timeout=EXECUTOR_HEALTH_TIMEOUT)
+            if response.status_code == 200:
+                self.record_success(executor)
+            else:
+                self.record_failure(executor)
+        except Exception as e:
+            logger.debug(f"Health check of {executor.name} failed: {str(e)}")
+            self.record_failure(executor)
+
+    async def _health_loop(self) -> None:
+        """Periodically probe all executors and wake up waiters when one recovers."""
+        while True:
+            await asyncio.gather(*(self._probe(executor) for executor in self.executors))
+            async with self._condition:
+                self._condition.notify_all()
+            await asyncio.sleep(EXECUTOR_HEALTH_INTERVAL)
+
+    def start(self) -> None:
+        """Start the background health checks."""
+        if self._health_task is None:
+            self._health_task = asyncio.create_task(self._health_loop())
+
+    def stats(self) -> Dict[str, Any]:
+        """Return the current load of every executor and the wait queue depth."""
+        return {
+            "queue_depth": self.waiting,
+            "queue_size": self.queue_size,
+            "sessions": len(self._affinity),
+            "executors": [
+                {
+                    "name": executor.name,
+                    "in_flight": executor.in_flight,
+                    "max_concurrency": executor.max_concurrency,
+                    "healthy": executor.healthy,
+                    "consecutive_failures": executor.consecutive_failures,
+                }
+                for executor in self.executors
+            ],
+        }
+
+    async def close(self) -> None:
+        if self._health_task is not None:
+            self._health_task.cancel()
+            try:
+                await self._health_task
+            except asyncio.CancelledError:
+                pass
+            self._health_task = None
+        await asyncio.gather(*(executor.close() for executor in self.executors))
+
+_pool: Optional[ExecutorPool] = None
+
+async def init_executor_pool() -> ExecutorPool:
+    """Create the shared executor pool and start its health checks."""
+    global _pool
+    if _pool is None:
+        _pool = ExecutorPool()
+        _pool.start()
+        logger.info(
+            f"Executor pool initialized (size={EXECUTOR_POOL_SIZE}, "
+            f"max_concurrency={EXECUTOR_MAX_CONCURRENCY}, queue_size={EXECUTOR_QUEUE_SIZE})"
+        )
+    return _pool
+
+async def close_executor_pool() -> None:
+    """Close the persistent connections of all executors."""
+    global _pool
+    if _pool is not None:
+        await _pool.close()
+        _pool = None
+        logger.info("Executor pool closed")
+
+async def get_executor_pool() -> ExecutorPool:
+    """Return the shared executor pool, creating it lazily when used outside the app lifespan."""
+    if _pool is None:
+        return await init_executor_pool()
+    return _pool
@@ -0,0 +1,217 @@
+import os
+import sys
+import json
+import shutil
+import signal
+import asyncio
+import hashlib
+import logging
+import tempfile
+from typing import List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Get the list of installed modules from environment variable or use defaults
+INSTALLED_MODULES = [
+    module.strip() for module in os.getenv("INSTALLED_MODULES", "pandas,numpy,matplotlib,requests").split(",")
+    if module.strip()
+]
+
+# Modules the local fallback is allowed to install, it runs without the executor container's isolation
+SAFE_MODULES = ("pandas", "numpy", "matplotlib", "requests", "scikit-learn")
+
+# Directory holding the pre-built virtualenvs, one per module set and Python version
+LOCAL_VENV_DIR = os.getenv("LOCAL_VENV_DIR", "/app/venvs")
+
+# Optional directory of wheels, builds install from it without touching the network
+LOCAL_WHEELHOUSE = os.getenv("LOCAL_WHEELHOUSE", "")
+
+# Resource limits of locally executed code
+LOCAL_EXEC_MEMORY_MB = int(os.getenv("LOCAL_EXEC_MEMORY_MB", "2048"))
+LOCAL_EXEC_MAX_FILE_MB = int(os.getenv("LOCAL_EXEC_MAX_FILE_MB", "100"))
+LOCAL_EXEC_MAX_OPEN_FILES = int(os.getenv("LOCAL_EXEC_MAX_OPEN_FILES", "256"))
+
+_build_lock: Optional[asyncio.Lock] = None
+_build_task: Optional[asyncio.Task] = None
+
+def venv_modules() -> List[str]:
+    """The sorted, de-duplicated modules installed in the local virtualenv."""
+    return sorted({module for module in INSTALLED_MODULES if module in SAFE_MODULES})
+
+def venv_key(modules: Optional[List[str]] = None) -> str:
+    """Content address of a virtualenv: its modules and the interpreter it is built from."""
+    spec = {
+        "modules": venv_modules() if modules is None else sorted(modules),
+        "python": f"{sys.version_info.major}.{sys.version_info.minor}",
+        "platform": sys.platform,
+    }
+    return hashlib.sha256(json.dumps(spec, sort_keys=True).encode()).hexdigest()[:16]
+
+def venv_path(key: Optional[str] = None) -> str:
+    return os.path.join(LOCAL_VENV_DIR, key or venv_key())
+
+def _python(venv_dir: str) -> str:
+    return os.path.join(venv_dir, "Scripts", "python.exe") if os.name == "nt" else os.path.join(venv_dir, "bin", "python")
+
+def venv_python() -> Optional[str]:
+    """The interpreter of the virtualenv for the current module set, None until it is built."""
+    venv_dir = venv_path()
+    if os.path.exists(os.path.join(venv_dir, "ready.json")):
+        return _python(venv_dir)
+    return None
+
+async def _run(*args: str) -> None:
+    proc = await asyncio.create_subprocess_exec(
+        *args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT
+    )
+    stdout, _ = await proc.communicate()
+    if proc.returncode != 0:
+        raise RuntimeError(f"{' '.join(args[:3])} failed: {stdout.decode(errors='replace')[-2000:]}")
+
+async def build_venv() -> str:
+    """
+    Build the virtualenv for the current module set, unless it already exists.
+
+    The virtualenv is built in a temporary directory next to its final path and renamed
+    into place once the modules are installed, so a half built one is never used.
+
+    Returns:
+        str: The interpreter of the virtualenv.
+    """
+    global _build_lock
+    if _build_lock is None:
+        _build_lock = asyncio.Lock()
+
+    async with _build_lock:
+        python = venv_python()
+        if python:
+            return python
+
+        modules = venv_modules()
+        venv_dir = venv_path()
+        os.makedirs(LOCAL_VENV_DIR, exist_ok=True)
+        build_dir = tempfile.mkdtemp(prefix=f".{os.path.basename(venv_dir)}-", dir=LOCAL_VENV_DIR)
+        logger.info(f"Building local virtualenv {os.path.basename(venv_dir)} with {modules}")
+        try:
+            await _run(sys.executable, "-m", "venv", build_dir)
+            if modules:
+                pip_args = [_python(build_dir), "-m", "pip", "install", "--no-cache-dir", "--disable-pip-version-check"]
+                if LOCAL_WHEELHOUSE:
+                    pip_args += ["--no-index", "--find-links", LOCAL_WHEELHOUSE]
+                await _run(*pip_args, *modules)
+            with open(os.path.join(build_dir, "ready.json"), "w") as f:
+                json.dump({"key": os.path.basename(venv_dir), "modules": modules}, f)
+            # Only bin/python is used, it finds the venv from its own location so the move is safe
+            shutil.rmtree(venv_dir, ignore_errors=True)
+            os.rename(build_dir, venv_dir)
+        except BaseException:
+            shutil.rmtree(build_dir, ignore_errors=True)
+            raise
+        logger.info(f"Local virtualenv ready at {venv_dir}")
+        return _python(venv_dir)
+
+def prepare_in_background() -> Optional[asyncio.Task]:
+    """Start building the virtualenv in the background when it doesn't exist yet."""
+    global _build_task
+    if venv_python() or (_build_task is not None and not _build_task.done()):
+        return _build_task
+
+    async def _build():
+        try:
+            await build_venv()
+        except Exception as e:
+            logger.error(f"Failed to build the local virtualenv: {str(e)}")
+
+    _build_task = asyncio.create_task(_build())
+    return _build_task
+
+# Run by the child interpreter: set the resource limits, then run the script as __main__.
+# preexec_fn would set them between fork and exec, which can deadlock while the API runs threads.
+_BOOTSTRAP = """
+import json, resource, runpy, sys, traceback
+for name, value in json.loads(sys.argv[1]).items():
+    limit = getattr(resource, name)
+    _, hard = resource.getrlimit(limit)
+    if hard != resource.RLIM_INFINITY:
+        value = min(value, hard)
+    resource.setrlimit(limit, (value, hard))
+path = sys.argv[2]
+del sys.argv[:2]
+try:
+    runpy.run_path(path, run_name="__main__")
+except SystemExit:
+    raise
+except BaseException as e:
+    # Leave the bootstrap and runpy frames out of the traceback, it only shows the script
+    tb = e.__traceback__
+    while tb is not None and tb.tb_frame.f_code.co_filename != path:
+        tb = tb.tb_next
+    traceback.print_exception(type(e), e, tb or e.__traceback__)
+    sys.exit(1)
+"""
+
+def _resource_limits(timeout: int) -> dict:
+    """Resource limits of the child process, by resource module constant name."""
+    return {
+        "RLIMIT_CPU": timeout + 1,
+        "RLIMIT_AS": LOCAL_EXEC_MEMORY_MB * 1024 * 1024,
+        "RLIMIT_FSIZE": LOCAL_EXEC_MAX_FILE_MB * 1024 * 1024,
+        "RLIMIT_NOFILE": LOCAL_EXEC_MAX_OPEN_FILES,
+        "RLIMIT_CORE": 0,
+    }
+
+async def run_sandboxed(code_file: str, work_dir: str, timeout: int) -> asyncio.subprocess.Process:
+    """
+    Start the code in the pre-built virtualenv, in its own process group with a clean
+    environment and resource limits, set by a bootstrap in the child before it runs the
+    code. Falls back to the API's interpreter while the virtualenv is being built, the
+    fallback must not wait for pip.
+
+    Args:
+        code_file: The script to run.
+        work_dir: Working and home directory of the process.
+        timeout: Execution timeout, also the CPU time limit.
+
+    Returns:
+        The started process, with stdout and stderr piped.
+    """
+    python = venv_python()
+    if python is None:
+        logger.warning("Local virtualenv is not built yet, running with the API interpreter")
+        prepare_in_background()
+        python = sys.executable
+
+    env = {
+        "PATH": os.path.dirname(python) + os.pathsep + os.defpath,
+        "HOME": work_dir,
+        "TMPDIR": work_dir,
+        "MPLBACKEND": "Agg",
+    }
+    args, kwargs = [code_file], {}
+    if os.name != "nt":
+        args = ["-c", _BOOTSTRAP, json.dumps(_resource_limits(timeout)), code_file]
+        kwargs = {"start_new_session": True}
+    # -I: isolated mode, ignores PYTHON* variables and the user site-packages, -B: no .pyc files
+    return await asyncio.create_subprocess_exec(
+        python, "-I", "-B", *args,
+        cwd=work_dir,
+        env=env,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+        **kwargs
+    )
+
+def kill(proc: asyncio.subprocess.Process) -> None:
+    """Kill the process and everything it started."""
+    try:
+        if os.name != "nt":
+            os.killpg(proc.pid, signal.SIGKILL)
+        else:
+            proc.kill()
+    except ProcessLookupError:
+        pass
+
+if __name__ == "__main__":
+    # Build the virtualenv ahead of time, e.g. while building the API image
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    print(asyncio.run(build_venv()))
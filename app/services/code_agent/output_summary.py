@@ -0,0 +1,77 @@
+import os
+from typing import List
+
+# Token budget of the execution output pasted into the final answer prompt
+PROMPT_OUTPUT_MAX_TOKENS = int(os.getenv("PROMPT_OUTPUT_MAX_TOKENS", "2000"))
+
+# Rough number of characters per token, good enough to budget prompt sizes
+CHARS_PER_TOKEN = 4
+
+# Share of the budget spent on the start of the output, the rest goes to the end
+HEAD_SHARE = 0.6
+
+def estimate_tokens(text: str) -> int:
+    """Estimate the number of tokens in a text."""
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+def _collapse_repeats(lines: List[str]) -> List[str]:
+    """Collapse runs of identical lines, e.g. progress output, into a single line."""
+    collapsed = []
+    index = 0
+    while index < len(lines):
+        run_end = index
+        while run_end + 1 < len(lines) and lines[run_end + 1] == lines[index]:
+            run_end += 1
+        count = run_end - index + 1
+        collapsed.append(lines[index] if count < 3 else f"{lines[index]}  [repeated {count} times]")
+        index = run_end + 1
+    return collapsed
+
+def summarize_output(output: str, max_tokens: int = PROMPT_OUTPUT_MAX_TOKENS) -> str:
+    """
+    Fit execution output in a token budget for the LLM prompt.
+
+    Repeated lines are collapsed first. When the output is still too large the start and
+    the end are kept and the middle is replaced with a note of how much was left out.
+
+    Args:
+        output: The execution output.
+        max_tokens: The token budget.
+
+    Returns:
+        The output, summarized when it doesn't fit the budget.
+    """
+    if estimate_tokens(output) <= max_tokens:
+        return output
+
+    lines = _collapse_repeats(output.splitlines())
+    text = "\n".join(lines)
+    if estimate_tokens(text) <= max_tokens:
+        return text
+
+    budget = max_tokens * CHARS_PER_TOKEN
+    head_budget = int(budget * HEAD_SHARE)
+    tail_budget = budget - head_budget
+
+    head, used = [], 0
+    for line in lines:
+        if used + len(line) + 1 > head_budget:
+            break
+        head.append(line)
+        used += len(line) + 1
+
+    tail, used = [], 0
+    for line in reversed(lines[len(head):]):
+        if used + len(line) + 1 > tail_budget:
+            break
+        tail.append(line)
+        used += len(line) + 1
+    tail.reverse()
+
+    # A single huge line doesn't fit either side, keep its start
+    if not head and not tail:
+        return text[:budget] + f"\n[... ~{estimate_tokens(text[budget:])} tokens omitted ...]"
+
+    omitted = lines[len(head):len(lines) - len(tail)]
+    omitted_tokens = estimate_tokens("\n".join(omitted))
+    return "\n".join(head + [f"[... {len(omitted)} lines, ~{omitted_tokens} tokens omitted ...]"] + tail)
@@ -0,0 +1,169 @@
+import ast
+import asyncio
+import io
+import logging
+import os
+import time
+from typing import Optional
+import httpx
+from services.code_agent.code_executor import EXECUTOR_SESSIONS_ENABLED
+from services.code_agent.executor_pool import get_executor_pool, Executor
+from services.llm_client import warm_up_connection
+
+logger = logging.getLogger(__name__)
+
+# Warm up the final answer's LLM connection and an executor slot while the code is generated
+PIPELINE_PREWARM = os.getenv("PIPELINE_PREWARM", "true").lower() in ("1", "true", "yes")
+
+# Seconds a speculatively reserved executor slot is held for the code generation at most
+PIPELINE_PREWARM_HOLD = float(os.getenv("PIPELINE_PREWARM_HOLD", "3"))
+
+# Skip the executor for code without statements or code that only prints constants
+PIPELINE_SHORT_CIRCUIT = os.getenv("PIPELINE_SHORT_CIRCUIT", "true").lower() in ("1", "true", "yes")
+
+NO_CODE_OUTPUT = "The generated code had nothing to execute."
+
+def _is_docstring(node: ast.stmt) -> bool:
+    return isinstance(node, ast.Expr) and isinstance(node.value, ast.Constant) and isinstance(node.value.value, str)
+
+def _constant_print(node: ast.stmt) -> Optional[ast.Call]:
+    """The print call of a statement that prints literal values only, None for anything else."""
+    if not (isinstance(node, ast.Expr) and isinstance(node.value, ast.Call)):
+        return None
+    call = node.value
+    if not (isinstance(call.func, ast.Name) and call.func.id == "print"):
+        return None
+    if any(isinstance(arg, ast.Starred) for arg in call.args):
+        return None
+    if any(keyword.arg not in ("sep", "end") for keyword in call.keywords):
+        return None
+    try:
+        for value in call.args + [keyword.value for keyword in call.keywords]:
+            ast.literal_eval(value)
+    except (ValueError, TypeError, SyntaxError, MemoryError, RecursionError):
+        # Not a literal, or one that can't be built like {[1]: 2}, the executor reports the error
+        return None
+    return call
+
+def static_output(code: str) -> Optional[str]:
+    """
+    Work out the output of generated code without running it, when that is possible.
+
+    Args:
+        code: The generated Python code.
+
+    Returns:
+        Optional[str]: The output for code without statements or code that only prints
+        constants, None when the code has to be executed.
+    """
+    try:
+        tree = ast.parse(code)
+    except SyntaxError:
+        # The executor normalizes the indentation, let it deal with the code
+        return None
+
+    statements = [node for node in tree.body if not _is_docstring(node) and not isinstance(node, ast.Pass)]
+    if not statements:
+        comments = [line.strip().lstrip("#").strip() for line in code.splitlines() if line.strip().startswith("#")]
+        return "\n".join([NO_CODE_OUTPUT] + [comment for comment in comments if comment])
+
+    calls = [_constant_print(node) for node in statements]
+    if any(call is None for call in calls):
+        return None
+
+    output = io.StringIO()
+    for call in calls:
+        kwargs = {keyword.arg: ast.literal_eval(keyword.value) for keyword in call.keywords}
+        print(*(ast.literal_eval(arg) for arg in call.args), file=output, **kwargs)
+    return output.getvalue()
+
+class ExecutionPrewarm:
+    """
+    Speculative warm-up that runs while the code is being generated.
+
+    It opens the connection for the final answer when the LLM pool has none idle, takes a
+    free executor slot without queueing for one and starts the conversation's session
+    interpreter on that executor. The slot is handed to the execution with take(), or
+    released with release() when the code doesn't need to run. A slot that isn't taken
+    within PIPELINE_PREWARM_HOLD seconds is released, so slow code generation doesn't keep
+    it from real executions; the execution then queues for a slot like any other.
+    """
+
+    def __init__(self, session_id: Optional[str]):
+        self.session_id = session_id if EXECUTOR_SESSIONS_ENABLED else None
+        self._executor: Optional[Executor] = None
+        self._connection_task: Optional[asyncio.Task] = None
+        self._reserve_task: Optional[asyncio.Task] = None
+        self._expiry_task: Optional[asyncio.Task] = None
+        # Seconds the reservation took, part of the execution's queue wait
+        self.reserve_wait = 0.0
+
+    @classmethod
+    def start(cls, session_id: Optional[str]) -> "ExecutionPrewarm":
+        """Start warming up in the background, does nothing when PIPELINE_PREWARM is off."""
+        prewarm = cls(session_id)
+        if PIPELINE_PREWARM:
+            prewarm._connection_task = asyncio.create_task(warm_up_connection())
+            prewarm._reserve_task = asyncio.create_task(prewarm._reserve())
+        return prewarm
+
+    async def _reserve(self) -> None:
+        pool = await get_executor_pool()
+        if pool.waiting:
+            # Executions are queueing, the pool has no capacity to spare
+            return
+        # Never wait for a slot here, a busy pool shouldn't be held up by speculative work
+        start = time.perf_counter()
+        self._executor = await pool.reserve(session_id=self.session_id, wait=False)
+        self.reserve_wait = time.perf_counter() - start
+        if self._executor is None:
+            return
+        self._expiry_task = asyncio.create_task(self._expire())
+        if not self.session_id:
+            return
+        try:
+            await self._executor.client.post("/sessions", json={"session_id": self.session_id})
+        except httpx.HTTPError as e:
+            logger.debug(f"Session warm-up on {self._executor.name} failed: {str(e)}")
+
+    async def _expire(self) -> None:
+        """Release the reserved slot when it is held longer than PIPELINE_PREWARM_HOLD."""
+        await asyncio.sleep(PIPELINE_PREWARM_HOLD)
+        pool = await get_executor_pool()
+        if self._executor is None:
+            return
+        executor, self._executor = self._executor, None
+        logger.debug(f"Releasing the slot reserved on {executor.name}, code generation took over {PIPELINE_PREWARM_HOLD}s")
+        # take() and release() cancel this task, the slot must be handed back regardless
+        await asyncio.shield(pool.release(executor))
+
+    def _stop_expiry(self) -> None:
+        if self._expiry_task is not None:
+            self._expiry_task.cancel()
+            self._expiry_task = None
+
+    @staticmethod
+    async def _settle(task: Optional[asyncio.Task]) -> None:
+        if task is None:
+            return
+        try:
+            await task
+        except Exception as e:
+            logger.debug(f"Pipeline warm-up failed: {str(e)}")
+
+    async def take(self) -> Optional[Executor]:
+        """Hand over the reserved executor slot, the execution releases it when it is done."""
+        await self._settle(self._reserve_task)
+        self._stop_expiry()
+        executor, self._executor = self._executor, None
+        return executor
+
+    async def release(self) -> None:
+        """Give back the reserved slot if it wasn't taken."""
+        await self._settle(self._reserve_task)
+        await self._settle(self._connection_task)
+        self._stop_expiry()
+        if self._executor is not None:
+            executor, self._executor = self._executor, None
+            pool = await get_executor_pool()
+            await pool.release(executor)
@@ -1,19 +1,226 @@
 from typing import List, Dict, Any, Optional, AsyncIterable
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
 from pydantic import BaseModel
+from services.code_agent.output_summary import estimate_tokens
 import httpx
 import logging
 import json
 import os
+import time
 
 logger = logging.getLogger(__name__)
 
 LLM_API_KEY = os.getenv("MISTRAL_API_KEY", "")
 LLM_API_URL = "https://api.mistral.ai/v1"
 
+# Connection pool settings for the shared LLM client
+LLM_HTTP2 = os.getenv("LLM_HTTP2", "false").lower() in ("1", "true", "yes")
+LLM_MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", "50"))
+LLM_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("LLM_MAX_KEEPALIVE_CONNECTIONS", "20"))
+LLM_KEEPALIVE_EXPIRY = float(os.getenv("LLM_KEEPALIVE_EXPIRY", "30"))
+LLM_CONNECT_TIMEOUT = float(os.getenv("LLM_CONNECT_TIMEOUT", "10"))
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "120"))
+
+# Ask for usage in the last chunk of streams, needed by OpenAI compatible APIs, Mistral sends it anyway
+LLM_STREAM_INCLUDE_USAGE = os.getenv("LLM_STREAM_INCLUDE_USAGE", "false").lower() in ("1", "true", "yes")
+
+# Tokens added per message by the chat template, used when estimating usage locally
+TOKENS_PER_MESSAGE = 4
+
+# App-lifetime client, created by init_http_client() in the FastAPI lifespan
+_client: Optional[httpx.AsyncClient] = None
+
+# Pool usage counters, see get_pool_stats()
+_pool_stats = {
+    "requests_total": 0,
+    "errors_total": 0,
+    "in_flight": 0,
+    "peak_in_flight": 0,
+    "warmups_total": 0,
+    "prompt_tokens_total": 0,
+    "completion_tokens_total": 0,
+    "estimated_usage_total": 0,
+}
+
+# Monotonic time the last request finished, pooled connections expire LLM_KEEPALIVE_EXPIRY after it
+_last_request_end = 0.0
+
 class Message(BaseModel):
     role: str
     content: str
 
+@dataclass
+class TokenUsage:
+    """
+    Token usage of one chat completion, summed over the LLM calls of its stages.
+
+    Attributes:
+        prompt_tokens: Prompt tokens of all calls.
+        completion_tokens: Completion tokens of all calls.
+        stages: Usage per stage, e.g. code_gen and final, with a flag for local estimates.
+    """
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    stages: Dict[str, Dict[str, Any]] = field(default_factory=dict)
+
+    def add(self, stage: str, prompt_tokens: int, completion_tokens: int, estimated: bool = False) -> None:
+        self.prompt_tokens += prompt_tokens
+        self.completion_tokens += completion_tokens
+        totals = self.stages.setdefault(stage, {"prompt_tokens": 0, "completion_tokens": 0, "estimated": False})
+        totals["prompt_tokens"] += prompt_tokens
+        totals["completion_tokens"] += completion_tokens
+        totals["estimated"] = totals["estimated"] or estimated
+
+    def as_openai(self) -> Dict[str, int]:
+        """The usage in the OpenAI response format."""
+        return {
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "total_tokens": self.prompt_tokens + self.completion_tokens,
+        }
+
+def _estimate_prompt_tokens(messages: List[Message]) -> int:
+    return sum(estimate_tokens(msg.content) + TOKENS_PER_MESSAGE for msg in messages)
+
+def _record_usage(
+    usage: Optional[TokenUsage],
+    stage: str,
+    upstream: Optional[Dict[str, Any]],
+    messages: List[Message],
+    completion: str,
+) -> None:
+    """
+    Add the usage of one call to the request usage and the pool counters, estimating it
+    locally when the API didn't report any.
+    """
+    if upstream and "prompt_tokens" in upstream:
+        prompt_tokens = int(upstream.get("prompt_tokens") or 0)
+        completion_tokens = int(upstream.get("completion_tokens") or 0)
+        estimated = False
+    else:
+        prompt_tokens = _estimate_prompt_tokens(messages)
+        completion_tokens = estimate_tokens(completion)
+        estimated = True
+        _pool_stats["estimated_usage_total"] += 1
+
+    _pool_stats["prompt_tokens_total"] += prompt_tokens
+    _pool_stats["completion_tokens_total"] += completion_tokens
+    if usage is not None:
+        usage.add(stage, prompt_tokens, completion_tokens, estimated)
+
+def _http2_available() -> bool:
+    """Check if the optional h2 package needed for HTTP/2 is installed."""
+    try:
+        import h2  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+async def init_http_client() -> httpx.AsyncClient:
+    """
+    Create the shared LLM HTTP client with keep-alive connection pooling.
+
+    Returns:
+        httpx.AsyncClient: The shared client.
+    """
+    global _client
+    if _client is not None and not _client.is_closed:
+        return _client
+
+    http2 = LLM_HTTP2
+    if http2 and not _http2_available():
+        logger.warning("LLM_HTTP2 is enabled but the h2 package is not installed, falling back to HTTP/1.1")
+        http2 = False
+
+    _client = httpx.AsyncClient(
+        http2=http2,
+        limits=httpx.Limits(
+            max_connections=LLM_MAX_CONNECTIONS,
+            max_keepalive_connections=LLM_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=LLM_KEEPALIVE_EXPIRY,
+        ),
+        timeout=httpx.Timeout(LLM_TIMEOUT, connect=LLM_CONNECT_TIMEOUT),
+    )
+    logger.info(
+        f"LLM HTTP client initialized (http2={http2}, max_connections={LLM_MAX_CONNECTIONS}, "
+        f"max_keepalive={LLM_MAX_KEEPALIVE_CONNECTIONS})"
+    )
+    return _client
+
+async def close_http_client() -> None:
+    """Close the shared LLM HTTP client and release its pooled connections."""
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+        logger.info("LLM HTTP client closed")
+
+async def get_http_client() -> httpx.AsyncClient:
+    """
+    Return the shared LLM HTTP client, creating it lazily when used outside the app lifespan.
+    """
+    if _client is None or _client.is_closed:
+        return await init_http_client()
+    return _client
+
+def get_pool_stats() -> Dict[str, Any]:
+    """
+    Return usage counters for the shared LLM connection pool.
+
+    Returns:
+        Dict[str, Any]: Request counters and the current number of pooled connections.
+    """
+    stats = dict(_pool_stats)
+    stats["client_open"] = _client is not None and not _client.is_closed
+    stats["pooled_connections"] = 0
+    stats["idle_connections"] = 0
+    if stats["client_open"]:
+        # httpcore exposes the live connections on the transport pool
+        pool = getattr(getattr(_client, "_transport", None), "_pool", None)
+        connections = getattr(pool, "connections", None) or []
+        stats["pooled_connections"] = len(connections)
+        stats["idle_connections"] = sum(1 for conn in connections if conn.is_idle())
+    return stats
+
+@asynccontextmanager
+async def _track_request():
+    """Keep the pool usage counters up to date around a single request."""
+    global _last_request_end
+    _pool_stats["requests_total"] += 1
+    _pool_stats["in_flight"] += 1
+    _pool_stats["peak_in_flight"] = max(_pool_stats["peak_in_flight"], _pool_stats["in_flight"])
+    try:
+        yield
+    except Exception:
+        _pool_stats["errors_total"] += 1
+        raise
+    finally:
+        _pool_stats["in_flight"] -= 1
+        _last_request_end = time.monotonic()
+
+async def warm_up_connection() -> bool:
+    """
+    Open a connection to the LLM API ahead of a request when the pool may have none left,
+    so the TCP and TLS handshakes happen while other work is still running.
+
+    Returns:
+        bool: Whether a warm-up request was sent.
+    """
+    recently_used = time.monotonic() - _last_request_end < LLM_KEEPALIVE_EXPIRY / 2
+    if recently_used or get_pool_stats()["idle_connections"] > 0:
+        return False
+
+    client = await get_http_client()
+    try:
+        # Any answer leaves an open keep-alive connection in the pool
+        await client.head(LLM_API_URL, timeout=LLM_CONNECT_TIMEOUT)
+        _pool_stats["warmups_total"] += 1
+        return True
+    except httpx.HTTPError as e:
+        logger.debug(f"LLM connection warm-up failed: {str(e)}")
+        return False
+
 async def _make_request(payload: Dict[str, Any], headers: Dict[str, str], url: str) -> httpx.Response:
     """
     Make an asynchronous HTTP POST request to the specified URL.
@@ -29,8 +236,9 @@ async def _make_request(payload: Dict[str, Any], headers: Dict[str, str], url: s
     Raises:
         ValueError: If the response status code is not 200.
     """
-    async with httpx.AsyncClient(timeout=120.0) as client:
-        response = await client.post(url, headers=headers, json=payload, timeout=120.0)
+    client = await get_http_client()
+    async with _track_request():
+        response = await client.post(url, headers=headers, json=payload)
         if response.status_code != 200:
             logger.error(f"LLM API error: {response.status_code} - {response.text}")
             raise ValueError(f"LLM API error: {response.status_code} - {response.text}")
@@ -39,7 +247,9 @@ async def _make_request(payload: Dict[str, Any], headers: Dict[str, str], url: s
 def stream_text_from_llm(
     messages: List[Message],
     model: str = "mistral-large-latest",
-    temperature: float = 0.5
+    temperature: float = 0.5,
+    usage: Optional[TokenUsage] = None,
+    stage: str = "final"
 ) -> AsyncIterable[str]:
     """
     Stream text from any compatible OpenAI API in real-time.
@@ -50,6 +260,8 @@ def stream_text_from_llm(
         messages (List[Message]): A list of message objects containing the conversation history.
         model (str, optional): The model to use for generating the response. Defaults to "mistral-large-latest".
         temperature (float, optional): The sampling temperature to use. Defaults to 0.5.
+        usage (Optional[TokenUsage], optional): Collects the token usage of the call. Defaults to None.
+        stage (str, optional): The stage the usage is booked under. Defaults to "final".
 
     Returns:
         AsyncIterable[str]: An asynchronous generator that yields text chunks.
@@ -79,14 +291,20 @@ def stream_text_from_llm(
             "temperature": temperature,
             "stream": True
         }
+        if LLM_STREAM_INCLUDE_USAGE:
+            payload["stream_options"] = {"include_usage": True}
 
-        async with httpx.AsyncClient(timeout=120.0) as client:
+        # Upstream usage arrives with the last chunk, the text is kept to estimate it otherwise
+        upstream_usage = None
+        completion = []
+
+        client = await get_http_client()
+        async with _track_request():
             async with client.stream(
                 "POST",
                 f"{LLM_API_URL}/chat/completions",
                 headers=headers,
-                json=payload,
-                timeout=120.0
+                json=payload
             ) as response:
                 if response.status_code != 200:
                     error_detail = await response.aread()
@@ -104,21 +322,28 @@ def stream_text_from_llm(
                                 continue
 
                             data = json.loads(json_str)
+                            if data.get("usage"):
+                                upstream_usage = data["usage"]
                             if "choices" in data and data["choices"]:
                                 delta = data["choices"][0].get("delta", {})
                                 content = delta.get("content", "")
                                 if content:
+                                    completion.append(content)
                                     yield content
                         except json.JSONDecodeError as e:
                             logger.error(f"Failed to parse LLM API response: {line} - Error: {str(e)}")
 
+        _record_usage(usage, stage, upstream_usage, messages, "".join(completion))
+
     return generator()
 
 async def get_text_from_llm(
     messages: List[Message],
     model: str = "mistral-large-latest",
     temperature: float = 0.2,
-    response_format: Optional[Dict[str, Any]] = None
+    response_format: Optional[Dict[str, Any]] = None,
+    usage: Optional[TokenUsage] = None,
+    stage: str = "final"
 ) -> str:
     """
     Get a complete text response from any compatible OpenAI API.
@@ -130,6 +355,8 @@ async def get_text_from_llm(
         model (str, optional): The model to use for generating the response. Defaults to "mistral-large-latest".
         temperature (float, optional): The sampling temperature to use. Defaults to 0.2.
         response_format (Optional[Dict[str, Any]], optional): The desired response format. Defaults to None.
+        usage (Optional[TokenUsage], optional): Collects the token usage of the call. Defaults to None.
+        stage (str, optional): The stage the usage is booked under. Defaults to "final".
 
     Returns:
         str: The complete text response from the API.
@@ -163,6 +390,8 @@ async def get_text_from_llm(
     response = await _make_request(payload, headers, f"{LLM_API_URL}/chat/completions")
 
     data = response.json()
+    content = data["choices"][0]["message"]["content"] if data.get("choices") else ""
+    _record_usage(usage, stage, data.get("usage"), messages, content or "")
     if response_format:
         return data
     else:
@@ -0,0 +1,105 @@
+import math
+import re
+from collections import Counter, defaultdict
+from typing import Any, Dict, List, Mapping, Sequence, Tuple
+
+# BM25 parameters
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+# Weight of the best matching function compared to the module's own description
+FUNCTION_WEIGHT = 1.0
+MODULE_WEIGHT = 0.5
+
+STOPWORDS = frozenset(
+    "a an and are as at be by can do for from get how i in is it me my of on or please "
+    "show that the this to use using want what with you".split()
+)
+
+_WORD = re.compile(r"[A-Za-z0-9]+")
+_CAMEL = re.compile(r"(?<=[a-z0-9])(?=[A-Z])")
+
+def tokenize(text: str) -> List[str]:
+    """
+    Split text into lowercase terms, breaking snake_case, dotted and camelCase names apart.
+    """
+    terms = []
+    for word in _WORD.findall(_CAMEL.sub(" ", text)):
+        word = word.lower()
+        if word not in STOPWORDS:
+            terms.append(word)
+    return terms
+
+class ModuleIndex:
+    """
+    BM25 inverted index over the modules and functions of the catalog.
+
+    Every function is a document made of its module and function name, description and
+    usage. Module descriptions are indexed as separate documents. A module scores the
+    best of its function scores plus a share of its own description score.
+    """
+
+    def __init__(self, modules: Sequence[Mapping[str, Any]]):
+        # Documents are (module position, is_module_doc) pairs
+        self.doc_owner: List[Tuple[int, bool]] = []
+        self.doc_length: List[int] = []
+        # Term -> (doc id, term weight), the BM25 weights don't depend on the query
+        self.postings: Dict[str, List[Tuple[int, float]]] = defaultdict(list)
+
+        for position, module in enumerate(modules):
+            self._add(position, True, f"{module['name']} {module['description']}")
+            for func in module["functions"]:
+                self._add(
+                    position,
+                    False,
+                    f"{module['name']} {func['name']} {func['description']} {func.get('usage', '')}"
+                )
+
+        count = len(self.doc_length)
+        self.average_length = sum(self.doc_length) / count if count else 0.0
+        for term, docs in self.postings.items():
+            idf = math.log(1 + (count - len(docs) + 0.5) / (len(docs) + 0.5))
+            self.postings[term] = [
+                (doc_id, idf * frequency * (BM25_K1 + 1) / (frequency + BM25_K1 * self._norm(doc_id)))
+                for doc_id, frequency in docs
+            ]
+        self.postings = dict(self.postings)
+        self.module_count = len(modules)
+
+    def _norm(self, doc_id: int) -> float:
+        return 1 - BM25_B + BM25_B * self.doc_length[doc_id] / (self.average_length or 1)
+
+    def _add(self, position: int, is_module_doc: bool, text: str) -> None:
+        doc_id = len(self.doc_owner)
+        terms = tokenize(text)
+        self.doc_owner.append((position, is_module_doc))
+        self.doc_length.append(len(terms))
+        for term, frequency in Counter(terms).items():
+            self.postings[term].append((doc_id, frequency))
+
+    def search(self, query: str) -> List[Tuple[int, float]]:
+        """
+        Rank the modules for a query.
+
+        Returns:
+            (module position, score) pairs with a positive score, best first.
+        """
+        doc_scores: Dict[int, float] = defaultdict(float)
+        for term in set(tokenize(query)):
+            for doc_id, weight in self.postings.get(term, ()):
+                doc_scores[doc_id] += weight
+
+        best_function: Dict[int, float] = defaultdict(float)
+        module_doc: Dict[int, float] = defaultdict(float)
+        for doc_id, score in doc_scores.items():
+            position, is_module_doc = self.doc_owner[doc_id]
+            if is_module_doc:
+                module_doc[position] = score
+            else:
+                best_function[position] = max(best_function[position], score)
+
+        scores = {
+            position: FUNCTION_WEIGHT * best_function[position] + MODULE_WEIGHT * module_doc[position]
+            for position in set(best_function) | set(module_doc)
+        }
+        return sorted(scores.items(), key=lambda item: item[1], reverse=True)
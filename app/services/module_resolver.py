@@ -1,31 +1,210 @@
 import os
+import time
 import logging
-from typing import List, Dict, Any
+import hashlib
+from dataclasses import dataclass
+from types import MappingProxyType
+from typing import List, Dict, Any, Mapping, Optional, Sequence, Tuple
 import json
-import aiofiles
+from services.module_index import ModuleIndex
+from services.code_agent.output_summary import estimate_tokens
 
 logger = logging.getLogger(__name__)
 
 # Load environment variables
 MODULES_DB_PATH = os.getenv("MODULES_DB_PATH", "/docs/modules.json")
 
+# Minimum interval in seconds between checks of the modules file for changes
+MODULES_DB_CHECK_INTERVAL = float(os.getenv("MODULES_DB_CHECK_INTERVAL", "2"))
+
+# Maximum number of ranked modules sent to the code generator
+MODULES_TOP_K = int(os.getenv("MODULES_TOP_K", "5"))
+
+# Token budget of the modules prompt block
+MODULES_TOKEN_BUDGET = int(os.getenv("MODULES_TOKEN_BUDGET", "3000"))
+
+# Comma separated module names that are always sent, on top of the ranked ones
+MODULES_ALWAYS_INCLUDE = [
+    name.strip() for name in os.getenv("MODULES_ALWAYS_INCLUDE", "").split(",") if name.strip()
+]
+
+# Number of recent user turns the module retrieval query is built from, follow-ups keep the modules of earlier turns
+MODULES_QUERY_TURNS = int(os.getenv("MODULES_QUERY_TURNS", "3"))
+
 # Ensure data directory exists
 os.makedirs(os.path.dirname(MODULES_DB_PATH), exist_ok=True)
 
-async def find_relevant_modules(query: str) -> List[Dict[str, Any]]:
+@dataclass(frozen=True)
+class ModuleCatalog:
+    """
+    Immutable snapshot of the modules database.
+
+    Attributes:
+        modules: The modules with their functions, as read-only mappings.
+        version: Hash of the file content, changes whenever the catalog changes.
+        modules_info: The prompt block describing all modules.
+        module_blocks: The prompt block of every single module, by module name.
+        file_key: Inode, mtime and size of the file the catalog was loaded from.
+        index: BM25 index over the module and function descriptions.
+    """
+    modules: Tuple[Mapping[str, Any], ...]
+    version: str
+    modules_info: str
+    module_blocks: Mapping[str, str]
+    file_key: Tuple[int, int, int]
+    index: ModuleIndex
+
+_catalog: Optional[ModuleCatalog] = None
+_last_check = 0.0
+
+def _freeze(value: Any) -> Any:
+    """Recursively turn dicts and lists into read-only mappings and tuples."""
+    if isinstance(value, dict):
+        return MappingProxyType({key: _freeze(item) for key, item in value.items()})
+    if isinstance(value, list):
+        return tuple(_freeze(item) for item in value)
+    return value
+
+def _render_module(module: Mapping[str, Any]) -> str:
+    """Render the prompt block of a single module and its functions."""
+    return (
+        f"- {module['name']}: {module['description']}\n" +
+        "\n".join([f"  - {func['name']}: {func['description']}\n    Usage: {func['usage']}"
+                  for func in module['functions']])
+    )
+
+def _file_key(path: str) -> Tuple[int, int, int]:
+    stat = os.stat(path)
+    return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+def load_catalog(path: str = MODULES_DB_PATH) -> ModuleCatalog:
+    """
+    Load the modules database into an immutable catalog and make it the current one.
+
+    Args:
+        path: The modules database file.
+
+    Returns:
+        ModuleCatalog: The loaded catalog.
+    """
+    global _catalog, _last_check
+    file_key = _file_key(path)
+    with open(path, "rb") as f:
+        content = f.read()
+
+    data = json.loads(content)
+    # modules/build_catalog.py writes a versioned object, older catalogs are a plain list
+    modules = _freeze(data["modules"] if isinstance(data, dict) else data)
+    module_blocks = {module["name"]: _render_module(module) for module in modules}
+    _catalog = ModuleCatalog(
+        modules=modules,
+        version=hashlib.sha256(content).hexdigest()[:16],
+        modules_info="\n\n".join(module_blocks.values()),
+        module_blocks=MappingProxyType(module_blocks),
+        file_key=file_key,
+        index=ModuleIndex(modules),
+    )
+    _last_check = time.monotonic()
+    logger.info(f"Loaded module catalog {_catalog.version} with {len(modules)} modules")
+    return _catalog
+
+def get_catalog() -> ModuleCatalog:
+    """
+    Return the current catalog, reloading it when the modules file was replaced or changed.
+    """
+    global _last_check
+    if _catalog is None:
+        return load_catalog()
+
+    now = time.monotonic()
+    if now - _last_check < MODULES_DB_CHECK_INTERVAL:
+        return _catalog
+    _last_check = now
+
+    try:
+        if _file_key(MODULES_DB_PATH) != _catalog.file_key:
+            return load_catalog()
+    except (OSError, ValueError) as e:
+        # Keep serving the last good catalog while the file is missing or half written
+        logger.error(f"Failed to reload module catalog, keeping version {_catalog.version}: {str(e)}")
+    return _catalog
+
+def render_modules_info(modules: Sequence[Mapping[str, Any]]) -> str:
+    """
+    Return the prompt block for the given modules, reusing the pre-rendered blocks of the catalog.
+    """
+    catalog = get_catalog()
+    if modules is catalog.modules:
+        return catalog.modules_info
+    return "\n\n".join(
+        catalog.module_blocks.get(module["name"]) or _render_module(module)
+        for module in modules
+    )
+
+def _select_modules(
+    catalog: ModuleCatalog, ranked_positions: List[int], top_k: int, token_budget: int
+) -> List[Mapping[str, Any]]:
+    """Take the always-include modules, then the ranked ones, while they fit the budget."""
+    by_name = {module["name"]: position for position, module in enumerate(catalog.modules)}
+    always = [by_name[name] for name in MODULES_ALWAYS_INCLUDE if name in by_name]
+
+    selected, used, ranked_taken = [], 0, 0
+    for position in always + [p for p in ranked_positions if p not in always]:
+        is_ranked = position not in always
+        if is_ranked and ranked_taken >= top_k:
+            break
+        module = catalog.modules[position]
+        tokens = estimate_tokens(catalog.module_blocks[module["name"]])
+        if selected and used + tokens > token_budget:
+            continue
+        selected.append(module)
+        used += tokens
+        ranked_taken += is_ranked
+    return selected
+
+def conversation_query(messages: Sequence[Any], turns: int = MODULES_QUERY_TURNS) -> str:
+    """
+    Build the module retrieval query from the last user turns of a conversation, so a
+    follow-up like "now plot it" still finds the modules the earlier turns' code used.
+
+    Args:
+        messages: The conversation messages, objects with role and content.
+        turns: Number of user turns to include.
+
+    Returns:
+        The user turns joined by newlines, oldest first.
+    """
+    user_turns = [message.content for message in messages if message.role == "user"]
+    return "\n".join(user_turns[-turns:])
+
+async def find_relevant_modules(
+    query: str, top_k: int = MODULES_TOP_K, token_budget: int = MODULES_TOKEN_BUDGET
+) -> List[Dict[str, Any]]:
     """
     Find modules relevant to the user's query.
 
     Args:
         query: The user's query
+        top_k: Maximum number of ranked modules
+        token_budget: Token budget of the rendered modules
 
     Returns:
-        A list of all modules with their documentation
+        The best matching modules with their documentation, best first
     """
-    # Load the modules database
-    async with aiofiles.open(MODULES_DB_PATH, 'r') as f:
-        content = await f.read()
-        modules = json.loads(content)
+    catalog = get_catalog()
+
+    start = time.perf_counter()
+    ranked = [position for position, _ in catalog.index.search(query)]
+    if not ranked:
+        # Nothing matched, fall back to the catalog order so the budget still applies
+        ranked = list(range(len(catalog.modules)))
+    modules = _select_modules(catalog, ranked, top_k, token_budget)
+    elapsed_ms = (time.perf_counter() - start) * 1000
 
-    logger.info(f"Returning all modules for query: {query}")
-    return modules
\ No newline at end of file
+    logger.info(
+        f"Selected modules {[module['name'] for module in modules]} in {elapsed_ms:.2f} ms for query: {query}"
+    )
+    if len(modules) == len(catalog.modules):
+        # Reuse the pre-rendered prompt block of the whole catalog
+        return catalog.modules
+    return modules
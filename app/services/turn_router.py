@@ -0,0 +1,148 @@
+import os
+import re
+import time
+import logging
+from collections import Counter, deque
+from dataclasses import dataclass, asdict
+from typing import Any, Deque, Dict, List, Sequence
+from services.metrics import routes
+
+logger = logging.getLogger(__name__)
+
+# Set to false to send every turn through code generation and execution
+FAST_PATH_ENABLED = os.getenv("FAST_PATH_ENABLED", "true").lower() in ("1", "true", "yes")
+
+# Minimum conversational score for a turn to skip code generation and execution
+FAST_PATH_THRESHOLD = float(os.getenv("FAST_PATH_THRESHOLD", "0.75"))
+
+# Turns with more words than this always go through the code pipeline
+FAST_PATH_MAX_WORDS = int(os.getenv("FAST_PATH_MAX_WORDS", "12"))
+
+# Number of recent decisions kept for the stats
+RECENT_DECISIONS = 100
+
+# Words that may trail a small talk or acknowledgement message without changing its meaning
+_FILLER = r"(?: (?:thanks|thank you|please|then|again|there|man|mate|buddy|so much|a lot|very much|doing))"
+
+# Whole-message small talk: greetings, thanks, farewells and questions about the agent
+_SMALL_TALK = re.compile(
+    r"^(?:(?:hi|hello|hey|hiya|yo|good (?:morning|afternoon|evening|night))"
+    r"|(?:thanks?|thank you|thx|ty|cheers)"
+    r"|(?:bye|goodbye|see you|see ya|later|cya)(?: later| soon)?"
+    r"|how are you|what'?s up|who are you|what can you do|what are you"
+    r")" + _FILLER + r"{0,2}[\s!.?:)(]*$",
+    re.IGNORECASE,
+)
+
+# Acknowledgements, only conversational when the assistant didn't just ask something
+_ACKNOWLEDGEMENT = re.compile(
+    r"^(?:ok|okay|k|cool|nice|great|awesome|perfect|got it|understood|alright|all right|sounds good|"
+    r"no worries|np|lol|haha)" + _FILLER + r"{0,2}[\s!.?:)(]*$",
+    re.IGNORECASE,
+)
+
+# Short confirmations, only conversational when the assistant didn't just ask something
+_CONFIRMATION = re.compile(
+    r"^(?:yes|yeah|yep|sure|no|nope|please do|go ahead|do it)[\s!.]*$",
+    re.IGNORECASE,
+)
+
+# Anything that hints at tools: numbers, math, URLs, code, files or action verbs
+_TOOL_SIGNAL = re.compile(
+    r"\d|[=+*/^%<>]|https?://|`|\b(?:calculate|compute|count|convert|run|execute|search|find|look ?up|"
+    r"fetch|get|list|show|plot|chart|graph|draw|download|scrape|read|write|open|file|csv|json|data|"
+    r"repo|repository|pipeline|gitlab|github|ssh|server|vm|docs?|wiki|wikipedia|weather|news|"
+    r"price|latest|today|current|now|time|date|code|script|python)\b",
+    re.IGNORECASE,
+)
+
+@dataclass
+class RouteDecision:
+    """
+    Routing decision for a single turn.
+
+    Attributes:
+        route: "chat" to answer directly, "code" for code generation and execution.
+        score: Conversational score between 0 and 1, compared to FAST_PATH_THRESHOLD.
+        reason: The rule that decided.
+        latency_ms: Time spent classifying the turn.
+    """
+    route: str
+    score: float
+    reason: str
+    latency_ms: float = 0.0
+
+_counters: Counter = Counter()
+_recent: Deque[Dict[str, Any]] = deque(maxlen=RECENT_DECISIONS)
+
+def _score(text: str, follows_question: bool) -> tuple:
+    """Return the conversational score of a user message and the rule behind it."""
+    text = text.strip()
+    if not text:
+        return 0.0, "empty"
+    if len(text.split()) > FAST_PATH_MAX_WORDS:
+        return 0.0, "long"
+    if _SMALL_TALK.match(text) and not _TOOL_SIGNAL.search(text):
+        return 0.95, "small_talk"
+    if _ACKNOWLEDGEMENT.match(text) and not _TOOL_SIGNAL.search(text):
+        # "ok" to "Shall I fetch the pipelines?" is a request for the tools
+        return (0.2, "confirms_question") if follows_question else (0.9, "acknowledgement")
+    if _CONFIRMATION.match(text):
+        # "yes" to "Shall I fetch the pipelines?" is a request for the tools
+        return (0.2, "confirms_question") if follows_question else (0.8, "confirmation")
+    if _TOOL_SIGNAL.search(text):
+        return 0.0, "tool_signal"
+    return 0.3, "no_rule"
+
+def classify_turn(messages: Sequence[Any], threshold: float = FAST_PATH_THRESHOLD) -> RouteDecision:
+    """
+    Decide whether the last user turn needs code generation and execution.
+
+    Args:
+        messages: The conversation messages, objects with role and content.
+        threshold: Minimum conversational score for the fast path.
+
+    Returns:
+        RouteDecision: The route with its score, rule and latency.
+    """
+    start = time.perf_counter()
+    if not FAST_PATH_ENABLED or not messages or messages[-1].role != "user":
+        score, reason = 0.0, "disabled" if not FAST_PATH_ENABLED else "no_user_turn"
+    else:
+        previous = messages[-2] if len(messages) > 1 else None
+        follows_question = (
+            previous is not None and previous.role == "assistant" and previous.content.rstrip().endswith("?")
+        )
+        score, reason = _score(messages[-1].content, follows_question)
+
+    decision = RouteDecision(
+        route="chat" if score >= threshold else "code",
+        score=score,
+        reason=reason,
+        latency_ms=(time.perf_counter() - start) * 1000,
+    )
+    record_decision(decision)
+    return decision
+
+def record_decision(decision: RouteDecision) -> None:
+    """Count a routing decision and keep it in the recent decisions."""
+    _counters[decision.route] += 1
+    routes.inc(decision.route)
+    _counters[f"reason:{decision.reason}"] += 1
+    _recent.append(asdict(decision))
+    logger.info(
+        f"Routed turn to {decision.route} (score={decision.score:.2f}, reason={decision.reason}, "
+        f"{decision.latency_ms:.3f} ms)"
+    )
+
+def get_router_stats() -> Dict[str, Any]:
+    """Return the routing counters and the latency of the recent decisions."""
+    latencies: List[float] = sorted(decision["latency_ms"] for decision in _recent)
+    return {
+        "enabled": FAST_PATH_ENABLED,
+        "threshold": FAST_PATH_THRESHOLD,
+        "routes": {route: count for route, count in _counters.items() if not route.startswith("reason:")},
+        "reasons": {key[7:]: count for key, count in _counters.items() if key.startswith("reason:")},
+        "recent_p50_ms": round(latencies[len(latencies) // 2], 3) if latencies else 0.0,
+        "recent_max_ms": round(latencies[-1], 3) if latencies else 0.0,
+    }
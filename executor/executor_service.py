@@ -1,64 +1,503 @@
 import os
+import re
+import ast
 import sys
-import subprocess
+import json
+import time
+import codecs
+import hashlib
+import shutil
+import asyncio
+import textwrap
+import logging
+import tempfile
+import threading
 import traceback
-from fastapi import FastAPI
+from typing import Optional, Dict, Tuple
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, Header
+from fastapi.responses import JSONResponse, StreamingResponse
 from pydantic import BaseModel
 import uvicorn
 import autopep8
+from warm_pool import WarmPool, WARM_POOL_SIZE
+from sessions import SessionManager
 
-app = FastAPI()
+# Configure logging the same way as the API, so both sides can be followed by request id
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+)
+logger = logging.getLogger(__name__)
+
+# Run code in children forked from pre-warmed workers instead of a cold interpreter
+WARM_POOL_ENABLED = os.getenv("WARM_POOL_ENABLED", "true").lower() in ("1", "true", "yes")
+
+# Maximum number of scripts running at the same time in this container
+EXECUTOR_CONCURRENCY = int(os.getenv("EXECUTOR_CONCURRENCY", str(WARM_POOL_SIZE)))
+
+# Maximum number of scripts waiting for a slot before answering 429
+EXECUTOR_MAX_QUEUE = int(os.getenv("EXECUTOR_MAX_QUEUE", "4"))
+
+# Interval in seconds at which streamed executions forward new output
+STREAM_POLL_INTERVAL = float(os.getenv("STREAM_POLL_INTERVAL", "0.1"))
+
+# Bytes kept from the start and the end of stdout/stderr, the middle of larger output is cut
+OUTPUT_HEAD_BYTES = int(os.getenv("OUTPUT_HEAD_BYTES", "16384"))
+OUTPUT_TAIL_BYTES = int(os.getenv("OUTPUT_TAIL_BYTES", "8192"))
+
+# Oversized output is kept in full in this directory, the oldest files are pruned
+OUTPUT_SPILL_DIR = os.getenv("OUTPUT_SPILL_DIR", "/app/data/outputs")
+OUTPUT_SPILL_MAX_FILES = int(os.getenv("OUTPUT_SPILL_MAX_FILES", "200"))
+
+# Number of normalized scripts kept in memory, retries and repeated requests skip the work
+NORMALIZE_CACHE_SIZE = int(os.getenv("NORMALIZE_CACHE_SIZE", "256"))
+
+warm_pool = None
+session_manager = None
+execution_slots = asyncio.Semaphore(EXECUTOR_CONCURRENCY)
+running = 0
+queued = 0
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global warm_pool, session_manager
+    if WARM_POOL_ENABLED:
+        try:
+            warm_pool = WarmPool()
+            warm_pool.start()
+        except Exception as e:
+            logger.error(f"Failed to start warm pool, using cold subprocesses: {str(e)}")
+            warm_pool = None
+    session_manager = SessionManager()
+    session_manager.start()
+    try:
+        yield
+    finally:
+        await session_manager.close()
+        if warm_pool is not None:
+            warm_pool.close()
+
+app = FastAPI(lifespan=lifespan)
 
 class CodeExecution(BaseModel):
     code: str
     execution_id: str
     timeout: int = 120
 
-@app.post("/execute")
-async def execute_code(execution: CodeExecution):
-    """Execute Python code and return the result."""
+class SessionCreate(BaseModel):
+    session_id: str
+
+class ExecutorBusy(Exception):
+    """Raised when all execution slots are taken and the queue is full."""
+
+@app.exception_handler(ExecutorBusy)
+async def executor_busy_handler(request, exc: ExecutorBusy):
+    return JSONResponse(
+        status_code=429,
+        content={
+            "detail": "Executor is busy",
+            "running": running,
+            "queue_depth": queued
+        },
+        headers={"Retry-After": "1"}
+    )
+
+def _check_capacity() -> None:
+    """Push back when all slots are taken and the queue is full."""
+    if execution_slots.locked() and queued >= EXECUTOR_MAX_QUEUE:
+        raise ExecutorBusy()
+
+@asynccontextmanager
+async def _execution_slot():
+    """Wait for a free execution slot, pushing back when the queue is full."""
+    global running, queued
+
+    _check_capacity()
+
+    queued += 1
+    try:
+        await execution_slots.acquire()
+    finally:
+        queued -= 1
+
+    running += 1
     try:
-        # Format the code using autopep8
-        formatted_code = autopep8.fix_code(execution.code)
-
-        # Execute the formatted code with timeout using subprocess.Popen
-        process = subprocess.Popen(
-            [sys.executable, '-c', formatted_code],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True
+        yield
+    finally:
+        running -= 1
+        execution_slots.release()
+
+def _output_paths(output_dir: str):
+    return os.path.join(output_dir, "stdout"), os.path.join(output_dir, "stderr")
+
+def _spill(path: str, execution_id: str, name: str) -> Optional[str]:
+    """Move an oversized output file to the spill directory and prune the oldest spills."""
+    try:
+        os.makedirs(OUTPUT_SPILL_DIR, exist_ok=True)
+        safe_id = re.sub(r"[^A-Za-z0-9_.-]", "_", execution_id)
+        spill_path = os.path.join(OUTPUT_SPILL_DIR, f"{safe_id}.{name}.txt")
+        shutil.move(path, spill_path)
+
+        spills = sorted(
+            (entry for entry in os.scandir(OUTPUT_SPILL_DIR) if entry.is_file()),
+            key=lambda entry: entry.stat().st_mtime
+        )
+        for entry in spills[:max(0, len(spills) - OUTPUT_SPILL_MAX_FILES)]:
+            os.remove(entry.path)
+        return spill_path
+    except OSError as e:
+        logger.warning(f"Could not spill {name} of {execution_id}: {str(e)}")
+        return None
+
+def _read_output(path: str, execution_id: str, name: str):
+    """
+    Read an output file keeping only its head and tail when it is too large.
+
+    Returns:
+        The captured text and its metadata: total bytes, whether it was truncated and the spill path.
+    """
+    if not os.path.exists(path):
+        return "", {"bytes": 0, "truncated": False, "spill_path": None}
+
+    size = os.path.getsize(path)
+    with open(path, "rb") as f:
+        if size <= OUTPUT_HEAD_BYTES + OUTPUT_TAIL_BYTES:
+            return f.read().decode(errors="replace"), {"bytes": size, "truncated": False, "spill_path": None}
+        head = f.read(OUTPUT_HEAD_BYTES)
+        f.seek(size - OUTPUT_TAIL_BYTES)
+        tail = f.read()
+
+    # Cut on line boundaries when there are any
+    if b"\n" in head:
+        head = head[:head.rindex(b"\n") + 1]
+    if b"\n" in tail[:-1]:
+        tail = tail[tail.index(b"\n") + 1:]
+
+    omitted = size - len(head) - len(tail)
+    text = (
+        head.decode(errors="replace")
+        + f"\n... [{omitted} bytes of output truncated] ...\n\n"
+        + tail.decode(errors="replace")
+    )
+    return text, {"bytes": size, "truncated": True, "spill_path": _spill(path, execution_id, name)}
+
+def _read_outputs(output_dir: str, execution_id: str):
+    """Read the bounded stdout and stderr of a run with their metadata."""
+    stdout_path, stderr_path = _output_paths(output_dir)
+    stdout, stdout_info = _read_output(stdout_path, execution_id, "stdout")
+    stderr, stderr_info = _read_output(stderr_path, execution_id, "stderr")
+    return stdout, stderr, {"stdout": stdout_info, "stderr": stderr_info}
+
+class _OutputTail:
+    """Incrementally read the text appended to an output file while a run writes it."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.offset = 0
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+
+    def read(self, max_bytes: int = -1, final: bool = False) -> str:
+        if not os.path.exists(self.path):
+            return ""
+        with open(self.path, "rb") as f:
+            f.seek(self.offset)
+            data = f.read(max_bytes)
+        self.offset += len(data)
+        return self.decoder.decode(data, final=final)
+
+async def _run_cold(code: str, timeout: int, output_dir: str) -> int:
+    """Run code in a fresh interpreter writing to the output files and return the return code."""
+    stdout_path, stderr_path = _output_paths(output_dir)
+    with open(stdout_path, "wb") as stdout, open(stderr_path, "wb") as stderr:
+        process = await asyncio.create_subprocess_exec(
+            sys.executable, '-c', code,
+            stdout=stdout,
+            stderr=stderr,
+            env={**os.environ, "PYTHONUNBUFFERED": "1"}
         )
 
+    try:
+        await asyncio.wait_for(process.wait(), timeout=timeout)
+        return process.returncode
+    except asyncio.TimeoutError:
+        process.kill()
+        await process.wait()
+        return -1
+
+async def _run(code: str, timeout: int, output_dir: str) -> int:
+    """Run code off the event loop, preferably in a warm worker, and return the return code."""
+    if warm_pool is not None:
         try:
-            stdout, stderr = process.communicate(timeout=execution.timeout)
-            returncode = process.returncode
-        except subprocess.TimeoutExpired:
-            process.kill()
-            stdout, stderr = process.communicate()
-            returncode = -1
-
-        # Return the result
-        return {
-            "execution_id": execution.execution_id,
-            "stdout": stdout,
-            "stderr": stderr,
-            "returncode": returncode,
-            "success": returncode == 0
-        }
-
-    except Exception as e:
-        return {
-            "execution_id": execution.execution_id,
-            "stdout": "",
-            "stderr": f"Error executing code: {str(e)}\n{traceback.format_exc()}",
-            "returncode": -1,
-            "success": False
-        }
+            result = await asyncio.to_thread(warm_pool.run, code, timeout, *_output_paths(output_dir))
+            return result.returncode
+        except Exception as e:
+            logger.warning(f"Warm pool run failed, using a cold subprocess: {str(e)}")
+    return await _run_cold(code, timeout, output_dir)
+
+async def _run_in_session(session_id: str, code: str, timeout: int, output_dir: str):
+    """
+    Run code in the session's live interpreter.
+
+    Returns:
+        The return code and, when the session had to be reset, the reason.
+    """
+    session = await session_manager.create(session_id)
+    async with session.lock:
+        reply = await session.run(code, timeout, *_output_paths(output_dir))
+    return reply["returncode"], await session_manager.check_limits(session, reply)
+
+def _parses(code: str) -> bool:
+    try:
+        ast.parse(code)
+        return True
+    except SyntaxError:
+        return False
+
+# Normalized code by sha256 of the code it came from, least recently used first.
+# Code that needed no change is stored as None, the cache doesn't keep a copy of it.
+_normalize_cache: "OrderedDict[str, Tuple[Optional[str], str]]" = OrderedDict()
+_normalize_cache_lock = threading.Lock()
+_normalize_cache_stats = {"hits": 0, "misses": 0}
+
+def _normalize_code(code: str) -> Tuple[str, str, bool]:
+    """
+    Fix the indentation of generated code, cached on the hash of the code.
+
+    Returns:
+        The normalized code, the method that produced it and whether it came from the cache.
+    """
+    key = hashlib.sha256(code.encode()).hexdigest()
+    with _normalize_cache_lock:
+        cached = _normalize_cache.get(key)
+        if cached is not None:
+            _normalize_cache.move_to_end(key)
+            _normalize_cache_stats["hits"] += 1
+        else:
+            _normalize_cache_stats["misses"] += 1
+    if cached is not None:
+        normalized, method = cached
+        return (code if normalized is None else normalized), method, True
+
+    normalized, method = _fix_indentation(code)
+    with _normalize_cache_lock:
+        _normalize_cache[key] = (None if method == "unchanged" else normalized), method
+        _normalize_cache.move_to_end(key)
+        while len(_normalize_cache) > NORMALIZE_CACHE_SIZE:
+            _normalize_cache.popitem(last=False)
+    return normalized, method, False
+
+def _normalize_cache_info() -> Dict[str, int]:
+    with _normalize_cache_lock:
+        return {**_normalize_cache_stats, "maxsize": NORMALIZE_CACHE_SIZE, "currsize": len(_normalize_cache)}
+
+def _fix_indentation(code: str) -> Tuple[str, str]:
+    """
+    Fix the indentation of generated code.
+
+    Generated code is usually only indented as a whole, or all lines but the first one
+    when the code block was stripped. Dedenting fixes that, autopep8 is only used when
+    the code still doesn't parse.
+
+    Returns:
+        The normalized code and the method that produced it.
+    """
+    if _parses(code):
+        return code, "unchanged"
+
+    dedented = textwrap.dedent(code)
+    if _parses(dedented):
+        return dedented, "dedent"
+
+    first_line, _, rest = code.partition("\n")
+    dedented = first_line.strip() + "\n" + textwrap.dedent(rest)
+    if _parses(dedented):
+        return dedented, "dedent"
+
+    return autopep8.fix_code(code), "autopep8"
+
+def _elapsed_ms(start: float) -> float:
+    return round((time.perf_counter() - start) * 1000, 2)
+
+async def _format_and_run(execution: CodeExecution, session_id: Optional[str], output_dir: str, timings: Dict):
+    """Normalize the code and run it, in a session when a session id is given."""
+    start = time.perf_counter()
+    # Normalize in a thread, the autopep8 fallback is pure Python and slow on large code
+    formatted_code, method, cached = await asyncio.to_thread(_normalize_code, execution.code)
+    timings["normalize_ms"] = _elapsed_ms(start)
+    timings["normalize"] = "cached" if cached else method
+
+    # Execute the formatted code with timeout
+    start = time.perf_counter()
+    try:
+        if session_id is not None:
+            return await _run_in_session(session_id, formatted_code, execution.timeout, output_dir)
+        return await _run(formatted_code, execution.timeout, output_dir), None
+    finally:
+        timings["run_ms"] = _elapsed_ms(start)
+
+def _result(
+    execution: CodeExecution, output_dir: str, returncode: int, reset_reason: Optional[str], timings: Dict
+):
+    start = time.perf_counter()
+    stdout, stderr, output_info = _read_outputs(output_dir, execution.execution_id)
+    timings["read_ms"] = _elapsed_ms(start)
+    timings["total_ms"] = _elapsed_ms(timings.pop("_start"))
+    if reset_reason:
+        stderr += ("\n" if stderr else "") + f"Session state was reset because {reset_reason}."
+    return {
+        "execution_id": execution.execution_id,
+        "stdout": stdout,
+        "stderr": stderr,
+        "returncode": returncode,
+        "success": returncode == 0,
+        "truncated": output_info["stdout"]["truncated"] or output_info["stderr"]["truncated"],
+        "output_info": output_info,
+        "timings": timings
+    }
+
+def _error_result(execution: CodeExecution, e: Exception):
+    return {
+        "execution_id": execution.execution_id,
+        "stdout": "",
+        "stderr": f"Error executing code: {str(e)}\n{traceback.format_exc()}",
+        "returncode": -1,
+        "success": False,
+        "truncated": False
+    }
+
+def _log_execution(result: Dict, request_id: Optional[str], session_id: Optional[str]) -> None:
+    """Log one line per execution, tied to the API request through the X-Request-ID header."""
+    logger.info(
+        f"Executed {result['execution_id']} for request {request_id or '-'} "
+        f"(session={session_id or '-'}, returncode={result['returncode']}, timings={result.get('timings', {})})"
+    )
+
+async def _execute(
+    execution: CodeExecution, session_id: Optional[str] = None, request_id: Optional[str] = None
+):
+    """Format and execute code, in a session when a session id is given."""
+    timings = {"_start": time.perf_counter()}
+    async with _execution_slot():
+        timings["queue_ms"] = _elapsed_ms(timings["_start"])
+        output_dir = tempfile.mkdtemp(prefix="exec_")
+        try:
+            returncode, reset_reason = await _format_and_run(execution, session_id, output_dir, timings)
+            result = _result(execution, output_dir, returncode, reset_reason, timings)
+        except Exception as e:
+            result = _error_result(execution, e)
+        finally:
+            shutil.rmtree(output_dir, ignore_errors=True)
+    _log_execution(result, request_id, session_id)
+    return result
+
+async def _stream_execution(
+    execution: CodeExecution, session_id: Optional[str] = None, request_id: Optional[str] = None
+):
+    """
+    Execute code and yield NDJSON events: stdout/stderr text as it is produced,
+    then a final result event with the same fields as /execute.
+    """
+    timings = {"_start": time.perf_counter()}
+    async with _execution_slot():
+        timings["queue_ms"] = _elapsed_ms(timings["_start"])
+        output_dir = tempfile.mkdtemp(prefix="exec_")
+        task = asyncio.create_task(_format_and_run(execution, session_id, output_dir, timings))
+        tails = {name: _OutputTail(path) for name, path in zip(("stdout", "stderr"), _output_paths(output_dir))}
+        # Only the head of the output is streamed, the result event carries the bounded tail
+        stream_budget = OUTPUT_HEAD_BYTES
+        try:
+            while True:
+                await asyncio.wait({task}, timeout=STREAM_POLL_INTERVAL)
+                finished = task.done()
+                for name, tail in tails.items():
+                    if stream_budget <= 0:
+                        break
+                    data = tail.read(max_bytes=stream_budget, final=finished)
+                    if not data:
+                        continue
+                    stream_budget -= len(data.encode())
+                    if stream_budget <= 0:
+                        data += "\n... [output truncated] ...\n"
+                    yield json.dumps({"type": name, "data": data}) + "\n"
+                if finished:
+                    break
+
+            try:
+                returncode, reset_reason = task.result()
+                result = _result(execution, output_dir, returncode, reset_reason, timings)
+            except Exception as e:
+                result = _error_result(execution, e)
+            if session_id is not None:
+                result["session_id"] = session_id
+            _log_execution(result, request_id, session_id)
+            yield json.dumps({"type": "result", **result}) + "\n"
+        finally:
+            # Keep the slot until the run is over, even when the client went away
+            if not task.done():
+                await asyncio.wait({task})
+            shutil.rmtree(output_dir, ignore_errors=True)
+
+@app.post("/execute")
+async def execute_code(execution: CodeExecution, x_request_id: Optional[str] = Header(None)):
+    """Execute Python code and return the result."""
+    return await _execute(execution, request_id=x_request_id)
+
+@app.post("/execute/stream")
+async def execute_code_stream(execution: CodeExecution, x_request_id: Optional[str] = Header(None)):
+    """Execute Python code and stream its output while it runs."""
+    _check_capacity()
+    return StreamingResponse(
+        _stream_execution(execution, request_id=x_request_id), media_type="application/x-ndjson"
+    )
+
+@app.post("/sessions")
+async def create_session(request: SessionCreate):
+    """Start a live interpreter that keeps its state between executions."""
+    existed = session_manager.get(request.session_id) is not None
+    await session_manager.create(request.session_id)
+    return {"session_id": request.session_id, "created": not existed}
+
+@app.post("/sessions/{session_id}/execute")
+async def execute_in_session(
+    session_id: str, execution: CodeExecution, x_request_id: Optional[str] = Header(None)
+):
+    """Execute Python code in a session, the session is created when it doesn't exist yet."""
+    result = await _execute(execution, session_id=session_id, request_id=x_request_id)
+    result["session_id"] = session_id
+    return result
+
+@app.post("/sessions/{session_id}/execute/stream")
+async def execute_in_session_stream(
+    session_id: str, execution: CodeExecution, x_request_id: Optional[str] = Header(None)
+):
+    """Execute Python code in a session and stream its output while it runs."""
+    _check_capacity()
+    return StreamingResponse(
+        _stream_execution(execution, session_id=session_id, request_id=x_request_id),
+        media_type="application/x-ndjson"
+    )
+
+@app.delete("/sessions/{session_id}")
+async def destroy_session(session_id: str):
+    """Stop a session and drop its state."""
+    if not await session_manager.destroy(session_id):
+        raise HTTPException(status_code=404, detail=f"Session {session_id} not found")
+    return {"session_id": session_id, "destroyed": True}
 
 @app.get("/health")
 async def health_check():
     """Health check endpoint."""
-    return {"status": "healthy", "executor_id": os.environ.get("EXECUTOR_ID", "unknown")}
+    return {
+        "status": "healthy",
+        "executor_id": os.environ.get("EXECUTOR_ID", "unknown"),
+        "running": running,
+        "queue_depth": queued,
+        "concurrency": EXECUTOR_CONCURRENCY,
+        "normalize_cache": _normalize_cache_info(),
+        **session_manager.stats()
+    }
 
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=5000)
\ No newline at end of file
+    uvicorn.run(app, host="0.0.0.0", port=5000)
@@ -0,0 +1,217 @@
+import os
+import sys
+import time
+import asyncio
+import logging
+import traceback
+import multiprocessing
+from typing import Dict, Any, Optional
+from warm_pool import preload_module_names, rss_mb
+
+logger = logging.getLogger(__name__)
+
+# Sessions without executions for this many seconds are destroyed
+SESSION_IDLE_TTL = float(os.getenv("SESSION_IDLE_TTL", "900"))
+
+# Maximum number of live sessions in this container, the least recently used is evicted
+SESSION_MAX_COUNT = int(os.getenv("SESSION_MAX_COUNT", "8"))
+
+# A session is reset when its interpreter uses more resident memory than this
+SESSION_MAX_RSS_MB = int(os.getenv("SESSION_MAX_RSS_MB", "1024"))
+
+# Interval in seconds of the idle session reaper
+SESSION_REAP_INTERVAL = float(os.getenv("SESSION_REAP_INTERVAL", "30"))
+
+def _session_main(conn) -> None:
+    """
+    Entry point of a session interpreter: run every job in the same namespace so
+    variables, imports and open clients survive between executions.
+    """
+    os.environ.setdefault("MPLBACKEND", "Agg")
+    devnull = os.open(os.devnull, os.O_RDONLY)
+    os.dup2(devnull, 0)
+    namespace = {"__name__": "__main__", "__builtins__": __builtins__}
+
+    # Flush every line so streamed executions see the output while the code runs
+    sys.stdout.reconfigure(line_buffering=True)
+    sys.stderr.reconfigure(line_buffering=True)
+
+    while True:
+        try:
+            job = conn.recv()
+        except EOFError:
+            break
+        if job is None:
+            break
+
+        stdout_fd = os.open(job["stdout_path"], os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        stderr_fd = os.open(job["stderr_path"], os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        os.dup2(stdout_fd, 1)
+        os.dup2(stderr_fd, 2)
+        os.close(stdout_fd)
+        os.close(stderr_fd)
+
+        returncode = 0
+        try:
+            exec(compile(job["code"], "<string>", "exec"), namespace)
+        except SystemExit as e:
+            returncode = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+        except BaseException as e:
+            # Leave this frame out of the traceback, it only shows the user's code
+            traceback.print_exception(type(e), e, e.__traceback__.tb_next)
+            returncode = 1
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+
+        conn.send({"returncode": returncode, "rss_mb": rss_mb()})
+
+class Session:
+    """A live interpreter process that keeps its state for one conversation."""
+
+    def __init__(self, session_id: str, context):
+        self.session_id = session_id
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=_session_main, args=(child_conn,), daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.lock = asyncio.Lock()
+        self.created = time.time()
+        self.last_used = time.time()
+        self.executions = 0
+
+    def _run(self, code: str, timeout: float, stdout_path: str, stderr_path: str) -> Dict[str, Any]:
+        self.conn.send({"code": code, "stdout_path": stdout_path, "stderr_path": stderr_path})
+        if not self.conn.poll(timeout):
+            return {"returncode": -1, "timed_out": True}
+        reply = self.conn.recv()
+        reply["timed_out"] = False
+        return reply
+
+    async def run(self, code: str, timeout: float, stdout_path: str, stderr_path: str) -> Dict[str, Any]:
+        """
+        Run code in the session's namespace, blocking a thread until it finishes.
+
+        Returns:
+            Dict[str, Any]: The return code, whether the run timed out and the interpreter RSS.
+        """
+        self.last_used = time.time()
+        self.executions += 1
+        try:
+            return await asyncio.to_thread(self._run, code, timeout, stdout_path, stderr_path)
+        finally:
+            self.last_used = time.time()
+
+    @property
+    def alive(self) -> bool:
+        return self.process.is_alive()
+
+    def destroy(self, kill: bool = False) -> None:
+        """Stop the interpreter, killing it right away when it is stuck in a run."""
+        if not kill:
+            try:
+                self.conn.send(None)
+            except (OSError, BrokenPipeError):
+                pass
+            self.process.join(timeout=1)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+        self.conn.close()
+
+class SessionManager:
+    """
+    Keeps one live interpreter per conversation with an idle TTL and memory caps.
+
+    Session interpreters are forked from a forkserver that preloaded the heavy
+    modules, so creating a session doesn't pay for the imports again.
+    """
+
+    def __init__(self):
+        self.sessions: Dict[str, Session] = {}
+        self._context = multiprocessing.get_context("forkserver")
+        self._context.set_forkserver_preload(preload_module_names())
+        self._reaper: Optional[asyncio.Task] = None
+        self._create_lock = asyncio.Lock()
+
+    def get(self, session_id: str) -> Optional[Session]:
+        session = self.sessions.get(session_id)
+        if session is not None and not session.alive:
+            # The process already exited, joining it doesn't block
+            self.sessions.pop(session_id, None)
+            session.destroy(kill=True)
+            logger.info(f"Removed dead session {session_id}")
+            return None
+        return session
+
+    async def create(self, session_id: str) -> Session:
+        """Return the live session for the id, starting a new interpreter when needed."""
+        async with self._create_lock:
+            session = self.get(session_id)
+            if session is not None:
+                return session
+
+            if len(self.sessions) >= SESSION_MAX_COUNT:
+                idle = [s for s in self.sessions.values() if not s.lock.locked()]
+                if idle:
+                    evicted = min(idle, key=lambda s: s.last_used)
+                    logger.info(f"Evicting least recently used session {evicted.session_id}")
+                    await self.destroy(evicted.session_id)
+
+            # Starting the process talks to the forkserver, keep it off the event loop
+            session = await asyncio.to_thread(Session, session_id, self._context)
+            self.sessions[session_id] = session
+            logger.info(f"Created session {session_id}")
+            return session
+
+    async def destroy(self, session_id: str, kill: bool = False) -> bool:
+        session = self.sessions.pop(session_id, None)
+        if session is None:
+            return False
+        # Joining the interpreter can take a second when user code left threads running
+        await asyncio.to_thread(session.destroy, kill)
+        logger.info(f"Destroyed session {session_id}")
+        return True
+
+    async def check_limits(self, session: Session, reply: Dict[str, Any]) -> Optional[str]:
+        """
+        Destroy a session that timed out or outgrew its memory cap.
+
+        Returns:
+            Optional[str]: The reason the session was reset, None if it is still live.
+        """
+        reason = None
+        if reply.get("timed_out"):
+            reason = "the execution timed out"
+        elif reply.get("rss_mb", 0) > SESSION_MAX_RSS_MB:
+            reason = f"the interpreter used more than {SESSION_MAX_RSS_MB} MB"
+        if reason:
+            await self.destroy(session.session_id, kill=bool(reply.get("timed_out")))
+        return reason
+
+    async def _reap_loop(self) -> None:
+        while True:
+            await asyncio.sleep(SESSION_REAP_INTERVAL)
+            now = time.time()
+            for session in list(self.sessions.values()):
+                if not session.lock.locked() and now - session.last_used > SESSION_IDLE_TTL:
+                    logger.info(f"Session {session.session_id} idle for {now - session.last_used:.0f}s")
+                    await self.destroy(session.session_id)
+
+    def start(self) -> None:
+        if self._reaper is None:
+            self._reaper = asyncio.create_task(self._reap_loop())
+
+    async def close(self) -> None:
+        if self._reaper is not None:
+            self._reaper.cancel()
+            try:
+                await self._reaper
+            except asyncio.CancelledError:
+                pass
+            self._reaper = None
+        for session_id in list(self.sessions):
+            await self.destroy(session_id)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"sessions": len(self.sessions), "max_sessions": SESSION_MAX_COUNT}
@@ -0,0 +1,285 @@
+import os
+import sys
+import time
+import queue
+import signal
+import logging
+import threading
+import traceback
+import importlib
+import multiprocessing
+from dataclasses import dataclass
+from typing import List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Number of warm worker processes, each one serves a single run at a time
+WARM_POOL_SIZE = int(os.getenv("WARM_POOL_SIZE", "2"))
+
+# Recycle a worker after this many runs
+WARM_POOL_MAX_RUNS = int(os.getenv("WARM_POOL_MAX_RUNS", "100"))
+
+# Pip distribution names of the preinstalled packages, see executor.Dockerfile
+INSTALLED_MODULES = os.getenv(
+    "INSTALLED_MODULES", "pandas,numpy,matplotlib,requests,scikit-learn"
+).split(",")
+
+# Directory with the custom module packages, installed with pip by executor.Dockerfile
+MODULES_DIR = os.getenv("MODULES_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "modules"))
+
+# Pip distribution names that differ from their import name
+IMPORT_NAMES = {
+    "scikit-learn": "sklearn",
+    "beautifulsoup4": "bs4",
+    "python-gitlab": "gitlab",
+    "python-dotenv": "dotenv",
+    "matplotlib": "matplotlib.pyplot",
+}
+
+# Maximum time in seconds to wait for an idle worker
+WARM_POOL_ACQUIRE_TIMEOUT = float(os.getenv("WARM_POOL_ACQUIRE_TIMEOUT", "30"))
+
+# Grace period for a worker to answer on top of the execution timeout
+WORKER_REPLY_MARGIN = 10
+
+@dataclass
+class RunResult:
+    returncode: int
+    timed_out: bool = False
+
+def preload_module_names() -> List[str]:
+    """
+    Return the import names of the installed packages and the custom modules to warm up.
+    """
+    names = []
+    for module in INSTALLED_MODULES:
+        module = module.strip()
+        if module:
+            names.append(IMPORT_NAMES.get(module, module.replace("-", "_")))
+
+    if os.path.isdir(MODULES_DIR):
+        for entry in sorted(os.listdir(MODULES_DIR)):
+            if os.path.isfile(os.path.join(MODULES_DIR, entry, entry, "__init__.py")):
+                names.append(entry)
+    return names
+
+def rss_mb() -> float:
+    """Current resident memory of this process in MB."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except (OSError, ValueError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def _run_child(code: str, stdout_path: str, stderr_path: str) -> None:
+    """Run the code in the forked child with stdout/stderr redirected to files. Never returns."""
+    exit_code = 1
+    try:
+        os.setpgid(0, 0)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+
+        devnull = os.open(os.devnull, os.O_RDONLY)
+        os.dup2(devnull, 0)
+        os.dup2(os.open(stdout_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 1)
+        os.dup2(os.open(stderr_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 2)
+
+        # Flush every line so streamed executions see the output while the code runs
+        sys.stdout.reconfigure(line_buffering=True)
+        sys.stderr.reconfigure(line_buffering=True)
+
+        # Forked children share the parent's numpy random state, reseed it
+        if "numpy" in sys.modules:
+            sys.modules["numpy"].random.seed()
+
+        sys.argv = ["-c"]
+        try:
+            exec(compile(code, "<string>", "exec"), {"__name__": "__main__", "__builtins__": __builtins__})
+            exit_code = 0
+        except SystemExit as e:
+            if e.code is None:
+                exit_code = 0
+            elif isinstance(e.code, int):
+                exit_code = e.code
+            else:
+                print(e.code, file=sys.stderr)
+                exit_code = 1
+        except BaseException as e:
+            # Leave this frame out of the traceback, it only shows the user's code
+            traceback.print_exception(type(e), e, e.__traceback__.tb_next)
+            exit_code = 1
+    finally:
+        try:
+            sys.stdout.flush()
+            sys.stderr.flush()
+        finally:
+            os._exit(exit_code)
+
+def _wait_child(pid: int, timeout: float) -> RunResult:
+    """Wait for a forked child, killing its whole process group on timeout."""
+    deadline = time.monotonic() + timeout
+    delay = 0.001
+    while True:
+        waited, status = os.waitpid(pid, os.WNOHANG)
+        if waited:
+            return RunResult(returncode=os.waitstatus_to_exitcode(status))
+        if time.monotonic() >= deadline:
+            try:
+                os.killpg(pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            os.waitpid(pid, 0)
+            return RunResult(returncode=-1, timed_out=True)
+        time.sleep(delay)
+        delay = min(delay * 2, 0.05)
+
+def _worker_main(conn, preload: List[str]) -> None:
+    """
+    Entry point of a warm worker: import the heavy modules once, then fork a child per run.
+    """
+    os.environ.setdefault("MPLBACKEND", "Agg")
+
+    for name in preload:
+        try:
+            importlib.import_module(name)
+        except Exception as e:
+            print(f"Warm worker could not preload {name}: {e}", file=sys.stderr)
+
+    conn.send({"ready": True})
+
+    while True:
+        try:
+            job = conn.recv()
+        except EOFError:
+            break
+        if job is None:
+            break
+
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:
+            conn.close()
+            _run_child(job["code"], job["stdout_path"], job["stderr_path"])
+
+        result = _wait_child(pid, job["timeout"])
+        conn.send({"returncode": result.returncode, "timed_out": result.timed_out})
+
+class _Worker:
+    """Handle to a warm worker process owned by the pool."""
+
+    def __init__(self, context, preload: List[str]):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=_worker_main, args=(child_conn, preload), daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.runs = 0
+
+    def wait_ready(self, timeout: float) -> bool:
+        try:
+            return self.conn.poll(timeout) and self.conn.recv().get("ready", False)
+        except EOFError:
+            return False
+
+    def stop(self) -> None:
+        try:
+            self.conn.send(None)
+        except (OSError, BrokenPipeError):
+            pass
+        self.process.join(timeout=2)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+        self.conn.close()
+
+class WarmPool:
+    """
+    Pool of pre-forked worker processes that already imported the heavy modules.
+
+    Every run forks a fresh child from a warmed worker, so runs stay isolated from each
+    other while skipping the interpreter startup and the imports. The user code never runs
+    in the worker itself, workers are only recycled after a number of runs.
+    """
+
+    def __init__(
+        self,
+        size: int = WARM_POOL_SIZE,
+        max_runs: int = WARM_POOL_MAX_RUNS,
+        preload: Optional[List[str]] = None,
+    ):
+        self.size = size
+        self.max_runs = max_runs
+        self.preload = preload if preload is not None else preload_module_names()
+        # Workers are spawned so they don't inherit the threads of the web server
+        self._context = multiprocessing.get_context("spawn")
+        self._idle: "queue.Queue[_Worker]" = queue.Queue()
+        self._closed = False
+
+    def start(self) -> None:
+        """Spawn and warm up all workers."""
+        for _ in range(self.size):
+            self._spawn()
+        logger.info(f"Warm pool started with {self.size} workers, preloaded: {', '.join(self.preload)}")
+
+    def _spawn(self) -> None:
+        worker = _Worker(self._context, self.preload)
+        if worker.wait_ready(timeout=300):
+            self._idle.put(worker)
+        else:
+            logger.error("Warm worker failed to start")
+            worker.stop()
+
+    def _replace(self, worker: _Worker) -> None:
+        """Stop a worker and spawn a fresh one in the background."""
+        worker.stop()
+        if not self._closed:
+            threading.Thread(target=self._spawn, daemon=True).start()
+
+    def run(self, code: str, timeout: float, stdout_path: str, stderr_path: str) -> RunResult:
+        """
+        Run code in a child forked from an idle warm worker, blocking until it finishes.
+
+        Args:
+            code: The Python code to run.
+            timeout: Maximum run time in seconds, the child is killed afterwards.
+            stdout_path: File that receives the child's stdout.
+            stderr_path: File that receives the child's stderr.
+
+        Returns:
+            RunResult: The return code, -1 when the run timed out.
+
+        Raises:
+            queue.Empty: If no worker became idle within WARM_POOL_ACQUIRE_TIMEOUT.
+        """
+        worker = self._idle.get(timeout=WARM_POOL_ACQUIRE_TIMEOUT)
+        try:
+            worker.conn.send({
+                "code": code,
+                "timeout": timeout,
+                "stdout_path": stdout_path,
+                "stderr_path": stderr_path,
+            })
+            if not worker.conn.poll(timeout + WORKER_REPLY_MARGIN):
+                raise RuntimeError("Warm worker did not answer in time")
+            reply = worker.conn.recv()
+        except Exception:
+            self._replace(worker)
+            raise
+
+        worker.runs += 1
+        if worker.runs >= self.max_runs:
+            logger.info(f"Recycling warm worker {worker.process.pid} after {worker.runs} runs")
+            self._replace(worker)
+        else:
+            self._idle.put(worker)
+        return RunResult(returncode=reply["returncode"], timed_out=reply["timed_out"])
+
+    def close(self) -> None:
+        """Stop all idle workers."""
+        self._closed = True
+        while True:
+            try:
+                self._idle.get_nowait().stop()
+            except queue.Empty:
+                break
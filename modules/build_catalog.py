@@ -0,0 +1,347 @@
+"""
+Build the modules catalog (docs/modules.json) from the docstrings of the packages in this directory.
+
+Every package under modules/ is parsed with ast, nothing is imported, so the build doesn't
+need the package dependencies. The public API of a package is what its __init__.py imports,
+or every public top-level class and function when it doesn't import anything.
+
+Packages are only re-parsed when the hash of their files changed since the last build,
+changed packages are parsed in parallel across a process pool. Catalog entries for modules
+that don't live in this directory (pandas, numpy, ...) are hand-maintained and kept as is.
+
+Usage:
+    python modules/build_catalog.py [--output docs/modules.json] [--jobs 4] [--force] [--compact]
+"""
+import argparse
+import ast
+import hashlib
+import json
+import os
+import re
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+
+CATALOG_FORMAT = 1
+
+MODULES_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_OUTPUT = os.path.join(os.path.dirname(MODULES_DIR), "docs", "modules.json")
+
+# Files besides the Python sources that feed the catalog entry of a package
+METADATA_FILES = ("setup.py", "README.MD", "README.md")
+
+def find_packages(modules_dir: str) -> List[str]:
+    """Return the names of the packages in the modules directory, laid out as <name>/<name>/__init__.py."""
+    return [
+        entry for entry in sorted(os.listdir(modules_dir))
+        if os.path.isfile(os.path.join(modules_dir, entry, entry, "__init__.py"))
+    ]
+
+def _source_files(package_dir: str) -> List[str]:
+    files = [name for name in METADATA_FILES if os.path.isfile(os.path.join(package_dir, name))]
+    for root, dirs, names in os.walk(package_dir):
+        dirs[:] = sorted(d for d in dirs if d not in ("__pycache__", "build") and not d.endswith(".egg-info"))
+        for name in sorted(names):
+            if name.endswith(".py"):
+                files.append(os.path.relpath(os.path.join(root, name), package_dir))
+    return sorted(set(files))
+
+def package_hash(package_dir: str) -> str:
+    """Hash the sources and metadata files of a package."""
+    digest = hashlib.sha256()
+    for relative_path in _source_files(package_dir):
+        digest.update(relative_path.encode())
+        with open(os.path.join(package_dir, relative_path), "rb") as f:
+            digest.update(hashlib.sha256(f.read()).digest())
+    return digest.hexdigest()[:16]
+
+def _summary(docstring: Optional[str]) -> str:
+    """Return the first paragraph of a docstring on a single line."""
+    if not docstring:
+        return ""
+    return " ".join(docstring.strip().split("\n\n")[0].split())
+
+# Brand names written as one word in snake case, GitLabClient -> gitlab_client rather than git_lab_client
+SNAKE_CASE_WORDS = {"GitLab": "Gitlab", "GitHub": "Github"}
+
+def _snake_case(name: str) -> str:
+    for word, replacement in SNAKE_CASE_WORDS.items():
+        name = name.replace(word, replacement)
+    return re.sub(r"(?<=[a-z0-9])(?=[A-Z])|(?<=[A-Z])(?=[A-Z][a-z])", "_", name).lower()
+
+def _signature(node: ast.AST, skip_self: bool = False) -> str:
+    """
+    Render the call arguments of a function definition, e.g. "project_id, ref='main'".
+    Arguments whose default isn't a literal are left out, the name it refers to is usually
+    not importable from the package and generated code copying the usage would fail.
+    """
+    args = node.args
+    positional = args.posonlyargs + args.args
+    defaults = [None] * (len(positional) - len(args.defaults)) + list(args.defaults)
+    pairs = list(zip(positional, defaults))[1 if skip_self else 0:]
+
+    parts = []
+    for arg, default in pairs:
+        if default is None:
+            parts.append(arg.arg)
+        elif isinstance(default, ast.Constant):
+            parts.append(f"{arg.arg}={ast.unparse(default)}")
+    if args.vararg:
+        parts.append(f"*{args.vararg.arg}")
+    for arg, default in zip(args.kwonlyargs, args.kw_defaults):
+        if default is None:
+            parts.append(arg.arg)
+        elif isinstance(default, ast.Constant):
+            parts.append(f"{arg.arg}={ast.unparse(default)}")
+    if args.kwarg:
+        parts.append(f"**{args.kwarg.arg}")
+    return ", ".join(parts)
+
+def _function_entries(node: ast.AST) -> List[Dict[str, str]]:
+    """Build the catalog entries of a top-level class or function."""
+    if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+        prefix = "await " if isinstance(node, ast.AsyncFunctionDef) else ""
+        return [{
+            "name": node.name,
+            "description": _summary(ast.get_docstring(node)),
+            "usage": f"result = {prefix}{node.name}({_signature(node)})",
+        }]
+
+    instance = _snake_case(node.name)
+    methods = [
+        item for item in node.body
+        if isinstance(item, (ast.FunctionDef, ast.AsyncFunctionDef))
+    ]
+    init = next((item for item in methods if item.name == "__init__"), None)
+    entries = [{
+        "name": node.name,
+        "description": _summary(ast.get_docstring(node)),
+        "usage": f"{instance} = {node.name}({_signature(init, skip_self=True) if init else ''})",
+    }]
+    for method in methods:
+        if method.name.startswith("_"):
+            continue
+        prefix = "await " if isinstance(method, ast.AsyncFunctionDef) else ""
+        is_static = any(isinstance(d, ast.Name) and d.id == "staticmethod" for d in method.decorator_list)
+        entries.append({
+            "name": method.name,
+            "description": _summary(ast.get_docstring(method)),
+            "usage": f"result = {prefix}{instance}.{method.name}({_signature(method, skip_self=not is_static)})",
+        })
+    return entries
+
+def _parse(path: str) -> ast.Module:
+    with open(path, "r", encoding="utf-8") as f:
+        return ast.parse(f.read(), filename=path)
+
+def _definitions(tree: ast.Module) -> Dict[str, ast.AST]:
+    return {
+        node.name: node for node in tree.body
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef))
+    }
+
+def _setup_description(package_dir: str) -> str:
+    """Return the description keyword of the setup() call in setup.py, if any."""
+    path = os.path.join(package_dir, "setup.py")
+    if not os.path.isfile(path):
+        return ""
+    for node in ast.walk(_parse(path)):
+        if isinstance(node, ast.Call) and getattr(node.func, "id", None) == "setup":
+            for keyword in node.keywords:
+                if keyword.arg == "description" and isinstance(keyword.value, ast.Constant):
+                    return str(keyword.value.value)
+    return ""
+
+def _readme_description(package_dir: str) -> str:
+    """Return the first paragraph after the title of the package README."""
+    for name in ("README.MD", "README.md"):
+        path = os.path.join(package_dir, name)
+        if os.path.isfile(path):
+            with open(path, "r", encoding="utf-8", errors="ignore") as f:
+                paragraphs = [p.strip() for p in f.read().split("\n\n") if p.strip()]
+            for paragraph in paragraphs:
+                lines = [line for line in paragraph.splitlines() if not line.startswith("#")]
+                if lines:
+                    return " ".join(" ".join(lines).split())
+    return ""
+
+def parse_package(modules_dir: str, name: str) -> Dict[str, Any]:
+    """
+    Extract the catalog entry of a package: its description and the classes, methods and
+    functions it exports, with their signatures and docstring summaries.
+
+    Args:
+        modules_dir: The modules directory.
+        name: The package name.
+
+    Returns:
+        Dict[str, Any]: The catalog entry of the package.
+    """
+    package_dir = os.path.join(modules_dir, name)
+    source_dir = os.path.join(package_dir, name)
+    init_tree = _parse(os.path.join(source_dir, "__init__.py"))
+
+    # Exported name -> submodule it is imported from, in import order
+    exports: List[Tuple[str, str]] = []
+    for node in init_tree.body:
+        if isinstance(node, ast.ImportFrom) and node.level == 1 and node.module:
+            exports.extend((alias.name, node.module) for alias in node.names if alias.name != "*")
+
+    trees: Dict[str, Dict[str, ast.AST]] = {"__init__": _definitions(init_tree)}
+    for relative_path in _source_files(source_dir):
+        submodule = relative_path[:-3].replace(os.sep, ".")
+        if submodule not in trees:
+            trees[submodule] = _definitions(_parse(os.path.join(source_dir, relative_path)))
+
+    if not exports:
+        exports = [
+            (definition, submodule)
+            for submodule, definitions in trees.items()
+            for definition in definitions
+            if not definition.startswith("_")
+        ]
+    exports.extend((definition, "__init__") for definition in trees["__init__"] if not definition.startswith("_"))
+
+    functions = []
+    seen = set()
+    for export, submodule in exports:
+        node = trees.get(submodule, {}).get(export)
+        if node is None or export in seen:
+            continue
+        seen.add(export)
+        functions.extend(_function_entries(node))
+
+    return {
+        "name": name,
+        "description": _summary(ast.get_docstring(init_tree)) or _setup_description(package_dir),
+        "functions": functions,
+    }
+
+def _merge_descriptions(
+    entry: Dict[str, Any], previous: Optional[Dict[str, Any]], package_dir: str
+) -> Dict[str, Any]:
+    """
+    Keep the hand-written descriptions of the previous catalog where the code has no docstring,
+    the package README is the last resort for the module description.
+    """
+    if not entry["description"]:
+        entry["description"] = (previous or {}).get("description") or _readme_description(package_dir)
+    if previous is None:
+        return entry
+    old_functions = {func["name"]: func for func in previous.get("functions", [])}
+    for func in entry["functions"]:
+        old = old_functions.get(func["name"])
+        if old and not func["description"]:
+            func["description"] = old.get("description", "")
+    return entry
+
+def load_catalog_file(path: str) -> Dict[str, Any]:
+    """Read an existing catalog, either the versioned format or the old plain list of modules."""
+    if not os.path.isfile(path):
+        return {"modules": [], "sources": {}}
+    with open(path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    if isinstance(data, list):
+        return {"modules": data, "sources": {}}
+    data.setdefault("sources", {})
+    return data
+
+def build_catalog(
+    modules_dir: str = MODULES_DIR,
+    output: str = DEFAULT_OUTPUT,
+    jobs: Optional[int] = None,
+    force: bool = False,
+) -> Tuple[Dict[str, Any], List[str]]:
+    """
+    Build the catalog, re-parsing only the packages whose files changed since the last build.
+
+    Args:
+        modules_dir: The directory with the module packages.
+        output: The existing catalog, reused for unchanged packages and hand-maintained entries.
+        jobs: Number of parser processes, defaults to the CPU count.
+        force: Re-parse every package.
+
+    Returns:
+        Tuple[Dict[str, Any], List[str]]: The catalog and the names of the re-parsed packages.
+    """
+    previous = load_catalog_file(output)
+    previous_modules = {module["name"]: module for module in previous["modules"]}
+    previous_sources = previous["sources"]
+
+    packages = find_packages(modules_dir)
+    hashes = {name: package_hash(os.path.join(modules_dir, name)) for name in packages}
+    changed = [
+        name for name in packages
+        if force or name not in previous_modules or previous_sources.get(name) != hashes[name]
+    ]
+
+    parsed: Dict[str, Dict[str, Any]] = {}
+    if len(changed) > 1 and jobs != 1:
+        with ProcessPoolExecutor(max_workers=min(jobs or os.cpu_count() or 1, len(changed))) as pool:
+            for name, entry in zip(changed, pool.map(parse_package, [modules_dir] * len(changed), changed)):
+                parsed[name] = entry
+    else:
+        for name in changed:
+            parsed[name] = parse_package(modules_dir, name)
+
+    def entry_for(name: str) -> Dict[str, Any]:
+        if name in parsed:
+            return _merge_descriptions(
+                parsed[name], previous_modules.get(name), os.path.join(modules_dir, name)
+            )
+        return previous_modules[name]
+
+    # Keep the order of the previous catalog, drop packages that were removed, append new ones
+    modules = []
+    for module in previous["modules"]:
+        name = module["name"]
+        if name in hashes:
+            modules.append(entry_for(name))
+        elif name not in previous_sources:
+            modules.append(module)
+    known = {module["name"] for module in modules}
+    modules.extend(entry_for(name) for name in packages if name not in known)
+
+    content = json.dumps(modules, sort_keys=True).encode()
+    catalog = {
+        "format": CATALOG_FORMAT,
+        "version": hashlib.sha256(content).hexdigest()[:16],
+        "sources": hashes,
+        "modules": modules,
+    }
+    return catalog, changed
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Build the modules catalog from the package docstrings.")
+    parser.add_argument("--modules-dir", default=MODULES_DIR, help="Directory with the module packages")
+    parser.add_argument("--output", default=DEFAULT_OUTPUT, help="Catalog file to update")
+    parser.add_argument("--jobs", type=int, default=None, help="Number of parser processes")
+    parser.add_argument("--force", action="store_true", help="Re-parse all packages")
+    parser.add_argument("--compact", action="store_true", help="Write the catalog without indentation")
+    args = parser.parse_args(argv)
+
+    catalog, changed = build_catalog(args.modules_dir, args.output, args.jobs, args.force)
+
+    previous_version = load_catalog_file(args.output).get("version")
+    if not changed and previous_version == catalog["version"]:
+        print(f"Catalog {catalog['version']} is up to date")
+        return 0
+
+    tmp_path = f"{args.output}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        if args.compact:
+            json.dump(catalog, f, separators=(",", ":"), ensure_ascii=False)
+        else:
+            json.dump(catalog, f, indent=4, ensure_ascii=False)
+            f.write("\n")
+    # Replace the file atomically, the API hot reloads it
+    os.replace(tmp_path, args.output)
+
+    print(
+        f"Wrote catalog {catalog['version']} with {len(catalog['modules'])} modules to {args.output}, "
+        f"re-parsed: {', '.join(changed) or 'none'}"
+    )
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,143 @@
+import os
+import re
+import json
+import numpy as np
+
+TOKEN = re.compile(r"\w+")
+
+def tokenize(text):
+    """Lowercase word tokens of the text, in order."""
+    return TOKEN.findall(text.lower())
+
+class InvertedIndex:
+    """
+    An inverted index of the passages with the positions of every token, for phrase matching.
+
+    The postings are three flat arrays sorted by term, passage row and position: the rows,
+    the positions, and the offsets of every term's postings, so they can be saved as .npy
+    files and memory-mapped like the TF-IDF matrix.
+
+    Attributes:
+        terms (dict): The term ids, by term.
+        term_ptr (np.ndarray): The postings of term t are at term_ptr[t]:term_ptr[t + 1].
+        rows (np.ndarray): The passage row of every posting.
+        positions (np.ndarray): The token position in its passage of every posting.
+    """
+
+    def __init__(self, terms=None, term_ptr=None, rows=None, positions=None):
+        self.terms = terms or {}
+        self.term_ptr = term_ptr if term_ptr is not None else np.zeros(1, dtype=np.int64)
+        self.rows = rows if rows is not None else np.zeros(0, dtype=np.int32)
+        self.positions = positions if positions is not None else np.zeros(0, dtype=np.int32)
+
+    @staticmethod
+    def _tokenize_all(texts, terms, first_row):
+        """Return the term ids, rows and positions of the tokens of the texts, adding new terms to terms."""
+        term_ids, rows, positions = [], [], []
+        for row, text in enumerate(texts, first_row):
+            tokens = tokenize(text)
+            term_ids.extend(terms.setdefault(token, len(terms)) for token in tokens)
+            rows.extend([row] * len(tokens))
+            positions.extend(range(len(tokens)))
+        return np.array(term_ids, dtype=np.int64), np.array(rows, dtype=np.int32), np.array(positions, dtype=np.int32)
+
+    @classmethod
+    def _from_postings(cls, terms, term_ids, rows, positions):
+        """Sort the postings and drop the terms without any."""
+        counts = np.bincount(term_ids, minlength=len(terms))
+        used = np.flatnonzero(counts)
+        if len(used) < len(terms):
+            remap = np.full(len(terms), -1)
+            remap[used] = np.arange(len(used))
+            terms = {term: int(remap[i]) for term, i in terms.items() if remap[i] >= 0}
+            term_ids, counts = remap[term_ids], counts[used]
+        order = np.lexsort((positions, rows, term_ids))
+        term_ptr = np.concatenate(([0], np.cumsum(counts))).astype(np.int64)
+        return cls(terms, term_ptr, rows[order], positions[order])
+
+    @classmethod
+    def build(cls, texts):
+        """
+        Index the texts, the row of a text being its position in texts.
+
+        Args:
+            texts (list): The texts of the passages.
+
+        Returns:
+            InvertedIndex: The index.
+        """
+        terms = {}
+        return cls._from_postings(terms, *cls._tokenize_all(texts, terms, 0))
+
+    def updated(self, kept_rows, texts):
+        """
+        Return a new index with the passages of kept_rows, renumbered from 0 in the same order,
+        followed by the passages of texts.
+
+        Args:
+            kept_rows (list): The rows kept, in ascending order.
+            texts (list): The texts of the new passages.
+
+        Returns:
+            InvertedIndex: The updated index.
+        """
+        kept_rows = np.asarray(kept_rows, dtype=np.int64)
+        term_ids = np.repeat(np.arange(len(self.term_ptr) - 1), np.diff(self.term_ptr))
+        kept = np.isin(self.rows, kept_rows)
+        terms = dict(self.terms)
+        new_term_ids, new_rows, new_positions = self._tokenize_all(texts, terms, len(kept_rows))
+        return self._from_postings(
+            terms,
+            np.concatenate((term_ids[kept], new_term_ids)),
+            np.concatenate((np.searchsorted(kept_rows, self.rows[kept]).astype(np.int32), new_rows)),
+            np.concatenate((self.positions[kept], new_positions)),
+        )
+
+    def search(self, query, n):
+        """
+        Find the passages containing the query as a phrase: all its tokens, consecutively.
+
+        Args:
+            query (str): The phrase.
+            n (int): The maximum number of passages.
+
+        Returns:
+            list: (row, occurrences) of the matching passages, most occurrences first.
+        """
+        tokens = tokenize(query)
+        if not tokens or any(token not in self.terms for token in tokens):
+            return []
+        postings = []
+        for offset, token in enumerate(tokens):
+            term = self.terms[token]
+            start, end = self.term_ptr[term], self.term_ptr[term + 1]
+            postings.append((end - start, offset, start, end))
+        # Intersect the rarest terms first, the candidates only get fewer
+        keys = None
+        for _, offset, start, end in sorted(postings):
+            positions = self.positions[start:end].astype(np.int64) - offset
+            valid = positions >= 0
+            # A phrase is identified by its passage and the position of its first token
+            token_keys = (self.rows[start:end][valid].astype(np.int64) << 32) | positions[valid]
+            keys = token_keys if keys is None else np.intersect1d(keys, token_keys, assume_unique=True)
+            if not len(keys):
+                return []
+        rows, occurrences = np.unique(keys >> 32, return_counts=True)
+        order = np.lexsort((rows, -occurrences))[:n]
+        return [(int(rows[i]), int(occurrences[i])) for i in order]
+
+    def save(self, path):
+        """Write the index to the directory: the postings as .npy files and the terms as JSON."""
+        for name in ("term_ptr", "rows", "positions"):
+            np.save(os.path.join(path, f"postings_{name}.npy"), getattr(self, name))
+        with open(os.path.join(path, "terms.json"), "w") as f:
+            json.dump(self.terms, f)
+
+    @classmethod
+    def load(cls, path):
+        """Load an index written by save(), memory-mapping the postings."""
+        with open(os.path.join(path, "terms.json")) as f:
+            terms = json.load(f)
+        arrays = [np.load(os.path.join(path, f"postings_{name}.npy"), mmap_mode="r")
+                  for name in ("term_ptr", "rows", "positions")]
+        return cls(terms, *arrays)
@@ -0,0 +1,102 @@
+import os
+import re
+
+# Maximum number of characters of a passage, longer sections are split at paragraph boundaries
+PASSAGE_MAX_CHARS = int(os.getenv("MISTRAL_DOCS_PASSAGE_CHARS", "1500"))
+
+# Number of passages a search returns
+PASSAGE_TOP_K = int(os.getenv("MISTRAL_DOCS_TOP_K", "5"))
+
+HEADING = re.compile(r"^(#{1,6})\s+(.*?)[\s#]*$")
+FENCE = re.compile(r"^\s*(```|~~~)")
+TITLE = re.compile(r"^title:\s*['\"]?(.*?)['\"]?\s*$")
+
+def _lines(content):
+    """Yield the lines of the content with their start offset."""
+    start = 0
+    for line in content.splitlines(keepends=True):
+        yield start, line
+        start += len(line)
+
+def _front_matter(content):
+    """Return the title and the end offset of the YAML front matter of a Markdown file, if any."""
+    if not content.startswith("---\n"):
+        return "", 0
+    end = content.find("\n---", 3)
+    if end == -1:
+        return "", 0
+    title = ""
+    for line in content[4:end].splitlines():
+        match = TITLE.match(line)
+        if match:
+            title = match.group(1)
+            break
+    next_line = content.find("\n", end + 4)
+    return title, len(content) if next_line == -1 else next_line + 1
+
+def _sections(content):
+    """Split the content at its Markdown headings, code blocks excluded, into (heading, start, end)."""
+    title, offset = _front_matter(content)
+    stack = [(0, title)] if title else []
+    sections, heading, start, in_fence = [], title, offset, False
+    for line_start, line in _lines(content):
+        if line_start < offset:
+            continue
+        if FENCE.match(line):
+            in_fence = not in_fence
+            continue
+        match = None if in_fence else HEADING.match(line.rstrip("\n"))
+        if match is None:
+            continue
+        sections.append((heading, start, line_start))
+        level = len(match.group(1))
+        stack = [entry for entry in stack if entry[0] < level] + [(level, match.group(2))]
+        heading = " > ".join(text for _, text in stack if text)
+        # The heading line stays in its section's text
+        start = line_start
+    sections.append((heading, start, len(content)))
+    return sections
+
+def _pack(content, start, end, max_chars):
+    """Split a section into chunks of at most max_chars, at blank lines, then line ends, when possible."""
+    chunks = []
+    while end - start > max_chars:
+        limit = start + max_chars
+        cut = content.rfind("\n\n", start, limit)
+        if cut <= start:
+            cut = content.rfind("\n", start, limit)
+        cut = limit if cut <= start else cut + 1
+        chunks.append((start, cut))
+        start = cut
+    chunks.append((start, end))
+    return chunks
+
+def split_passages(content, max_chars=PASSAGE_MAX_CHARS):
+    """
+    Split a document into heading-aware passages.
+
+    Every Markdown heading starts a new passage, headings inside code blocks excepted.
+    Sections longer than max_chars are split further at paragraph boundaries. Documents
+    without headings are only split by size.
+
+    Args:
+        content (str): The document content.
+        max_chars (int, optional): The maximum passage length. Defaults to PASSAGE_MAX_CHARS.
+
+    Returns:
+        list: (heading, start, end) of every passage, heading being the path of headings
+        it is under, e.g. "Function calling > Step 2", and start and end its offsets in the content.
+    """
+    passages = []
+    for heading, start, end in _sections(content):
+        for chunk_start, chunk_end in _pack(content, start, end, max_chars):
+            text = content[chunk_start:chunk_end]
+            # Skip the passages that are only whitespace or a heading line
+            if HEADING.match(text.strip()) or not text.strip():
+                continue
+            passages.append((heading, chunk_start, chunk_end))
+    return passages
+
+def passage_text(heading, text):
+    """The text a passage is indexed with, its heading path is searchable as well."""
+    return f"{heading}\n{text}" if heading else text
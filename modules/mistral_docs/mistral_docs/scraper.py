@@ -1,5 +1,6 @@
 import os
 import subprocess
+from .searcher import get_vector_store
 
 REPO_URL = "https://github.com/mistralai/platform-docs-public.git"
 CLONE_DIR = "./git"
@@ -25,5 +26,8 @@ def clone_repo(url=REPO_URL, clone_dir=CLONE_DIR):
 def scrape_docs():
     """
     Clone the repository and ensure the docs are up-to-date.
+    The search index is brought up to date as well, re-reading only the docs that changed.
     """
-    clone_repo()
\ No newline at end of file
+    clone_repo()
+    if os.path.isdir(DOCS_DIR):
+        get_vector_store(DOCS_DIR)
\ No newline at end of file
@@ -1,48 +1,77 @@
 import os
-from .vector_store import VectorStore
+from .vector_store import VectorStore, docs_version
+from .passages import PASSAGE_TOP_K
 
 DOCS_DIR = os.path.join("./git", "docs")
 
-def search_docs(query, vector_store=None):
+# Smoothing constant of reciprocal-rank fusion, 60 is the usual value
+RRF_K = int(os.getenv("MISTRAL_DOCS_RRF_K", "60"))
+
+# Passages each search ranks before the fusion
+RRF_CANDIDATES = 50
+
+# Vector stores loaded in this process, by docs directory
+_vector_stores = {}
+
+def get_vector_store(docs_dir=DOCS_DIR):
     """
-    Search the stored documents using both normal search and vector search.
+    Return the vector store of the docs directory, reusing the one loaded in this process
+    while the docs version is unchanged.
+
+    Args:
+        docs_dir (str, optional): The directory containing the documents. Defaults to DOCS_DIR.
+
+    Returns:
+        VectorStore: The vector store.
+    """
+    vector_store = _vector_stores.get(docs_dir)
+    if vector_store is None or vector_store.version != docs_version(docs_dir):
+        vector_store = _vector_stores[docs_dir] = VectorStore(docs_dir)
+    return vector_store
+
+def search_docs(query, vector_store=None, k=PASSAGE_TOP_K):
+    """
+    Search the stored documents using both normal search and vector search, returns the best passages with their file path, heading and score.
 
     Args:
         query (str): The search query.
         vector_store (VectorStore, optional): The vector store to use for vector search. Defaults to None.
+        k (int, optional): The maximum number of passages. Defaults to PASSAGE_TOP_K.
 
     Returns:
-        list: A list of search results.
+        list: The matching passages, dicts with the path of the file relative to the docs,
+        the heading path of the passage, its fused score and its text.
     """
     if vector_store is None:
-        vector_store = VectorStore(DOCS_DIR)
+        vector_store = get_vector_store(DOCS_DIR)
 
-    vector_results = vector_store.search(query)
-    normal_results = normal_search(query, DOCS_DIR)
+    rankings = [
+        vector_store.rank(query, RRF_CANDIDATES),
+        vector_store.phrase_rank(query, RRF_CANDIDATES),
+    ]
+    # Reciprocal-rank fusion: a passage ranked high by either search, or well by both, comes first
+    scores = {}
+    for ranking in rankings:
+        for rank, (row, _) in enumerate(ranking, 1):
+            scores[row] = scores.get(row, 0.0) + 1 / (RRF_K + rank)
+    top_rows = sorted(scores, key=lambda row: (-scores[row], row))[:k]
+    contents = {}
+    return [vector_store.passage(row, scores[row], contents) for row in top_rows]
 
-    # Combine and limit results to 5
-    combined_results = vector_results + normal_results
-    return combined_results[:3]
-
-def normal_search(query, docs_dir):
+def normal_search(query, vector_store=None, k=PASSAGE_TOP_K):
     """
-    Perform a normal search on the stored documents.
+    Perform a normal search on the stored documents: the passages containing the query as a phrase.
 
     Args:
         query (str): The search query.
-        docs_dir (str): The directory containing the documents.
+        vector_store (VectorStore, optional): The vector store whose inverted index is used. Defaults to None.
+        k (int, optional): The maximum number of passages. Defaults to PASSAGE_TOP_K.
 
     Returns:
-        list: A list of search results.
+        list: The matching passages, the score being the number of occurrences of the phrase.
     """
-    results = []
-    for root, _, files in os.walk(docs_dir):
-        for file in files:
-            file_path = os.path.join(root, file)
-            with open(file_path, 'r', encoding='utf-8') as f:
-                content = f.read()
-                if query.lower() in content.lower():
-                    results.append(content)
-                    if len(results) >= 3:
-                        return results
-    return results
\ No newline at end of file
+    if vector_store is None:
+        vector_store = get_vector_store(DOCS_DIR)
+
+    contents = {}
+    return [vector_store.passage(row, occurrences, contents) for row, occurrences in vector_store.phrase_rank(query, k)]
@@ -1,65 +1,500 @@
 import os
-from sklearn.feature_extraction.text import TfidfVectorizer
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+import subprocess
+from collections import Counter
+import numpy as np
+from scipy.sparse import csr_matrix, vstack
+from sklearn.feature_extraction.text import CountVectorizer, TfidfVectorizer
 from sklearn.metrics.pairwise import linear_kernel
+from sklearn.preprocessing import normalize
+from .passages import split_passages, passage_text, PASSAGE_TOP_K
+from .inverted_index import InvertedIndex
+
+# Directory of the persisted indexes, one subdirectory per docs version
+INDEX_DIR = os.getenv("MISTRAL_DOCS_INDEX_DIR", "./index")
+
+# Bumped whenever the files of a persisted index change meaning
+INDEX_FORMAT = 4
+
+# Number of persisted indexes kept, older docs versions are removed
+INDEX_KEEP = 2
+
+# Seconds after which a temporary index directory is considered abandoned, a build killed on timeout leaves one
+INDEX_TMP_GRACE = 3600
+
+# Share of the documents that may change in an update before the index is rebuilt from scratch
+REINDEX_DRIFT = float(os.getenv("MISTRAL_DOCS_REINDEX_DRIFT", "0.5"))
+
+def _git(docs_dir, *args):
+    return subprocess.run(
+        ["git", "-C", docs_dir, *args], capture_output=True, text=True, check=True
+    ).stdout
+
+def docs_version(docs_dir):
+    """
+    Return the version of the docs: the git commit of the repository they are in, or a
+    fingerprint of the file names, sizes and modification times outside of git.
+
+    Args:
+        docs_dir (str): The directory containing the documents.
+
+    Returns:
+        str: The docs version.
+    """
+    try:
+        commit = _git(docs_dir, "rev-parse", "HEAD").strip()
+        if commit:
+            return commit
+    except (OSError, subprocess.CalledProcessError):
+        pass
+    fingerprint = hashlib.sha256()
+    for path in list_documents(docs_dir):
+        stat = os.stat(path)
+        fingerprint.update(f"{path}\0{stat.st_size}\0{stat.st_mtime_ns}\n".encode())
+    return "files-" + fingerprint.hexdigest()[:16]
+
+def changed_documents(docs_dir, old_version, new_version):
+    """
+    Return the paths of the documents modified between two commits of the docs.
+
+    Args:
+        docs_dir (str): The directory containing the documents.
+        old_version (str): The commit the index was built from.
+        new_version (str): The current commit.
+
+    Returns:
+        set: The modified paths, None when git can't compare the two versions.
+    """
+    if old_version.startswith("files-") or new_version.startswith("files-"):
+        return None
+    try:
+        output = _git(docs_dir, "diff", "--name-only", "--no-renames", "--relative", "-z", old_version, new_version)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return {os.path.join(docs_dir, name) for name in output.split("\0") if name}
+
+def list_documents(docs_dir):
+    """Return the paths of the documents in the directory, in a stable order."""
+    paths = []
+    for root, dirs, files in os.walk(docs_dir):
+        dirs.sort()
+        for file in sorted(files):
+            paths.append(os.path.join(root, file))
+    return paths
+
+def read_text(path):
+    """
+    Return the text of a file, with universal newlines like open() in text mode.
+
+    Args:
+        path (str): The file path.
+
+    Returns:
+        str: The text, None for binary and non-UTF-8 files.
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    # Text files have no NUL bytes, binary ones almost always have some near the start
+    if b"\0" in data[:8192]:
+        return None
+    try:
+        text = data.decode('utf-8-sig')
+    except UnicodeDecodeError:
+        return None
+    return text.replace("\r\n", "\n").replace("\r", "\n")
 
 class VectorStore:
     """
     A class to create and search a vector store.
 
+    Documents are split into heading-aware passages and every passage is a row of the index,
+    searches return the best matching passages rather than whole files. An inverted index of
+    the passages with token positions is built alongside, for phrase matching. The vocabulary,
+    term counts, TF-IDF matrix and inverted index are saved under INDEX_DIR, keyed by the
+    docs version, and memory-mapped when a later VectorStore for the same docs is created.
+    After the docs were updated, the most recent saved index is updated instead of rebuilt:
+    only added and modified files are read again, the passages of deleted files are dropped and
+    the IDF weights are recomputed from the document frequencies.
+
     Attributes:
         docs_dir (str): The directory containing the documents.
-        documents (list): A list of document contents.
+        version (str): The docs version the index was built from.
+        paths (list): The document paths.
+        passages (list): [document, heading, start, end] of every passage, in matrix row order:
+            the index of its document in paths, its heading path and its offsets in the document.
         vectorizer (TfidfVectorizer): The TF-IDF vectorizer.
+        counts (csr_matrix): The term counts of every passage.
         tfidf_matrix (csr_matrix): The TF-IDF matrix.
+        inverted_index (InvertedIndex): The token positions of every passage.
+        stats (dict): How the index was obtained: loaded, built or updated.
     """
 
-    def __init__(self, docs_dir):
+    def __init__(self, docs_dir, index_dir=INDEX_DIR):
         """
-        Initialize the VectorStore.
+        Initialize the VectorStore, from the persisted index when there is one for the docs version.
 
         Args:
             docs_dir (str): The directory containing the documents.
+            index_dir (str, optional): The directory of the persisted indexes. Defaults to INDEX_DIR.
         """
         self.docs_dir = docs_dir
-        self.documents = self.load_documents()
-        self.vectorizer = TfidfVectorizer()
+        self.index_dir = index_dir
+        self.version = docs_version(docs_dir)
+        self._documents = None
+        if self.load(self.path):
+            self.stats = {"mode": "loaded"}
+            return
+        previous = self._latest_index()
+        if previous is None or not self.update(previous):
+            self.build()
+        self.save()
+
+    @property
+    def path(self):
+        return os.path.join(self.index_dir, self.version)
+
+    @property
+    def documents(self):
+        """The document contents, read on first access."""
+        if self._documents is None:
+            self._documents = self.load_documents()
+        return self._documents
+
+    def load_documents(self):
+        """
+        Load the documents from the directory.
+
+        Returns:
+            list: A list of document contents.
+        """
+        return [self.read_document(i) or "" for i in range(len(self.paths))]
+
+    def read_document(self, i):
+        """Return the content of document i of paths, None for binary and non-UTF-8 files."""
+        return read_text(self.paths[i])
+
+    def _split(self, documents, first=0):
+        """
+        Split documents into passages.
+
+        Args:
+            documents (iterable): Indexes in paths of the documents to split.
+            first (int, optional): The index the first document gets in the passages. Defaults to 0.
+
+        Returns:
+            tuple: The passages and the texts to index them with.
+        """
+        passages, texts = [], []
+        self.skipped = 0
+        for position, i in enumerate(documents, first):
+            content = self.read_document(i)
+            if content is None:
+                # Binary and non-UTF-8 files stay listed, without passages
+                self.skipped += 1
+                continue
+            for heading, start, end in split_passages(content):
+                passages.append([position, heading, start, end])
+                texts.append(passage_text(heading, content[start:end]))
+        return passages, texts
+
+    def build(self):
+        """Read all the documents, split them into passages and count their terms."""
+        self.paths = list_documents(self.docs_dir)
+        self.passages, texts = self._split(range(len(self.paths)))
+        counter = CountVectorizer()
         try:
-            self.tfidf_matrix = self.vectorizer.fit_transform(self.documents)
+            self.counts = counter.fit_transform(texts).tocsr()
+            self.vocabulary = {term: int(column) for term, column in counter.vocabulary_.items()}
         except ValueError as e:
             if "empty vocabulary" in str(e):
-                self.tfidf_matrix = None
+                self.counts, self.vocabulary = None, {}
             else:
                 raise
+        self._weigh()
+        self.inverted_index = InvertedIndex.build(texts)
+        self.stats = {
+            "mode": "built",
+            "documents": len(self.paths),
+            "passages": len(self.passages),
+            "skipped": self.skipped,
+        }
 
-    def load_documents(self):
+    def update(self, previous):
         """
-        Load the documents from the directory.
+        Update the index of an older docs version to the current docs.
+
+        Args:
+            previous (str): Directory of the older persisted index.
 
         Returns:
-            list: A list of document contents.
+            bool: False when the index should be rebuilt instead: git can't tell what changed,
+            or more than REINDEX_DRIFT of the documents changed.
+        """
+        old = VectorStore.__new__(VectorStore)
+        if not old.load(previous):
+            return False
+        modified = changed_documents(self.docs_dir, old.version, self.version)
+        if modified is None:
+            return False
+
+        self.paths = list_documents(self.docs_dir)
+        current = set(self.paths)
+        # Files outside of git show up as added or removed through the directory listing
+        kept = [i for i, path in enumerate(old.paths) if path in current and path not in modified]
+        kept_paths = {old.paths[i] for i in kept}
+        reread = [path for path in self.paths if path not in kept_paths]
+        if self.paths and len(reread) / len(self.paths) > REINDEX_DRIFT:
+            return False
+
+        # The kept documents come first, their passages keep their rows in the same order
+        self.paths = [old.paths[i] for i in kept] + reread
+        position = {document: i for i, document in enumerate(kept)}
+        kept_rows = [row for row, passage in enumerate(old.passages) if passage[0] in position]
+        self.passages = [[position[document], *rest] for document, *rest in (old.passages[row] for row in kept_rows)]
+        new_passages, texts = self._split(range(len(kept), len(self.paths)), len(kept))
+        self.passages += new_passages
+
+        self.vocabulary = dict(old.vocabulary)
+        analyzer = CountVectorizer().build_analyzer()
+        rows, columns, values = [], [], []
+        for row, text in enumerate(texts):
+            for term, count in Counter(analyzer(text)).items():
+                rows.append(row)
+                columns.append(self.vocabulary.setdefault(term, len(self.vocabulary)))
+                values.append(count)
+        width = len(self.vocabulary)
+        new_counts = csr_matrix((values, (rows, columns)), shape=(len(texts), width), dtype=np.int64)
+        kept_counts = old.counts[kept_rows] if old.counts is not None else csr_matrix((len(kept_rows), 0), dtype=np.int64)
+        kept_counts = csr_matrix(
+            (kept_counts.data, kept_counts.indices, kept_counts.indptr), shape=(len(kept_rows), width)
+        )
+        self.counts = vstack([kept_counts, new_counts], format="csr")
+        self._drop_unused_terms()
+        self._weigh()
+        self.inverted_index = old.inverted_index.updated(kept_rows, texts)
+        self.stats = {
+            "mode": "updated",
+            "from": old.version,
+            "documents": len(self.paths),
+            "passages": len(self.passages),
+            "reread": len(reread),
+            "skipped": self.skipped,
+            "removed": len(set(old.paths) - current),
+        }
+        return True
+
+    def _drop_unused_terms(self):
+        """Remove the terms only the deleted or changed documents had."""
+        document_frequency = np.bincount(self.counts.indices, minlength=self.counts.shape[1])
+        used = np.flatnonzero(document_frequency)
+        if len(used) == self.counts.shape[1]:
+            return
+        remap = np.full(self.counts.shape[1], -1)
+        remap[used] = np.arange(len(used))
+        self.counts = self.counts[:, used].tocsr()
+        self.vocabulary = {term: int(remap[column]) for term, column in self.vocabulary.items() if remap[column] >= 0}
+
+    def _weigh(self):
+        """Compute the IDF weights and the TF-IDF matrix from the counts, the same way TfidfVectorizer does."""
+        self.vectorizer = TfidfVectorizer(vocabulary=self.vocabulary or None)
+        if self.counts is None or self.counts.shape[1] == 0:
+            self.counts, self.tfidf_matrix = None, None
+            return
+        n_documents = self.counts.shape[0]
+        document_frequency = np.bincount(self.counts.indices, minlength=self.counts.shape[1])
+        # Smoothed IDF, the TfidfVectorizer default
+        idf = np.log((1 + n_documents) / (1 + document_frequency)) + 1
+        self.vectorizer.idf_ = idf
+        self.tfidf_matrix = normalize(self.counts.multiply(idf).tocsr().astype(np.float64))
+
+    def save(self):
+        """
+        Write the index to INDEX_DIR/<version>: the CSR arrays of the counts and TF-IDF matrices
+        and the postings of the inverted index as .npy files, the vocabulary, the terms, the
+        document paths and the passages as JSON. The directory is written
+        under a temporary name and renamed into place, readers never see a partial index.
+        When another process saved the index of the same docs version first, that one is
+        kept and loaded instead.
+        """
+        os.makedirs(self.index_dir, exist_ok=True)
+        tmp_dir = tempfile.mkdtemp(prefix=f".{self.version}-", dir=self.index_dir)
+        try:
+            meta = {"format": INDEX_FORMAT, "version": self.version, "paths": self.paths,
+                    "passages": self.passages, "shape": None}
+            if self.tfidf_matrix is not None:
+                meta["shape"] = list(self.tfidf_matrix.shape)
+                # Plain .npy files, unlike .npz they can be memory-mapped
+                for prefix, matrix in (("", self.tfidf_matrix), ("counts_", self.counts)):
+                    for name in ("data", "indices", "indptr"):
+                        np.save(os.path.join(tmp_dir, f"{prefix}{name}.npy"), getattr(matrix, name))
+                np.save(os.path.join(tmp_dir, "idf.npy"), self.vectorizer.idf_)
+                with open(os.path.join(tmp_dir, "vocabulary.json"), "w") as f:
+                    json.dump(self.vocabulary, f)
+            self.inverted_index.save(tmp_dir)
+            with open(os.path.join(tmp_dir, "meta.json"), "w") as f:
+                json.dump(meta, f)
+            if not VectorStore.__new__(VectorStore).load(self.path):
+                # Only an unusable leftover is removed, another process's complete index is kept
+                shutil.rmtree(self.path, ignore_errors=True)
+            os.rename(tmp_dir, self.path)
+        except OSError:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            # Scripts run in parallel, another one may have saved this docs version meanwhile
+            if not self.load(self.path):
+                raise
+            return
+        except BaseException:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+        self._prune()
+
+    def _load_matrix(self, path, prefix, shape):
+        arrays = [np.load(os.path.join(path, f"{prefix}{name}.npy"), mmap_mode="r")
+                  for name in ("data", "indices", "indptr")]
+        return csr_matrix(tuple(arrays), shape=shape, copy=False)
+
+    def load(self, path):
+        """
+        Load a persisted index, memory-mapping the matrices and the postings.
+
+        Args:
+            path (str): Directory of the persisted index.
+
+        Returns:
+            bool: False when there is no usable index in the directory.
+        """
+        try:
+            with open(os.path.join(path, "meta.json")) as f:
+                meta = json.load(f)
+            if meta.get("format") != INDEX_FORMAT:
+                return False
+            self.version = meta["version"]
+            self.paths = meta["paths"]
+            self.passages = meta["passages"]
+            self.vocabulary = {}
+            self.vectorizer = TfidfVectorizer()
+            self.counts = self.tfidf_matrix = None
+            self.inverted_index = InvertedIndex.load(path)
+            if meta["shape"] is not None:
+                shape = tuple(meta["shape"])
+                self.tfidf_matrix = self._load_matrix(path, "", shape)
+                self.counts = self._load_matrix(path, "counts_", shape)
+                with open(os.path.join(path, "vocabulary.json")) as f:
+                    self.vocabulary = json.load(f)
+                self.vectorizer = TfidfVectorizer(vocabulary=self.vocabulary)
+                self.vectorizer.idf_ = np.load(os.path.join(path, "idf.npy"))
+        except (OSError, ValueError, KeyError):
+            return False
+        return True
+
+    def _indexes(self):
+        """The persisted indexes, most recent first."""
+        if not os.path.isdir(self.index_dir):
+            return []
+        indexes = [
+            os.path.join(self.index_dir, name) for name in os.listdir(self.index_dir)
+            if not name.startswith(".") and os.path.isdir(os.path.join(self.index_dir, name))
+        ]
+        return sorted(indexes, key=os.path.getmtime, reverse=True)
+
+    def _latest_index(self):
+        """The most recent persisted index of another docs version, None if there is none."""
+        for path in self._indexes():
+            if path != self.path:
+                return path
+        return None
+
+    def _prune(self):
+        """
+        Remove the indexes of older docs versions, keeping the INDEX_KEEP most recent ones, and
+        the temporary directories of saves that were killed before they could clean up.
+        """
+        for path in self._indexes()[INDEX_KEEP:]:
+            if path != self.path:
+                shutil.rmtree(path, ignore_errors=True)
+        now = time.time()
+        for name in os.listdir(self.index_dir):
+            path = os.path.join(self.index_dir, name)
+            # Younger ones may belong to a save still running in another process
+            try:
+                abandoned = name.startswith(".") and now - os.path.getmtime(path) > INDEX_TMP_GRACE
+            except OSError:
+                continue
+            if abandoned and os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+
+    def passage(self, row, score, contents=None):
+        """
+        Return the passage in a row of the matrix.
+
+        Args:
+            row (int): The matrix row.
+            score (float): The search score of the passage.
+            contents (dict, optional): Document contents already read, by document index.
+
+        Returns:
+            dict: The path of the document relative to the docs directory, the heading path,
+            the score and the text of the passage.
         """
-        documents = []
-        for root, _, files in os.walk(self.docs_dir):
-            for file in files:
-                file_path = os.path.join(root, file)
-                with open(file_path, 'r', encoding='utf-8') as f:
-                    documents.append(f.read())
-        return documents
+        document, heading, start, end = self.passages[row]
+        if contents is None:
+            contents = {}
+        if document not in contents:
+            contents[document] = self.read_document(document)
+        return {
+            "path": os.path.relpath(self.paths[document], self.docs_dir),
+            "heading": heading,
+            "score": round(float(score), 4),
+            "text": contents[document][start:end].strip(),
+        }
 
-    def search(self, query):
+    def rank(self, query, n):
         """
-        Search the vector store for documents similar to the query.
+        Rank the passages by the cosine similarity of their TF-IDF vectors to the query.
 
         Args:
             query (str): The search query.
+            n (int): The maximum number of passages.
 
         Returns:
-            list: A list of similar documents.
+            list: (row, similarity) of the similar passages, most similar first.
         """
         if self.tfidf_matrix is None:
             return []
 
         query_vec = self.vectorizer.transform([query])
         cosine_similarities = linear_kernel(query_vec, self.tfidf_matrix).flatten()
-        related_docs_indices = cosine_similarities.argsort()[:-11:-1]
-        return [self.documents[i] for i in related_docs_indices]
\ No newline at end of file
+        top_rows = np.argsort(-cosine_similarities, kind="stable")[:n]
+        return [(int(row), float(cosine_similarities[row])) for row in top_rows if cosine_similarities[row] > 0]
+
+    def phrase_rank(self, query, n):
+        """
+        Rank the passages containing the query as a phrase by its number of occurrences.
+
+        Args:
+            query (str): The phrase.
+            n (int): The maximum number of passages.
+
+        Returns:
+            list: (row, occurrences) of the matching passages, most occurrences first.
+        """
+        return self.inverted_index.search(query, n)
+
+    def search(self, query, k=PASSAGE_TOP_K):
+        """
+        Search the vector store for the passages most similar to the query.
+
+        Args:
+            query (str): The search query.
+            k (int, optional): The maximum number of passages. Defaults to PASSAGE_TOP_K.
+
+        Returns:
+            list: The matching passages, best first, see passage().
+        """
+        # Only the documents of the returned passages are read, the index doesn't keep their content
+        contents = {}
+        return [self.passage(row, score, contents) for row, score in self.rank(query, k)]
@@ -7,5 +7,7 @@ setup(
     install_requires=[
         'requests',
         'scikit-learn',
+        'scipy',
+        'numpy',
     ],
 )
\ No newline at end of file